@@ -1,7 +1,7 @@
 import asyncio
 from datetime import datetime
 import os
-import random
+import socket
 import sys
 import functools
 import logging
@@ -10,18 +10,30 @@ from typing import Optional
 
 from cachetools import TTLCache
 
+import utils.clock as clock
 import utils.config as config
 import utils.gitutil as gitutil
-from utils.connection import Connection
+import utils.logpipe as logpipe
+from utils.connection import Connection, broadcast
 from utils.i10n import get_i10n_text
-from utils.phiraapi import PhiraFetcher
+from utils.phiraapi import OnlineProfile, PhiraFetcher
 from utils.room import *
+import utils.room
+from utils import chat, room_engine
 from utils.eventbus import EventBus
 from utils.plugin_manager import PluginManager
 from utils.commands import Command, CommandContext, CommandRegistry
 from utils.console import console_loop
 from utils.security import SecurityStore
-from rymc.phira.protocol.data import UserProfile
+from utils import hotrestart, snapshot
+from utils.resume import DetachedConnection, ResumeRegistry
+from utils.timeouts import TimeoutManager, TimeoutPolicy
+from utils.timerwheel import TimerWheel
+from utils import workers
+from utils.loopmonitor import monitor as loop_monitor
+from utils.metrics import cache_stats, callbacks, metrics
+from utils.directory import DirectoryClient, NodeCluster, parse_address
+from rymc.phira.protocol.data import RoomInfo, UserProfile
 from rymc.phira.protocol.data.message import *
 from rymc.phira.protocol.handler import SimplePacketHandler
 from rymc.phira.protocol.packet.clientbound import *
@@ -43,23 +55,45 @@ while os.path.exists(os.path.join(log_dir, f"{log_date}-{counter}.log")):
 
 log_filename = os.path.join(log_dir, f"{log_date}-{counter}.log")
 
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format='[%(asctime)s %(levelname)s]: [%(name)s] %(message)s',
-    datefmt='%H:%M:%S',
-    handlers=[
+# 控制台与文件输出由后台线程完成（utils/logpipe.py），事件循环只负责把日志记录放入队列
+logpipe.setup(
+    LOG_LEVEL,
+    [
         logging.StreamHandler(sys.stdout),
         logging.FileHandler(log_filename, encoding='utf-8')
-    ]
+    ],
+    fmt='[%(asctime)s %(levelname)s]: [%(name)s] %(message)s',
+    datefmt='%H:%M:%S',
 )
 
 logger = logging.getLogger("main")
+# 允许通过 config.json 将 Phira API 指向本地替身 (tools/mock_api.py)，并调整超时与重试
+PhiraFetcher.configure(
+    host=config.get_value("phira_api_host", None),
+    timeout=config.get_value("phira_api_timeout", None),
+    retry_attempts=config.get_value("phira_api_retries", None),
+    retry_wait=config.get_value("phira_api_retry_wait", None),
+)
 fetcher = PhiraFetcher()
+# OnlineProfile 的完整资料懒加载同样走 fetcher（便于替换为本地替身）
+OnlineProfile.loader = lambda token: fetcher.get_user_info(token)
 
-# 初始化TTL缓存: 最大1000个token，每个存活5分钟
-auth_cache = TTLCache(maxsize=1000, ttl=300)
+# 初始化TTL缓存: 最大1000个token，每个存活5分钟（时间取自 utils.clock，模拟时可替换为虚拟时钟）
+auth_cache = TTLCache(maxsize=1000, ttl=300, timer=clock.monotonic)
+auth_cache_stats = cache_stats("auth")
 online_user_list = {}
 online_profiles = {}
+# 鉴权完成前（还不知道玩家语言）的回复所用语言，见 config.json 的 default_language
+default_language = "zh-CN"
+# 由 kick() 关闭、断线时不进入续连保留的连接
+_kicked = set()
+# 连接/房间超时（鉴权、空闲、准备、游玩卡死），在 _main 中创建；离线工具不启用
+timeouts: Optional[TimeoutManager] = None
+# 断线/热重启后保留玩家房间位置的续连票据（同样在 _main 中创建）
+resume_registry: Optional[ResumeRegistry] = None
+# 集群视图：多进程模式下为本 worker 的 WorkerCluster（utils/workers.py），
+# 多节点模式下为 NodeCluster（utils/directory.py）；单机单进程运行时为 None
+cluster: Optional[DirectoryClient] = None
 git_info = gitutil.get_git_version(str(Path(__file__).resolve().parent))
 
 
@@ -77,8 +111,11 @@ class ServerState:
 
         self.rooms = room_mod.rooms
 
-        # soft room limits: rid -> max_players
-        self.room_limits = {}
+        # player limits (server-wide room default / online cap); per-room limit is Room.max_users
+        self.limits = room_mod.limits
+
+        # 管理员踢人（不保留房间位置，见 kick()）
+        self.kick = kick
 
         self.restart_requested = False
 
@@ -87,14 +124,19 @@ class MainHandler(SimplePacketHandler):
     def __init__(self, connection: Connection, event_bus: EventBus) -> None:
         super().__init__(connection)
         self.event_bus = event_bus
-        self._install_handler_events()
+        # 鉴权成功后才有玩家资料；断线后重新置为 None
+        self.user_info: Optional[OnlineProfile] = None
 
-    def _install_handler_events(self) -> None:
+    @classmethod
+    def _install_handler_events(cls) -> None:
         """Wrap all handleXXX methods to emit before/after events.
 
         This provides a generic event surface for plugins without having to
         manually emit an event inside each handler implementation.
 
+        The wrappers are installed once on the class (not per connection), so
+        an online player does not carry a set of bound closures around.
+
         Events:
           - handler.<method>.before
           - handler.<method>.after
@@ -102,11 +144,11 @@ class MainHandler(SimplePacketHandler):
         Payload contains: connection, handler, packet (if available), args/kwargs, result (after)
         """
 
-        for name in dir(self):
+        for name in dir(cls):
             if not name.startswith("handle") or name == "handle":
                 continue
 
-            attr = getattr(self, name, None)
+            attr = getattr(cls, name, None)
             if not callable(attr):
                 continue
 
@@ -117,7 +159,7 @@ class MainHandler(SimplePacketHandler):
             orig = attr
 
             @functools.wraps(orig)
-            def wrapped(*args, __name=name, __orig=orig, **kwargs):
+            def wrapped(self, *args, __name=name, __orig=orig, **kwargs):
                 packet = args[0] if args else None
                 try:
                     self.event_bus.emit(
@@ -131,7 +173,7 @@ class MainHandler(SimplePacketHandler):
                 except Exception:
                     logger.exception("Failed to emit handler event (before): %s", __name)
 
-                result = __orig(*args, **kwargs)
+                result = __orig(self, *args, **kwargs)
 
                 try:
                     self.event_bus.emit(
@@ -149,11 +191,23 @@ class MainHandler(SimplePacketHandler):
                 return result
 
             wrapped._pyphira_event_wrapped = True  # type: ignore[attr-defined]
-            setattr(self, name, wrapped)
+            setattr(cls, name, wrapped)
 
     def handleAuthenticate(self, packet: ServerBoundAuthenticatePacket) -> None:
         logger.info(f"Authenticate with token {packet.token}")
-        user_info = self._get_cached_user_info(packet.token)
+        # 续连: 同一 token 在保留期内重新登录时直接复用资料，不再请求 Phira API
+        ticket = resume_registry.peek(packet.token) if resume_registry is not None else None
+        if ticket is not None:
+            user_info = ticket.profile
+        else:
+            # 服务器满员时直接拒绝（续连的玩家本来就占着位置，不受限制），不再请求 Phira API
+            online = online_count() if limits.online is not None else 0
+            if limits.online is not None and online >= limits.online:
+                logger.info(f"Server full ({online}/{limits.online}), rejecting login")
+                self.connection.send(ClientBoundAuthenticatePacket.Failed(get_i10n_text(default_language, "server_full")))
+                self.connection.close()
+                return
+            user_info = self._get_cached_user_info(packet.token)
 
         # Ban check by user id
         try:
@@ -169,6 +223,13 @@ class MainHandler(SimplePacketHandler):
         except Exception:
             logger.exception("Security check failed (id)")
 
+        # 多进程/多节点: 玩家仍在另一个 worker/节点上（在线或保留着房间位置）时，把连接交过去处理登录
+        if cluster is not None and user_info.id not in online_user_list:
+            owner = cluster.user_node(user_info.id)
+            if owner is not None and owner != cluster.node:
+                hand_off(self, owner, {"packet": "authenticate", "token": packet.token})
+                return
+
         if user_info.id in online_user_list:
             old_connection: Connection = online_user_list[user_info.id]
             if not old_connection.is_closed():
@@ -182,11 +243,21 @@ class MainHandler(SimplePacketHandler):
 
         online_user_list[user_info.id] = self.connection
         online_profiles[user_info.id] = user_info
+        if timeouts is not None:
+            timeouts.authenticated(self.connection, user_info.id)
+        if cluster is not None:
+            cluster.user_online(user_info.id)
 
         self.user_info = user_info
         self.user_lang = user_info.language
 
-        packet = ClientBoundAuthenticatePacket.Success(UserProfile(user_info.id, user_info.name), False)
+        room_info = None
+        if resume_registry is not None:
+            ticket = resume_registry.claim(packet.token) or resume_registry.claim_user(user_info.id)
+            if ticket is not None:
+                room_info = self._resume_room(ticket)
+
+        packet = ClientBoundAuthenticatePacket.Success(UserProfile(user_info.id, user_info.name), False, room_info)
         self.connection.send(packet)
 
         # Emit auth success event for plugins
@@ -214,28 +285,77 @@ class MainHandler(SimplePacketHandler):
         else:
             logger.debug(f"Error while getting git info: {git_info.error}")
 
-    def _get_cached_user_info(self, token: str) -> Optional[any]:
-        """带缓存的获取用户信息"""
+    def _get_cached_user_info(self, token: str) -> Optional[OnlineProfile]:
+        """带缓存的获取用户信息（只保留精简资料，完整资料由插件按需懒加载）"""
         if token in auth_cache:
             logger.debug(f"Cache hit for token {token[:8]}...")
+            auth_cache_stats.hits += 1
             return auth_cache[token]
 
+        auth_cache_stats.misses += 1
         logger.debug(f"Cache miss for token {token[:8]}..., fetching from API")
-        user_info = fetcher.get_user_info(token)
+        user_info = OnlineProfile.from_user_info(fetcher.get_user_info(token), token=token)
         auth_cache[token] = user_info
         return user_info
 
-    def on_player_disconnected(self) -> None:
+    def _resume_room(self, ticket) -> Optional[RoomInfo]:
+        """把保留的房间位置交还给新连接，返回随鉴权成功包下发的房间信息"""
+        room = rooms.get(ticket.room_id)
+        if room is None or self.user_info.id not in room.users:
+            return None
+        room_user = room.users[self.user_info.id]
+        room_user.info = self.user_info
+        room_user.connection = self.connection
+        bind_traffic(self.connection, room)
+        if timeouts is not None:
+            timeouts.resumed(self.user_info.id, room)
+        logger.info(f"用户 [{self.user_info.id}] {self.user_info.name} 续连回到房间 {room.id}")
+        return RoomInfo(
+            roomId=room.id,
+            state=room.state,
+            live=room.live,
+            locked=room.locked,
+            cycle=room.cycle,
+            isHost=room.host == self.user_info.id,
+            isReady=self.user_info.id in room.ready,
+            users=[UserProfile(u.info.id, u.info.name) for u in room.users.values()],
+        )
+
+    def _hold_slot_for_resume(self) -> bool:
+        """断线时保留玩家在房间中的位置（RoomUser、房主、准备/完成状态都不变）"""
+        if resume_registry is None or resume_registry.grace <= 0 or self.user_info.token is None:
+            return False
+        room_id_query_result = get_roomId(self.user_info.id)
+        if room_id_query_result.get("status") == "1":
+            return False
+        roomId = room_id_query_result["roomId"]
+        rooms[roomId].users[self.user_info.id].connection = DetachedConnection(self.user_info.id)
+        hold_slot(self.user_info, roomId)
+        return True
+
+    def _engine_error(self, result) -> str:
+        """把 room_engine 返回的失败结果转换为提示文本"""
+        if "message" in result:
+            return result["message"]
+        return get_i10n_text(self.user_lang, result["reason"])
+
+    def on_player_disconnected(self, *, hold: bool = True) -> None:
         """
         当玩家断开连接时，这个方法会被调用。
         可以在这里做一些清理工作，比如把玩家从房间里移除。
+        hold=True 时，房间内的玩家会先保留位置等待续连（见 utils/resume.py），
+        保留期结束仍未回来时再以 hold=False 调用本方法完成离开。
         """
         # 检查这个玩家是否已经鉴权（登录），并且有 user_info 信息
         if hasattr(self, 'user_info') and self.user_info:
             logger.info(f"用户 [{self.user_info.id}] {self.user_info.name} 下线。")
             online_user_list.pop(self.user_info.id, None)
             online_profiles.pop(self.user_info.id, None)
+            chat.limiter.forget(self.user_info.id)
             logger.debug(f"Online user list after disconnect: {online_user_list}")
+            if hold and self._hold_slot_for_resume():
+                self.user_info = None
+                return
             # 获取这个用户所在的所有房间
             rooms_of_user = get_rooms_of_user(self.user_info.id)
             if rooms_of_user["status"] == "0":
@@ -262,14 +382,14 @@ class MainHandler(SimplePacketHandler):
 
                     # 房主掉线时转移房主，避免无人可控房间
                     if was_host:
-                        new_host_id = random.choice(list(room.users.keys()))
+                        new_host_id = choose_new_host(roomId)["host"]
                         change_host(roomId, new_host_id)
                         if new_host_id in room.users:
                             room.users[new_host_id].connection.send(ClientBoundChangeHostPacket(True))
 
-                    # 如果房间正在游玩，检查剩余玩家是否满足结束条件
-                    if isinstance(room.state, Playing):
-                        self.checkAllFinished(roomId)
+                    # 剩余玩家可能已满足开始/结束条件（两者都只在对应阶段生效，O(1) 判断）
+                    self.checkReady(roomId)
+                    self.checkAllFinished(roomId)
 
                     # 提醒这些房间里的所有其他玩家
                     packet = ClientBoundMessagePacket(LeaveRoomMessage(self.user_info.id, self.user_info.name))
@@ -277,8 +397,11 @@ class MainHandler(SimplePacketHandler):
                         if room_user.connection != self.connection:
                             room_user.connection.send(packet)
 
+            if cluster is not None:
+                cluster.user_offline(self.user_info.id)
+
             # 释放资源
-            del self.user_info
+            self.user_info = None
 
     def handleCreateRoom(self, packet: ServerBoundCreateRoomPacket) -> None:
         logger.info(f"Create room with id {packet.roomId}")
@@ -322,24 +445,19 @@ class MainHandler(SimplePacketHandler):
                 self.connection.close()
                 return
 
-            # Check if room exists and is in WaitForReady state
-            if packet.roomId in rooms:
-                if isinstance(rooms[packet.roomId].state, WaitForReady):
-                    # Room is in ready state, cannot join
-                    packet_room_in_ready = ClientBoundJoinRoomPacket.Failed(
-                        get_i10n_text(self.user_lang, "room_in_ready_state"))
-                    self.connection.send(packet_room_in_ready)
-                    return
-                elif isinstance(rooms[packet.roomId].state, Playing):
-                    # Room is in playing state, cannot join
-                    packet_room_playing = ClientBoundJoinRoomPacket.Failed(
-                        get_i10n_text(self.user_lang, "room_in_playing_state"))
-                    self.connection.send(packet_room_playing)
+            # 多进程/多节点: 房间属于另一个 worker/节点时把连接交过去，由对方重放这次加入
+            if cluster is not None and packet.roomId not in rooms and get_roomId(self.user_info.id).get("status") == "1":
+                owner = cluster.room_owner(packet.roomId)
+                if owner is not None and owner != cluster.node:
+                    hand_off(self, owner, {"packet": "join_room", "roomId": packet.roomId, "monitor": bool(packet.monitor)})
                     return
 
-            # 【修改】确保传递了 self.connection 参数
-            join_room_result = add_user(packet.roomId, self.user_info, self.connection)
-            if join_room_result == {"status": "0"}:
+            # 房间阶段是否允许加入（等待准备/游玩中不可加入）、锁定/满员等由 room_engine 统一判定并加入
+            join_room_result = room_engine.apply(packet.roomId, "join", self.user_info.id,
+                                                 user_info=self.user_info, connection=self.connection)
+            if join_room_result["status"] != "0":
+                self.connection.send(ClientBoundJoinRoomPacket.Failed(self._engine_error(join_room_result)))
+            else:
                 # 获取一堆信息
                 # 烦人
                 # 获取房间状态
@@ -371,22 +489,6 @@ class MainHandler(SimplePacketHandler):
                 packet = ClientBoundJoinRoomPacket.Success(gameState=room_state, users=user_profiles, monitors=monitors,
                                                            isLive=islive)
                 self.connection.send(packet)
-            elif join_room_result == {"status": "1"}:
-                # 房间不存在
-                packet = ClientBoundJoinRoomPacket.Failed(get_i10n_text(self.user_lang, "room_not_exist"))
-                self.connection.send(packet)
-            elif join_room_result == {"status": "2"}:
-                # 用户已存在
-                packet = ClientBoundJoinRoomPacket.Failed(get_i10n_text(self.user_lang, "user_already_exist"))
-                self.connection.send(packet)
-            elif join_room_result == {"status": "3"}:
-                # 用户已存在
-                packet = ClientBoundJoinRoomPacket.Failed(get_i10n_text(self.user_lang, "room_already_locked"))
-                self.connection.send(packet)
-            elif join_room_result == {"status": "4"}:
-                # 用户已存在
-                packet = ClientBoundJoinRoomPacket.Failed(get_i10n_text(self.user_lang, "room_duplicate_join"))
-                self.connection.send(packet)
 
     # ServerBoundLeaveRoomPacket
 
@@ -426,9 +528,9 @@ class MainHandler(SimplePacketHandler):
             else:
                 # 从踢人前的列表里排除自己，随机选新房主
                 # 注意：你代码里写的是踢monitor，实际判断的是踢自己，我按代码原逻辑保留
-                other_ids = [uid for uid in users_before_leave.keys() if uid != self.user_info.id]
-                if other_ids:  # 防御性检查
-                    new_host_id = random.choice(other_ids)
+                choose_result = choose_new_host(roomId, exclude=self.user_info.id)
+                if choose_result["status"] == "0":  # 防御性检查
+                    new_host_id = choose_result["host"]
         # ========================================================
 
         # --------- 真正离开房间（现在才踢）---------
@@ -471,11 +573,45 @@ class MainHandler(SimplePacketHandler):
             if new_host_id in room.users:
                 room.users[new_host_id].connection.send(ClientBoundChangeHostPacket(True))
 
+        if not should_destroy_room:
+            # 剩余玩家可能已满足开始/结束条件
+            self.checkReady(roomId)
+            self.checkAllFinished(roomId)
+
+    def handleChat(self, packet: ServerBoundChatPacket) -> None:
+        if self.user_info is None:
+            self.connection.close()
+            return
+        room_id_query_result = get_roomId(self.user_info.id)
+        if room_id_query_result.get("status") == "1":
+            self.connection.send(ClientBoundChatPacket.Failed(get_i10n_text(self.user_lang, "not_in_room")))
+            return
+        roomId = room_id_query_result["roomId"]
+
+        # 限速（令牌桶）与屏蔽词（Aho-Corasick），见 utils/chat.py
+        if not chat.limiter.allow(self.user_info.id):
+            self.connection.send(ClientBoundChatPacket.Failed(get_i10n_text(self.user_lang, "chat_too_fast")))
+            return
+        message = (packet.message or "").strip()
+        if not message:
+            self.connection.send(ClientBoundChatPacket.Failed(get_i10n_text(self.user_lang, "chat_empty")))
+            return
+        content, hits = chat.word_filter.apply(message)
+        if content is None:
+            logger.info(f"用户 [{self.user_info.id}] 的消息含屏蔽词 ({hits} 处)，已拒绝")
+            self.connection.send(ClientBoundChatPacket.Failed(get_i10n_text(self.user_lang, "chat_blocked")))
+            return
+
+        self.connection.send(ClientBoundChatPacket.Success())
+        # 房间内所有人（包括发送者）收到同一份编码好的消息
+        broadcast(get_connections(roomId)["connections"],
+                  ClientBoundMessagePacket(ChatMessage(self.user_info.id, content)))
+
     def handleSelectChart(self, packet: ServerBoundSelectChartPacket) -> None:
         logger.info(f"Select chart with id {packet.id}")
         # 获取用户所在房间
         roomId = get_roomId(self.user_info.id)
-        if roomId == None:
+        if roomId.get("status") == "1":
             # 用户不在房间
             packet_not_in_room = ClientBoundSelectChartPacket.Failed(get_i10n_text(self.user_lang, "not_in_room"))
             self.connection.send(packet_not_in_room)
@@ -486,18 +622,16 @@ class MainHandler(SimplePacketHandler):
             # 断开连接
             self.connection.close()
             return
-            # 判断是不是房主
-        if get_host(roomId)["host"] != self.user_info.id:
-            # 不是房主
-            packet_not_host = ClientBoundSelectChartPacket.Failed(get_i10n_text(self.user_lang, "not_host"))
-            self.connection.send(packet_not_host)
-            self.connection.send(ClientBoundChangeHostPacket(False))
+        # 设置chart（房主身份与房间阶段由 room_engine 校验）
+        select_result = room_engine.apply(roomId, "select_chart", self.user_info.id, chart=packet.id)
+        if select_result["status"] != "0":
+            self.connection.send(ClientBoundSelectChartPacket.Failed(self._engine_error(select_result)))
+            if select_result["status"] == "3":
+                # 不是房主
+                self.connection.send(ClientBoundChangeHostPacket(False))
             return
-        # 是房主
-        # 设置chart
-        set_chart(roomId, packet.id)
         # 通知其他用户
-        chart_info = PhiraFetcher.get_chart_info(packet.id)
+        chart_info = fetcher.get_chart_info(packet.id)
         connections = get_connections(roomId)["connections"]
         for connection in connections:
             # 如果当前要发送的消息是要发给自己
@@ -555,6 +689,7 @@ class MainHandler(SimplePacketHandler):
 
         # Change lock state
         rooms[roomId].locked = packet.lock
+        rooms.touch(roomId)
 
         # Send success response
         self.connection.send(ClientBoundLockRoomPacket.Success())
@@ -603,6 +738,7 @@ class MainHandler(SimplePacketHandler):
 
         # Change lock state
         rooms[roomId].cycle = packet.cycle
+        rooms.touch(roomId)
 
         # Send success response
         self.connection.send(ClientBoundCycleRoomPacket.Success())
@@ -618,29 +754,20 @@ class MainHandler(SimplePacketHandler):
         roomId = get_roomId(self.user_info.id)
         logger.info(f"Game start at room {roomId} by user {self.user_info.id}")
         # 检查在不在房间里
-        if roomId == None:
+        if roomId.get("status") == "1":
             # 用户不在房间
             packet_not_in_room = ClientBoundRequestStartPacket.Failed(get_i10n_text(self.user_lang, "not_in_room"))
             self.connection.send(packet_not_in_room)
             return
         roomId = roomId["roomId"]
-        # 检查是否在SelectChart状态
-        if not isinstance(rooms[roomId].state, SelectChart):
-            packet_not_select_chart = ClientBoundRequestStartPacket.Failed(
-                get_i10n_text(self.user_lang, "not_select_chart"))
-            self.connection.send(packet_not_select_chart)
+        # 切换状态WaitForReady，并把房主设置为ready（SelectChart 阶段 + 房主身份由 room_engine 校验）
+        start_result = room_engine.apply(roomId, "request_start", self.user_info.id)
+        if start_result["status"] != "0":
+            self.connection.send(ClientBoundRequestStartPacket.Failed(self._engine_error(start_result)))
+            if start_result["status"] == "3":
+                # 不是房主
+                self.connection.send(ClientBoundChangeHostPacket(False))
             return
-        # 验证房主身份
-        elif get_host(roomId)["host"] != self.user_info.id:
-            # 不是房主
-            packet_not_host = ClientBoundRequestStartPacket.Failed(get_i10n_text(self.user_lang, "not_host"))
-            self.connection.send(packet_not_host)
-            self.connection.send(ClientBoundChangeHostPacket(False))
-            return
-        # 切换状态WaitForReady
-        set_state(roomId, WaitForReady())
-        # 把房主的state设置为ready
-        set_ready(roomId, self.user_info.id)
         # 广播ClientBoundRequestStartPacket
         connections = get_connections(roomId)["connections"]
         for connection in connections:
@@ -665,15 +792,21 @@ class MainHandler(SimplePacketHandler):
         logger.info(f"Played submission from user {self.user_info.id} in room {roomId}, record ID: {packet.id}")
 
         # Check if room is in Playing state
-        if not isinstance(rooms[roomId].state, Playing):
-            packet_not_playing_state = ClientBoundPlayedPacket.Failed("Not in playing state")
-            self.connection.send(packet_not_playing_state)
+        played_check = room_engine.check(roomId, "played", self.user_info.id)
+        if played_check["status"] != "0":
+            self.connection.send(ClientBoundPlayedPacket.Failed(self._engine_error(played_check)))
             return
 
         try:
             # Fetch record result from Phira API
             result_info = fetcher.get_record_result(packet.id)
 
+            # Mark user as finished (before-hooks may still veto the submission)
+            played_result = room_engine.apply(roomId, "played", self.user_info.id)
+            if played_result["status"] != "0":
+                self.connection.send(ClientBoundPlayedPacket.Failed(self._engine_error(played_result)))
+                return
+
             # Send success response to the submitting player
             self.connection.send(ClientBoundPlayedPacket.Success())
 
@@ -690,9 +823,6 @@ class MainHandler(SimplePacketHandler):
                 )
                 connection.send(packet_played_msg)
 
-            # Mark user as finished
-            set_finished(roomId, self.user_info.id)
-
             # Check if all players have finished
             self.checkAllFinished(roomId)
 
@@ -713,10 +843,10 @@ class MainHandler(SimplePacketHandler):
         roomId = room_id_query_result["roomId"]
         logger.info(f"Abort submission from user {self.user_info.id} in room {roomId}")
 
-        # Check if room is in Playing state
-        if not isinstance(rooms[roomId].state, Playing):
-            packet_not_playing_state = ClientBoundAbortPacket.Failed("Not in playing state")
-            self.connection.send(packet_not_playing_state)
+        # Check if room is in Playing state and mark user as finished
+        abort_result = room_engine.apply(roomId, "abort", self.user_info.id)
+        if abort_result["status"] != "0":
+            self.connection.send(ClientBoundAbortPacket.Failed(self._engine_error(abort_result)))
             return
 
         # Send success response to the submitting player
@@ -728,9 +858,6 @@ class MainHandler(SimplePacketHandler):
             packet_played_msg = ClientBoundMessagePacket(AbortMessage(self.user_info.id))
             connection.send(packet_played_msg)
 
-        # Mark user as finished
-        set_finished(roomId, self.user_info.id)
-
         # Check if all players have finished
         self.checkAllFinished(roomId)
 
@@ -746,23 +873,18 @@ class MainHandler(SimplePacketHandler):
         roomId = room_id_query_result["roomId"]
         logger.info(f"Cancel ready at room {roomId} by user {self.user_info.id}")
 
-        # Check if room is in WaitForReady state
-        if not isinstance(rooms[roomId].state, WaitForReady):
-            packet_not_ready_state = ClientBoundCancelReadyPacket.Failed(
-                get_i10n_text(self.user_lang, "not_ready_state"))
-            self.connection.send(packet_not_ready_state)
-            return
-
         # Check if user is the host
         is_host = get_host(roomId)["host"] == self.user_info.id
 
-        if is_host:
-            # Host canceling: change room state back to SelectChart and cancel all ready states
-            set_state(roomId, SelectChart(chartId=rooms[roomId].chart))
-
-            # Cancel all ready states
-            rooms[roomId].ready.clear()
+        # Host canceling: change room state back to SelectChart and cancel all ready states
+        # Regular player canceling: just cancel their own ready state
+        # (WaitForReady state is checked by room_engine)
+        cancel_result = room_engine.apply(roomId, "cancel_start" if is_host else "cancel_ready", self.user_info.id)
+        if cancel_result["status"] != "0":
+            self.connection.send(ClientBoundCancelReadyPacket.Failed(self._engine_error(cancel_result)))
+            return
 
+        if is_host:
             # Broadcast state change to all room members
             connections = get_connections(roomId)["connections"]
             for connection in connections:
@@ -772,19 +894,6 @@ class MainHandler(SimplePacketHandler):
             # Send success response
             self.connection.send(ClientBoundCancelReadyPacket.Success())
         else:
-            # Regular player canceling: just cancel their own ready state
-            cancel_ready_result = cancel_ready(roomId, self.user_info.id)
-            if cancel_ready_result.get("status") != "0":
-                error_message = ""
-                if cancel_ready_result == {"status": "1"}:
-                    error_message = get_i10n_text(self.user_lang, "room_not_exist")
-                elif cancel_ready_result == {"status": "2"}:
-                    error_message = get_i10n_text(self.user_lang, "user_not_exist")
-                else:
-                    error_message = f"[Error canceling ready: {cancel_ready_result}]"
-                self.connection.send(ClientBoundCancelReadyPacket.Failed(error_message))
-                return
-
             # Send success response
             self.connection.send(ClientBoundCancelReadyPacket.Success())
 
@@ -808,23 +917,10 @@ class MainHandler(SimplePacketHandler):
         roomId = room_id_query_result["roomId"]
         logger.info(f"Ready at room {roomId} by user {self.user_info.id}")
 
-        # Check if room is in WaitForReady state
-        if not isinstance(rooms[roomId].state, WaitForReady):
-            packet_not_ready_state = ClientBoundReadyPacket.Failed(get_i10n_text(self.user_lang, "not_ready_state"))
-            self.connection.send(packet_not_ready_state)
-            return
-
-        # Set user as ready
-        set_ready_result = set_ready(roomId, self.user_info.id)
-        if set_ready_result.get("status") != "0":
-            error_message = ""
-            if set_ready_result == {"status": "1"}:
-                error_message = get_i10n_text(self.user_lang, "room_not_exist")
-            elif set_ready_result == {"status": "2"}:
-                error_message = get_i10n_text(self.user_lang, "user_not_exist")
-            else:
-                error_message = f"[Error setting ready: {set_ready_result}]"
-            self.connection.send(ClientBoundReadyPacket.Failed(error_message))
+        # Set user as ready (room must be in WaitForReady state, checked by room_engine)
+        ready_result = room_engine.apply(roomId, "ready", self.user_info.id)
+        if ready_result["status"] != "0":
+            self.connection.send(ClientBoundReadyPacket.Failed(self._engine_error(ready_result)))
             return
 
         # Send success response to the user
@@ -841,20 +937,36 @@ class MainHandler(SimplePacketHandler):
 
         self.checkReady(roomId)
 
-    def checkReady(self, roomId):
-        # Check if all players are ready
-        room = rooms[roomId]
-        all_users = list(room.users.keys())
-        ready_users = list(room.ready.keys())
-
+    def abortStalled(self, roomId, user_id):
+        """Abort a player on the server's behalf (playing stall / max duration timeout)."""
+        if room_engine.apply(roomId, "abort", user_id)["status"] != "0":
+            return
+        logger.info(f"User {user_id} aborted by timeout in room {roomId}")
         connections = get_connections(roomId)["connections"]
+        for connection in connections:
+            connection.send(ClientBoundMessagePacket(AbortMessage(user_id)))
+        self.checkAllFinished(roomId)
+
+    @staticmethod
+    def cancelStartByTimeout(roomId):
+        """Send a room stuck in WaitForReady back to SelectChart, as if the host cancelled."""
+        room = rooms.get(roomId)
+        if room is None or room_engine.apply(roomId, "cancel_start", room.host)["status"] != "0":
+            return
+        for room_user in room.users.values():
+            room_user.connection.send(ClientBoundChangeStatePacket(SelectChart(chartId=room.chart)))
+            text = get_i10n_text(room_user.info.language, "ready_timeout")
+            room_user.connection.send(ClientBoundMessagePacket(ChatMessage(-1, text)))
 
-        # Check if everyone is ready (including host)
-        if len(all_users) == len(ready_users) and len(all_users) > 0:
+    def checkReady(self, roomId):
+        # Check if everyone is ready (including host); O(1), see room_engine.all_ready
+        if room_engine.all_ready(roomId):
+            # Clear ready states and change room state to Playing
+            if room_engine.apply(roomId, "start_playing")["status"] != "0":
+                return
             logger.info(f"All players ready in room {roomId}, starting game...")
 
-            # Clear ready states before starting
-            room.ready.clear()
+            connections = get_connections(roomId)["connections"]
 
             # Send StartPlayingMessage to all room members
             for connection in connections:
@@ -863,9 +975,6 @@ class MainHandler(SimplePacketHandler):
                 )
                 connection.send(packet_start_msg)
 
-            # Change room state to Playing
-            set_state(roomId, Playing())
-
             # Broadcast state change to all room members
             for connection in connections:
                 packet_state_change = ClientBoundChangeStatePacket(Playing())
@@ -873,12 +982,12 @@ class MainHandler(SimplePacketHandler):
 
     def checkAllFinished(self, roomId):
         """Check if all players have finished playing and return to SelectChart state."""
-        room = rooms[roomId]
-        all_users = list(room.users.keys())
-        finished_users = list(room.finished.keys())
-
-        # Check if everyone has finished (including those who aborted)
-        if len(all_users) == len(finished_users) and len(all_users) > 0:
+        # Check if everyone has finished (including those who aborted); O(1)
+        if room_engine.all_finished(roomId):
+            # Change room state back to SelectChart, clear chart and finished states for next round
+            if room_engine.apply(roomId, "end_round")["status"] != "0":
+                return
+            room = rooms[roomId]
             logger.info(f"All players finished in room {roomId}, returning to SelectChart...")
 
             connections = get_connections(roomId)["connections"]
@@ -914,17 +1023,13 @@ class MainHandler(SimplePacketHandler):
                 room_users[new_host].connection.send(ClientBoundChangeHostPacket(True))
                 room_users[target_key].connection.send(ClientBoundChangeHostPacket(False))
 
-            # Change room state back to SelectChart
-            room.chart = None
-            set_state(roomId, SelectChart(chartId=room.chart))
-
             # Broadcast state change to all room members
             for connection in connections:
                 packet_state_change = ClientBoundChangeStatePacket(SelectChart(chartId=room.chart))
                 connection.send(packet_state_change)
 
-            # Clear finished states for next round
-            room.finished.clear()
+
+MainHandler._install_handler_events()
 
 
 def handle_connection(connection: Connection):
@@ -933,6 +1038,8 @@ def handle_connection(connection: Connection):
     handler.security_store = security_store
 
     def _on_packet(packet):
+        if timeouts is not None:
+            timeouts.packet_received(connection)
         # Generic packet events (for plugins)
         try:
             event_bus.emit(
@@ -952,23 +1059,280 @@ def handle_connection(connection: Connection):
 
         packet.handle(handler)
 
+    def _on_close():
+        if timeouts is not None:
+            timeouts.connection_closed(connection)
+        # 被管理员踢出/封禁的连接不保留房间位置
+        hold = connection not in _kicked
+        _kicked.discard(connection)
+        handler.on_player_disconnected(hold=hold)
+
     connection.set_receiver(_on_packet)
-    connection.on_close(lambda: handler.on_player_disconnected())
+    connection.on_close(_on_close)
+    if timeouts is not None:
+        timeouts.connection_opened(connection, handler)
+    return handler
+
+
+def hold_slot(profile, room_id, *, grace: Optional[float] = None):
+    """保留玩家在 room_id 中的位置；保留期内同一账号重新登录即可续连，过期后按正常下线处理"""
+
+    def _expire():
+        room = rooms.get(room_id)
+        if room is None or profile.id not in room.users:
+            return
+        handler = MainHandler(room.users[profile.id].connection, event_bus)
+        handler.user_info = profile
+        handler.user_lang = profile.language
+        handler.on_player_disconnected(hold=False)
+
+    return resume_registry.hold(profile.token, profile, room_id, on_expire=_expire if room_id is not None else None,
+                                grace=grace)
+
+
+def online_count() -> int:
+    """全服在线人数（含保留续连位置的玩家）：多进程/多节点时取集群目录中的人数，目录不可达时退回本进程人数"""
+    count = len(online_user_list)
+    if resume_registry is not None:
+        count += len(resume_registry)
+    if cluster is not None:
+        count = max(count, cluster.online_count() or 0)
+    return count
+
+
+def kick(user_id) -> bool:
+    """管理员踢出玩家：断开连接且不保留房间位置（同时作废其续连票据）。返回玩家是否在线或被保留着位置"""
+    found = False
+    if resume_registry is not None:
+        # 断线保留中的玩家：直接按保留期结束处理，立即离开房间
+        ticket = resume_registry.drop_user(user_id)
+        if ticket is not None:
+            found = True
+            if ticket.on_expire is not None:
+                ticket.on_expire()
+    conn = online_user_list.get(user_id)
+    if conn is not None:
+        found = True
+        _kicked.add(conn)
+        conn.close()
+    return found
+
+
+def write_snapshot(path: str, grace: float) -> int:
+    """热重启前保存房间与在线玩家（每人一张续连票据），返回快照字节数"""
+    room_of = {uid: rid for rid, room in rooms.items() for uid in room.users}
+    sessions = []
+    for uid, profile in online_profiles.items():
+        if profile.token is not None:
+            sessions.append((profile.token, uid, profile.name, profile.language, room_of.get(uid), grace))
+    if resume_registry is not None:
+        now = clock.monotonic()
+        for ticket in resume_registry:
+            if ticket.user_id not in online_profiles:
+                p = ticket.profile
+                sessions.append((ticket.token, p.id, p.name, p.language, ticket.room_id, max(0.0, ticket.expires - now)))
+    return snapshot.save(path, rooms, sessions)
+
+
+def restore_snapshot(path: str) -> None:
+    """新进程启动时恢复房间，并为快照中的每个玩家保留位置等待续连"""
+    try:
+        restored, sessions = snapshot.load(path)
+    except (OSError, snapshot.SnapshotError) as e:
+        logger.error(f"Failed to restore snapshot {path}: {e}")
+        return
+    rooms.update(restored)
+    for token, uid, name, language, room_id, remaining in sessions:
+        room = rooms.get(room_id)
+        if room is not None and uid in room.users:
+            profile = room.users[uid].info
+        else:
+            profile, room_id = OnlineProfile(uid, name, language, token=token), None
+        hold_slot(profile, room_id, grace=remaining)
+    logger.info(f"Restored {len(restored)} rooms and {len(sessions)} sessions from snapshot")
+
+
+def hand_off(handler: MainHandler, node, replay: dict) -> None:
+    """把连接交给另一个 worker / 节点，对方接管后重放 replay 描述的请求
+
+    多进程模式下转交 socket 本身；多节点模式下由本节点中继到对方节点。
+    """
+    connection = handler.connection
+    user_info = getattr(handler, "user_info", None)
+    payload = {"replay": replay, "user": None}
+    if user_info is not None:
+        payload["user"] = {"id": user_info.id, "name": user_info.name, "language": user_info.language,
+                           "token": user_info.token}
+        # 玩家转移到对方: 这里只清理本地记录，不触发离开房间/保留位置
+        online_user_list.pop(user_info.id, None)
+        online_profiles.pop(user_info.id, None)
+        cluster.user_offline(user_info.id)
+        del handler.user_info
+    # 超时由接管方负责
+    if timeouts is not None:
+        timeouts.connection_closed(connection)
+    connection.on_close(None)
+    logger.info(f"Handing connection over to {node}: {replay}")
+    cluster.hand_off(connection, node, payload)
+
+
+def adopt_connection(connection: Connection, payload: dict) -> None:
+    """接管另一个 worker 交过来的连接：恢复登录状态并重放请求"""
+    handler = handle_connection(connection)
+    user = payload.get("user")
+    if user is not None:
+        profile = OnlineProfile(user["id"], user["name"], user["language"], token=user["token"])
+        online_user_list[profile.id] = connection
+        online_profiles[profile.id] = profile
+        handler.user_info = profile
+        handler.user_lang = profile.language
+        if timeouts is not None:
+            timeouts.authenticated(connection, profile.id)
+        cluster.user_online(profile.id)
+
+    replay = payload["replay"]
+    if replay["packet"] == "authenticate":
+        packet = ServerBoundAuthenticatePacket()
+        packet.token = replay["token"]
+    else:
+        packet = ServerBoundJoinRoomPacket()
+        packet.roomId = replay["roomId"]
+        packet.monitor = replay["monitor"]
+    connection.receiver(packet)
+
+
+def _node_cluster() -> NodeCluster:
+    """多节点模式：按 config.json 的 cluster_broker / node_id / node_address 加入集群"""
+    address = config.get_value("node_address", None)
+    if address:
+        address = parse_address(address)
+    else:
+        # 其它节点需要能连到本节点的游戏端口；监听 0.0.0.0 时退而使用主机名
+        address = (socket.gethostname() if HOST in ("0.0.0.0", "::", "") else HOST, PORT)
+    node = config.get_value("node_id", None) or f"{socket.gethostname()}:{PORT}"
+    return NodeCluster(node, address, broker=config.get_value("cluster_broker", None))
+
+
+def _register_local_state() -> None:
+    """(重新)向目录登记本节点的房间与在线玩家，例如与 broker 的连接断开重连之后"""
+    for roomId in list(rooms):
+        if not cluster.claim(roomId):
+            logger.warning(f"Room {roomId} is now owned by another node")
+    for user_id in list(online_user_list):
+        cluster.user_online(user_id)
+    if resume_registry is not None:
+        for ticket in resume_registry:
+            cluster.user_online(ticket.user_id)
 
 
 if __name__ == '__main__':
-    async def _main() -> None:
+    async def _main(cluster_: Optional[DirectoryClient] = None) -> None:
         # Global event bus + plugin manager (must start within a running loop)
         global event_bus
         global security_store
+        global timeouts
+        global resume_registry
+        global cluster
+        global default_language
+
+        # 多进程/多节点模式：房间创建/销毁经目录登记，保证房间号全局唯一
+        cluster = cluster_
+        if cluster is None and config.get_value("cluster_broker", None):
+            cluster = _node_cluster()
+        utils.room.room_directory = cluster
+        if cluster is not None:
+            # 处理数据包时的目录请求最多等待的秒数，超时按目录不可达处理
+            cluster.call_timeout = float(config.get_value("cluster_call_timeout", cluster.call_timeout))
 
         event_bus = EventBus()
         security_store = SecurityStore("security.json")
-        plugin_manager = PluginManager(event_bus, plugins_dir="plugins", poll_interval=1.0)
+        # 插件回调计时（utils/metrics.py 的 callbacks），关闭时事件分发不做任何计时
+        callbacks.set_enabled(bool(config.get_value("plugin_profiling", False)))
+        callbacks.attach(event_bus)
+
+        # 房间状态机钩子 -> 插件事件 (room.transition.before 可通过 reject(reason) 否决)
+        def _room_transition_before(room, transition, user_id):
+            rejected = []
+            event_bus.emit(
+                "room.transition.before",
+                room=room,
+                transition=transition.name,
+                source=room_engine.phase_of(room).value,
+                target=(transition.target or room_engine.phase_of(room)).value,
+                user_id=user_id,
+                reject=rejected.append,
+            )
+            return rejected[0] if rejected else None
+
+        def _room_transition_after(room, transition, user_id, source):
+            event_bus.emit(
+                "room.transition.after",
+                room=room,
+                transition=transition.name,
+                source=source.value,
+                target=room_engine.phase_of(room).value,
+                user_id=user_id,
+            )
+
+        room_engine.add_hook(before=_room_transition_before, after=_room_transition_after)
+
+        # 所有超时共用一个时间轮（单个 asyncio 任务驱动）
+        timer_wheel = TimerWheel()
+        timeouts = TimeoutManager(
+            timer_wheel,
+            TimeoutPolicy.from_config(config.get_value),
+            on_auth_timeout=lambda connection: connection.close(),
+            on_idle=lambda connection: connection.close(),
+            on_ready_timeout=lambda roomId: MainHandler.cancelStartByTimeout(roomId),
+            # 断线保留位置的玩家没有 handler（None），借用一个临时 handler 走同样的放弃流程
+            on_stalled=lambda handler, roomId, user_id: (
+                handler or MainHandler(DetachedConnection(user_id), event_bus)).abortStalled(roomId, user_id),
+        )
+        room_engine.add_hook(after=timeouts.room_transition)
+        timer_wheel.start()
+
+        # 事件循环延迟监控 + 卡顿时抓取主线程调用栈（utils/loopmonitor.py）
+        loop_monitor.interval = float(config.get_value("loop_lag_interval", loop_monitor.interval))
+        loop_monitor.threshold = float(config.get_value("loop_lag_threshold", loop_monitor.threshold) or 0)
+        loop_monitor.start()
+
+        # 收发管线计时采样间隔（utils/metrics.py），0 关闭计时
+        metrics.sample_every = int(config.get_value("metrics_sample", metrics.sample_every) or 0)
+
+        # 房间聊天：每人 chat_burst 条突发、每秒恢复 chat_rate 条；屏蔽词表改动后自动重新加载
+        chat.limiter.rate = float(config.get_value("chat_rate", chat.limiter.rate) or 0)
+        chat.limiter.burst = int(config.get_value("chat_burst", chat.limiter.burst))
+        chat.word_filter.path = config.get_value("chat_filter_file", chat.word_filter.path)
+        chat.word_filter.action = config.get_value("chat_filter_action", chat.word_filter.action)
+        chat.word_filter.load()
+
+        # 人数上限（utils/room.py 的 limits），0 / 不填表示不限
+        limits.room_default = int(config.get_value("room_max_users", 0) or 0) or None
+        limits.online = int(config.get_value("max_online_players", 0) or 0) or None
+        default_language = config.get_value("default_language", default_language)
+
+        resume_registry = ResumeRegistry(config.get_value("resume_grace", 60), wheel=timer_wheel)
+        snapshot_path = hotrestart.inherited_snapshot()
+        if snapshot_path:
+            restore_snapshot(snapshot_path)
+        if isinstance(cluster, NodeCluster):
+            cluster.on_reconnect = _register_local_state
+            cluster.connect()
+            _register_local_state()
+            asyncio.create_task(cluster.keepalive(config.get_value("cluster_keepalive", 2.0)))
+        # plugin_import_threads > 0：插件在线程池中导入，监听端口不必等待 fastapi 等重依赖
+        # plugin_watch：auto（Linux 上用 inotify，否则轮询）/ inotify / poll / off
+        plugin_manager = PluginManager(event_bus, plugins_dir="plugins", poll_interval=1.0,
+                                       import_threads=int(config.get_value("plugin_import_threads", 0) or 0),
+                                       watch=config.get_value("plugin_watch", "auto"),
+                                       debounce=float(config.get_value("plugin_watch_debounce", 0.2)),
+                                       sandbox=config.get_value("plugin_sandbox", []) or [],
+                                       sandbox_cpu=float(config.get_value("plugin_sandbox_cpu", 0.5)))
         plugin_manager.start()
 
         shutdown_event = asyncio.Event()
         registry = CommandRegistry()
+        callbacks.attach(registry)
         state = ServerState(host=HOST, port=PORT, git_info=git_info, security=security_store)
 
         ctx = CommandContext(
@@ -1004,16 +1368,36 @@ if __name__ == '__main__':
         except Exception:
             logger.exception("Failed to emit commands.init")
 
-        # Start console loop
-        console_task = asyncio.create_task(console_loop(registry, ctx, prompt="> "))
+        # Start console loop (多进程模式下只有 0 号 worker 读取控制台)
+        console_task = None
+        if not isinstance(cluster, workers.WorkerCluster) or cluster.worker_id == 0:
+            console_task = asyncio.create_task(console_loop(registry, ctx, prompt="> "))
 
-        server = Server(HOST, PORT, handle_connection, security_store=security_store)
+        server = Server(HOST, PORT, handle_connection, security_store=security_store,
+                        sock=cluster.listen_socket() if isinstance(cluster, workers.WorkerCluster)
+                        else hotrestart.inherited_socket())
         await server.start()
+        if isinstance(cluster, workers.WorkerCluster):
+            cluster.start_inbox(lambda sock, payload: asyncio.create_task(server.adopt(
+                sock, workers.decode_pending(payload), lambda connection: adopt_connection(connection, payload))))
 
         # Wait for shutdown requested by console command
         await shutdown_event.wait()
 
         # shutdown sequence
+        listen_fd = None
+        snapshot_path = None
+        if state.restart_requested and not isinstance(cluster, workers.WorkerCluster):
+            # 热重启: 在停止服务器之前复制监听 socket 并写快照；旧连接随 exec 断开，客户端重连时凭 token 续连
+            try:
+                listen_fd = hotrestart.keep_listener(server.listening_socket())
+                snapshot_path = config.get_value("restart_snapshot", "restart_snapshot.bin")
+                size = write_snapshot(snapshot_path, resume_registry.grace)
+                logger.info(f"Wrote restart snapshot ({size} bytes, {len(rooms)} rooms)")
+            except Exception:
+                logger.exception("Failed to prepare hot restart, rooms will not be restored")
+                snapshot_path = None
+        loop_monitor.stop()
         try:
             plugin_manager.stop()
         except Exception:
@@ -1022,13 +1406,28 @@ if __name__ == '__main__':
             await server.stop()
         except Exception:
             logger.exception("Server stop failed")
-        try:
+        if console_task is not None:
             console_task.cancel()
-        except Exception:
-            pass
+        if cluster is not None:
+            cluster.close()
+        if isinstance(cluster, workers.WorkerCluster):
+            if state.restart_requested:
+                # 由协调进程重新执行自身并拉起全部 worker
+                raise SystemExit(workers.RESTART_EXIT_CODE)
+            raise SystemExit(0)
 
         if state.restart_requested:
             logger.warning("Restart requested, execv...")
-            os.execv(sys.executable, [sys.executable] + sys.argv)
+            hotrestart.exec_self(listen_fd, snapshot_path)
 
-    asyncio.run(_main())
+    worker_count = int(config.get_value("workers", 1) or 1)
+    if worker_count > 1 and workers.supported():
+        if config.get_value("cluster_broker", None):
+            logger.warning("cluster_broker is ignored in worker mode")
+        if workers.run(worker_count, HOST, PORT, lambda c: asyncio.run(_main(c))) == workers.RESTART_EXIT_CODE:
+            logger.warning("Restart requested, execv...")
+            hotrestart.exec_self()
+    else:
+        if worker_count > 1:
+            logger.warning("Worker mode is not supported on this platform, running a single process")
+        asyncio.run(_main())
@@ -11,6 +11,9 @@ import time
 from typing import List, Union
 
 from utils.commands import Command, CommandContext
+from utils.loopmonitor import monitor as loop_monitor
+from utils.metrics import callbacks, metrics, top_traffic
+from utils.packettrace import tracer
 
 PLUGIN_INFO = { "name": "console_admin", "version": "1.0.1", }
 
@@ -49,25 +52,74 @@ def on_commands_init(registry=None, ctx=None, **_):
 
     # ========== 基础命令 ==========
 
+    def parse_room_query(args: List[str]):
+        """/room 的筛选参数 -> rooms.query 的参数；出错时返回错误信息字符串"""
+        from utils.room import has_space, state_type
+        flags = {"1": True, "true": True, "yes": True, "0": False, "false": False, "no": False}
+        query = {"limit": 20}
+        for arg in args:
+            key, _, value = arg.partition("=")
+            key = key.lower()
+            try:
+                if key == "state":
+                    query["state"] = state_type(value)
+                    if query["state"] is None:
+                        return f"未知状态: {value} (selectchart / waitforready / playing)"
+                elif key == "chart":
+                    query["chart"] = int(value)
+                elif key in ("locked", "live"):
+                    if value.lower() not in flags:
+                        return f"{key} 只能是 0 或 1"
+                    query[key] = flags[value.lower()]
+                elif key == "players":
+                    low, _, high = value.partition("-")
+                    query["min_players"] = int(low) if low else None
+                    query["max_players"] = int(high) if high else (None if "-" in value else int(low))
+                elif key == "free":
+                    query["where"] = lambda rid, room: has_space(room)
+                elif key == "after":
+                    query["after"] = value
+                elif key == "limit":
+                    query["limit"] = max(1, int(value))
+                else:
+                    return f"未知筛选条件: {arg}"
+            except ValueError:
+                return f"参数格式错误: {arg}"
+        return query
+
     def cmd_room(c: CommandContext, args: List[str]):
-        """列出所有房间信息"""
+        """列出房间信息（可按状态/谱面/锁定/直播/人数筛选并分页）"""
+        from utils.room import room_capacity
         rooms = state.rooms
         if not rooms:
             c.println("当前没有活跃的房间")
             return
+        listing = rooms.items()
+        footer = None
+        if args:
+            query = parse_room_query(args)
+            if isinstance(query, str):
+                c.println(query)
+                c.println("用法: /room [state=playing] [chart=ID] [locked=0|1] [live=0|1] [players=2-4] [free] [after=游标] [limit=20]")
+                return
+            listing, cursor, total = rooms.query(**query)
+            footer = f"共 {total} 个符合条件" + (f"，下一页: after={cursor}" if cursor is not None else "")
         lines = ["房间列表:"]
-        for rid, room in rooms.items():
+        for rid, room in listing:
             host_id = room.host or "N/A"
             user_count = len(room.users)
             st = type(room.state).__name__
             locked = "🔒" if room.locked else ""
             cycle = "🔄" if room.cycle else ""
-            maxp = state.room_limits.get(rid, "无限制")
-            maxp_str = f"/{maxp}" if isinstance(maxp, int) else ""
+            maxp = room_capacity(room)
+            maxp_str = f"/{maxp}" if maxp is not None else ""
             over = ""
-            if isinstance(maxp, int) and user_count > maxp:
+            # 上限调低到现有人数以下时已在房间里的玩家不会被踢出，只是不能再加入
+            if maxp is not None and user_count > maxp:
                 over = " [OVER]"
             lines.append(f"  [{rid}] 房主:{host_id} 人数:{user_count}{maxp_str}{over} 状态:{st}{locked}{cycle}")
+        if footer:
+            lines.append(footer)
         c.println("\n".join(lines))
 
     def cmd_status(c: CommandContext, args: List[str]):
@@ -77,12 +129,13 @@ def on_commands_init(registry=None, ctx=None, **_):
             "===== 服务器状态 =====",
             f"监听地址: {state.host}:{state.port}",
             f"支持协议版本: {SUPPORTED_VERSIONS}",
-            f"在线玩家数: {len(state.online_user_list)}",
+            f"在线玩家数: {len(state.online_user_list)}" + (f"/{state.limits.online}" if state.limits.online else ""),
             f"房间数: {len(state.rooms)}",
         ]
         if state.git_info and not state.git_info.error:
             dirty = " (dirty)" if state.git_info.is_dirty else ""
             lines.append(f"Git: {state.git_info.short_hash}{dirty}")
+        lines.extend(loop_monitor.status_lines())
         lines.append("=====================")
         c.println("\n".join(lines))
 
@@ -122,31 +175,20 @@ def on_commands_init(registry=None, ctx=None, **_):
             raw_rid = args[1].lstrip("#")
             target_room_id = try_parse_id(raw_rid)
 
-        sent = 0
+        from rymc.phira.protocol.packet.clientbound import ClientBoundMessagePacket
+        from rymc.phira.protocol.data.message import ChatMessage
+        from utils.connection import broadcast
+        packet = ClientBoundMessagePacket(ChatMessage(-1, f"[广播] {content}"))
         if target_room_id is not None:
             # 指定房间
             room = state.rooms.get(target_room_id)
             if not room:
                 c.println(f"房间 {target_room_id} 不存在")
                 return
-            for uid, ru in room.users.items():
-                try:
-                    from rymc.phira.protocol.packet.clientbound import ClientBoundMessagePacket
-                    from rymc.phira.protocol.data.message import ChatMessage
-                    ru.connection.send(ClientBoundMessagePacket(ChatMessage(-1, f"[广播] {content}")))
-                    sent += 1
-                except Exception as e:
-                    c.println(f"发送给 {uid} 失败: {e}")
+            sent = broadcast([ru.connection for ru in room.users.values()], packet)
         else:
             # 全服
-            for uid, conn in state.online_user_list.items():
-                try:
-                    from rymc.phira.protocol.packet.clientbound import ClientBoundMessagePacket
-                    from rymc.phira.protocol.data.message import ChatMessage
-                    conn.send(ClientBoundMessagePacket(ChatMessage(-1, f"[广播] {content}")))
-                    sent += 1
-                except Exception as e:
-                    c.println(f"发送给 {uid} 失败: {e}")
+            sent = broadcast(list(state.online_user_list.values()), packet)
         c.println(f"广播已发送给 {sent} 位玩家")
 
     def cmd_kick(c: CommandContext, args: List[str]):
@@ -158,12 +200,10 @@ def on_commands_init(registry=None, ctx=None, **_):
         # 使用 try_parse_id 统一处理
         uid = try_parse_id(args[0])
 
-        conn = state.online_user_list.get(uid)
-        if not conn:
-            c.println(f"用户 {uid} 不在线 (类型: {type(uid).__name__})")
-            return
         try:
-            conn.close()
+            if not state.kick(uid):
+                c.println(f"用户 {uid} 不在线 (类型: {type(uid).__name__})")
+                return
             c.println(f"已踢出用户 {uid}")
         except Exception as e:
             c.println(f"踢出失败: {e}")
@@ -180,13 +220,15 @@ def on_commands_init(registry=None, ctx=None, **_):
         if not room:
             c.println(f"房间 {rid} 不存在")
             return
-        from rymc.phira.protocol.data.state import WaitForReady, Playing, SelectChart
+        from rymc.phira.protocol.data.state import Playing
         from rymc.phira.protocol.packet.clientbound import ClientBoundChangeStatePacket, ClientBoundMessagePacket
         from rymc.phira.protocol.data.message import StartPlayingMessage
-        # 直接切换到 Playing 状态
-        room.ready.clear()
-        set_state = lambda r, s: setattr(r, "state", s)
-        set_state(room, Playing())
+        from utils import room_engine
+        # 与自动开始一样经由房间状态机（只能从等待准备阶段开始，并触发 room.transition 钩子），不等待未准备的玩家
+        result = room_engine.apply(rid, "start_playing")
+        if result["status"] != "0":
+            c.println(f"无法强制开始房间 {rid}: {result.get('message') or result.get('reason')}")
+            return
         for uid, ru in room.users.items():
             try:
                 ru.connection.send(ClientBoundMessagePacket(StartPlayingMessage()))
@@ -208,27 +250,49 @@ def on_commands_init(registry=None, ctx=None, **_):
             c.println(f"房间 {rid} 不存在")
             return
         room.locked = not room.locked
+        state.rooms.touch(rid)
         status = "锁定" if room.locked else "解锁"
         c.println(f"房间 {rid} 已{status}")
 
     def cmd_maxp(c: CommandContext, args: List[str]):
-        """修改房间最大人数限制（软限制）"""
+        """修改人数上限：单个房间、房间默认值（default）或全服在线人数（server）"""
+        from utils.room import set_default_max_users, set_max_users
+        limits = state.limits
+        if not args:
+            c.println(f"房间默认上限: {limits.room_default or '无限制'}，全服在线上限: {limits.online or '无限制'} "
+                      f"(当前在线 {len(state.online_user_list)})")
+            return
         if len(args) < 2:
-            c.println("用法: /maxp {房间ID} {人数}")
+            c.println("用法: /maxp {房间ID|default|server} {人数|off}")
             return
-        
-        rid = try_parse_id(args[0])
-        
-        try:
-            max_players = int(args[1])
-        except ValueError:
-            c.println("人数必须是整数")
+
+        if args[1].lower() == "off":
+            max_players = None
+        else:
+            try:
+                max_players = int(args[1])
+            except ValueError:
+                c.println("人数必须是整数或 off")
+                return
+            if max_players < 1:
+                c.println("人数必须大于 0")
+                return
+        shown = max_players if max_players is not None else "无限制"
+
+        target = args[0].lower()
+        if target == "default":
+            set_default_max_users(max_players)
+            c.println(f"房间默认最大人数已设置为 {shown}")
+            return
+        if target == "server":
+            limits.online = max_players
+            c.println(f"全服在线人数上限已设置为 {shown}")
             return
-        if rid not in state.rooms:
+        rid = try_parse_id(args[0])
+        if set_max_users(rid, max_players)["status"] == "1":
             c.println(f"房间 {rid} 不存在")
             return
-        state.room_limits[rid] = max_players
-        c.println(f"房间 {rid} 最大人数已设置为 {max_players}")
+        c.println(f"房间 {rid} 最大人数已设置为 {shown}")
 
     def cmd_close(c: CommandContext, args: List[str]):
         """强制关闭指定房间"""
@@ -269,6 +333,7 @@ def on_commands_init(registry=None, ctx=None, **_):
             c.println(f"房间 {rid} 不存在")
             return
         room.cycle = not room.cycle
+        state.rooms.touch(rid)
         status = "循环" if room.cycle else "普通"
         c.println(f"房间 {rid} 已切换为{status}模式")
 
@@ -323,6 +388,7 @@ def on_commands_init(registry=None, ctx=None, **_):
             for rid, room in rooms.items():
                 if not room.locked:
                     room.locked = True
+                    rooms.touch(rid)
                     count += 1
             c.println(f"已锁定 {count} 个房间")
         elif action == "unlock_all":
@@ -330,6 +396,7 @@ def on_commands_init(registry=None, ctx=None, **_):
             for rid, room in rooms.items():
                 if room.locked:
                     room.locked = False
+                    rooms.touch(rid)
                     count += 1
             c.println(f"已解锁 {count} 个房间")
         else:
@@ -377,13 +444,11 @@ def on_commands_init(registry=None, ctx=None, **_):
             # 同样使用 try_parse_id 以匹配在线列表的 Key 类型
             target_uid = try_parse_id(target)
             
-            conn = state.online_user_list.get(target_uid)
-            if conn:
-                try:
-                    conn.close()
+            try:
+                if state.kick(target_uid):
                     c.println(f"检测到玩家在线，已强制踢出: {target}")
-                except Exception:
-                    pass
+            except Exception:
+                pass
         elif btype == "ip":
             # 遍历在线玩家检查 IP (这需要遍历 verify logic，比较复杂，暂时只处理 ID 踢出)
             c.println(f"IP封禁已记录，但暂不支持在线踢出IP玩家。")
@@ -480,12 +545,61 @@ def on_commands_init(registry=None, ctx=None, **_):
         """重新加载 env 配置"""
         # 重新加载 security.json
         state.security.load()
+        # 重新加载聊天屏蔽词表
+        from utils.chat import word_filter
+        word_filter.load()
         # 触发插件重载
         pm = c.plugin_manager
         if pm:
             pm.load_all()
         c.println("配置已重新加载")
 
+    def cmd_plugins(c: CommandContext, args: List[str]):
+        """插件加载耗时；/plugins load {名称} 立即加载懒加载插件；/plugins stats 回调耗时"""
+        if args and args[0].lower() == "stats":
+            what = args[1].lower() if len(args) > 1 else ""
+            if what in ("on", "off"):
+                callbacks.set_enabled(what == "on")
+                c.println(f"插件回调计时已{'开启' if callbacks.enabled else '关闭'}")
+            elif what == "reset":
+                callbacks.reset()
+                c.println("已清空插件回调计时")
+            elif what in ("", "owner", "event", "both"):
+                c.println(callbacks.format_table(what or "owner"))
+            else:
+                c.println("用法: /plugins stats [on|off|reset|owner|event|both]")
+            return
+        pm = c.plugin_manager
+        if pm is None:
+            c.println("插件管理器未启用")
+            return
+        if args and args[0].lower() == "load":
+            if len(args) < 2:
+                c.println("用法: /plugins load {插件名}")
+            elif pm.load_deferred(args[1]):
+                c.println(f"插件 {args[1]} 已加载")
+            else:
+                c.println(f"插件 {args[1]} 不存在或加载失败")
+            return
+        lines = [f"{'插件':<20}{'状态':<10}{'import ms':>10}{'setup ms':>10}"]
+        for row in pm.report():
+            if row["state"] == "lazy":
+                triggers = ", ".join([*row["events"], *(f"/{name}" for name in row["commands"])])
+                lines.append(f"{row['name']:<20}{'lazy':<10}  首次使用时加载: {triggers}")
+            else:
+                timing = "".join(f"{row[k]:>10.1f}" if row[k] is not None else f"{'-':>10}"
+                                 for k in ("import_ms", "setup_ms"))
+                lines.append(f"{row['name']:<20}{row['how']:<10}{timing}")
+            sandbox = row.get("sandbox")
+            if sandbox:
+                status = "运行中" if sandbox["running"] else "重启中"
+                if sandbox["throttled"]:
+                    status += "，超出 CPU 预算"
+                lines.append(f"{'':<20}pid {sandbox['pid']} {status}  CPU {sandbox['cpu_share'] * 100:.0f}%"
+                             f"/{sandbox['cpu_budget'] * 100:.0f}%  转发 {sandbox['forwarded']}"
+                             f"  丢弃 {sandbox['dropped']}  重启 {sandbox['restarts']}")
+        c.println("\n".join(lines))
+
     def cmd_set(c: CommandContext, args: List[str]):
         """设置 env 变量的值"""
         if len(args) < 2:
@@ -496,10 +610,75 @@ def on_commands_init(registry=None, ctx=None, **_):
         os.environ[key] = val
         c.println(f"已设置 {key}={val} (仅当前进程有效)")
 
+    def cmd_perf(c: CommandContext, args: List[str]):
+        """收发管线耗时与流量统计"""
+        what = args[0].lower() if args else ""
+        if what == "reset":
+            metrics.reset()
+            c.println("已清空耗时统计")
+        elif what == "rooms":
+            rows = top_traffic(((rid, room.traffic) for rid, room in state.rooms.items()), limit=20)
+            c.println("\n".join(_format_traffic("房间", rows)))
+        elif what == "conns":
+            rows = top_traffic(((uid, getattr(conn, "traffic", None)) for uid, conn in state.online_user_list.items()),
+                               limit=20)
+            c.println("\n".join(_format_traffic("玩家", rows)))
+        elif what in ("sample", "sampling") and len(args) > 1 and args[1].isdigit():
+            metrics.sample_every = int(args[1])
+            c.println(f"计时采样间隔已设置为 {metrics.sample_every}")
+        elif not what:
+            c.println(metrics.format_table())
+        else:
+            c.println("用法: /perf [rooms|conns|reset|sample N]")
+
+    def _format_traffic(label: str, rows) -> List[str]:
+        lines = [f"{label:<12}{'pkts in':>10}{'pkts out':>10}{'KiB in':>10}{'KiB out':>10}"]
+        for row in rows:
+            lines.append(f"{str(row['id']):<12}{row['packets_in']:>10}{row['packets_out']:>10}"
+                         f"{row['bytes_in'] / 1024:>10.1f}{row['bytes_out'] / 1024:>10.1f}")
+        return lines
+
+    def cmd_log_trace(c: CommandContext, args: List[str]):
+        """数据包采样追踪: /log trace on [N]|off|user {uID}|type {类型,...}|clear"""
+        if not args:
+            c.println(f"数据包追踪: {tracer.describe()}")
+            return
+        action = args[0].lower()
+        if action == "on":
+            if len(args) > 1 and not args[1].isdigit():
+                c.println("采样间隔必须是正整数")
+                return
+            tracer.enable(sample=int(args[1]) if len(args) > 1 else None)
+        elif action == "off":
+            tracer.disable()
+        elif action == "clear":
+            tracer.clear()
+        elif action == "user" and len(args) > 1:
+            uid = try_parse_id(args[1])
+            conn = state.online_user_list.get(uid)
+            if conn is None:
+                c.println(f"用户 {uid} 不在线")
+                return
+            tracer.watch(conn)
+            tracer.enable()
+        elif action == "type" and len(args) > 1:
+            unknown = tracer.set_types(",".join(args[1:]).replace(",", " ").split())
+            if unknown:
+                c.println(f"未知数据包类型: {', '.join(unknown)}")
+            tracer.enable()
+        else:
+            c.println("用法: /log trace on [N]|off|user {uID}|type {类型,...}|clear")
+            return
+        c.println(f"数据包追踪: {tracer.describe()}")
+
     def cmd_log(c: CommandContext, args: List[str]):
         """调整日志等级"""
         if len(args) < 1:
             c.println("用法: /log debug|info|mark|warn|error")
+            c.println("      /log trace on [N]|off|user {uID}|type {类型,...}|clear")
+            return
+        if args[0].lower() == "trace":
+            cmd_log_trace(c, args[1:])
             return
         levels = args[0].split("|")
         valid = {"debug", "info", "mark", "warn", "error"}
@@ -524,7 +703,7 @@ def on_commands_init(registry=None, ctx=None, **_):
     # ========== 注册所有命令 ==========
 
     commands = [
-        Command(name="room", usage="/room", help="获取服务器房间列表 (文本详情)", handler=cmd_room, owner=owner),
+        Command(name="room", usage="/room [state=..] [chart=..] [locked=..] [players=a-b] [free] [after=..]", help="获取服务器房间列表 (可筛选、分页)", handler=cmd_room, owner=owner),
         Command(name="status", usage="/status", help="Phira 服务器协议握手检测", handler=cmd_status, owner=owner),
         Command(name="ping", usage="/ping", help="查看服务器响应", handler=cmd_ping, owner=owner),
         Command(name="list", usage="/list", help="查看当前所有在线玩家列表", handler=cmd_list, owner=owner),
@@ -532,7 +711,7 @@ def on_commands_init(registry=None, ctx=None, **_):
         Command(name="kick", usage="/kick {uID}", help="强制移除指定用户", handler=cmd_kick, owner=owner),
         Command(name="fstart", usage="/fstart {RID}", help="强制开始指定房间对局", handler=cmd_fstart, owner=owner),
         Command(name="lock", usage="/lock {RID}", help="锁定/解锁房间", handler=cmd_lock, owner=owner),
-        Command(name="maxp", usage="/maxp {RID} {人数}", help="修改房间最大人数限制", handler=cmd_maxp, owner=owner),
+        Command(name="maxp", usage="/maxp {RID|default|server} {人数|off}", help="修改房间/默认/全服人数上限", handler=cmd_maxp, owner=owner),
         Command(name="close", usage="/close {RID}", help="强制关闭指定房间", handler=cmd_close, owner=owner),
         Command(name="tmode", usage="/tmode {RID}", help="切换房间模式 (循环/普通)", handler=cmd_tmode, owner=owner),
         Command(name="smsg", usage="/smsg {RID} {内容}", help="发送房间系统消息", handler=cmd_smsg, owner=owner),
@@ -549,8 +728,10 @@ def on_commands_init(registry=None, ctx=None, **_):
         Command(name="op", usage="/op {phira_id}", help="将此 ID 设置为管理员", handler=cmd_op, owner=owner),
         Command(name="deop", usage="/deop {phira_id}", help="将此 ID 移除管理员", handler=cmd_deop, owner=owner),
         Command(name="info", usage="/info", help="展示服务器状态以及各种信息", handler=cmd_info, owner=owner),
+        Command(name="plugins", usage="/plugins [load {插件名}] | /plugins stats [on|off|reset|owner|event|both]", help="查看插件加载耗时 / 立即加载懒加载插件 / 按插件与事件统计回调耗时", handler=cmd_plugins, owner=owner),
         Command(name="set", usage="/set \"{环境变量}\" \"{值}\"", help="设置 env 变量的值", handler=cmd_set, owner=owner),
-        Command(name="log", usage="/log debug|info|mark|warn|error", help="调整日志等级 (可多选，例如：/log warn|error)", handler=cmd_log, owner=owner),
+        Command(name="perf", usage="/perf [rooms|conns|reset|sample N]", help="查看各类数据包的解码/处理/编码/排队/发送耗时与流量统计", handler=cmd_perf, owner=owner),
+        Command(name="log", usage="/log debug|info|mark|warn|error | /log trace ...", help="调整日志等级 (可多选，例如：/log warn|error)；/log trace 开关数据包采样追踪", handler=cmd_log, owner=owner),
     ]
 
     for cmd in commands:
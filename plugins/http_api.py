@@ -5,20 +5,31 @@ HTTP API Plugin for pyphira-mp
 """
 
 import asyncio
+import json
 import logging
 import os
 import secrets
 import sys
+import threading
 import time
 import uuid
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-
-from utils.room import destroy_room, rooms
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+from utils import room_engine
+from utils.chat import limiter as chat_limiter, word_filter
+from utils.connection import broadcast
+from utils.loopmonitor import monitor as loop_monitor
+from utils.metrics import Exposition, caches, callbacks, metrics, top_traffic, totals
+from utils.phiraapi import PhiraFetcher
+from utils.loopbridge import LoopBridge
+from utils.room import (destroy_room, has_space, limits, room_capacity, rooms, set_default_max_users,
+                        set_max_users, state_type)
+from utils.roomfeed import RoomFeed, RoomSnapshots
 
 main_module = sys.modules["__main__"]
 
@@ -49,7 +60,6 @@ app.add_middleware(
 )
 
 room_creation_enabled = True
-room_limits_ref = {}
 
 otp_sessions: Dict[str, Dict[str, Any]] = {}
 temp_tokens: Dict[str, Dict[str, Any]] = {}
@@ -76,6 +86,15 @@ def parse_room_id(room_id: str):
         return None
 
 
+# 游戏循环的命令队列：读写房间/玩家/封禁等实时状态的代码都经它回到游戏循环执行
+bridge: Optional[LoopBridge] = None
+
+
+async def on_game(fn, *args):
+    """在游戏循环上执行 fn(*args) 并返回结果（HTTP 服务与游戏同一循环时直接调用）"""
+    return await bridge.run(fn, *args)
+
+
 async def read_json_body(request: Request) -> Dict[str, Any]:
     try:
         body = await request.json()
@@ -176,86 +195,326 @@ async def otp_verify(request: Request):
     }
 
 
+# /room 的缓存：(快照序号, 序列化好的 JSON, ETag)；只有快照变化时才重新生成
+_room_cache = (None, b"", "")
+# ETag 带上进程标识，避免重启后序号从头计数时与旧的 ETag 撞上
+_etag_prefix = uuid.uuid4().hex[:8]
+
+
+ROOM_QUERY_PARAMS = ("state", "chart", "locked", "live", "min_players", "max_players", "free", "cursor", "limit")
+
+
+def parse_flag(raw: str):
+    raw = raw.strip().lower()
+    if raw in ("1", "true", "yes"):
+        return True
+    if raw in ("0", "false", "no"):
+        return False
+    return None
+
+
 @app.get("/room")
-async def get_public_rooms():
-    res = []
-    for rid, room in rooms.items():
-        host_info = {"id": room.host, "name": str(room.host)}
-        players = []
-        for uid, ruser in room.users.items():
-            name = getattr(ruser.info, "name", str(uid))
-            players.append({"id": uid, "name": name})
-            if uid == room.host:
-                host_info["name"] = name
-
-        res.append(
-            {
-                "roomid": str(rid),
-                "cycle": getattr(room, "cycle", False),
-                "lock": getattr(room, "locked", False),
-                "host": host_info,
-                "state": type(room.state).__name__.lower(),
-                "chart": {
-                    "id": getattr(room, "chart", None),
-                    "name": str(getattr(room, "chart", "Unknown")),
-                },
-                "players": players,
-            }
-        )
-    return {"rooms": res, "total": len(res)}
+async def get_public_rooms(request: Request):
+    global _room_cache
+    if any(name in request.query_params for name in ROOM_QUERY_PARAMS):
+        return await query_public_rooms(request)
+    seq, body, etag = _room_cache
+    snapshot = room_snapshots.current
+    if seq != snapshot.seq:
+        seq = snapshot.seq
+        res = list(snapshot.views.values())
+        body = json.dumps({"rooms": res, "total": len(res)}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = f'"{_etag_prefix}-{seq}"'
+        _room_cache = (seq, body, etag)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def query_public_rooms(request: Request):
+    """带筛选/分页的 /room：走房间表的二级索引，只生成当前页的房间信息"""
+    params = request.query_params
+    query: Dict[str, Any] = {}
+    try:
+        if "state" in params:
+            query["state"] = state_type(params["state"])
+            if query["state"] is None:
+                return JSONResponse({"ok": False, "error": "bad-state"}, status_code=400)
+        if "chart" in params:
+            query["chart"] = int(params["chart"])
+        for name in ("locked", "live"):
+            if name in params:
+                query[name] = parse_flag(params[name])
+                if query[name] is None:
+                    return JSONResponse({"ok": False, "error": f"bad-{name}"}, status_code=400)
+        for name in ("min_players", "max_players"):
+            if name in params:
+                query[name] = int(params[name])
+        limit = min(max(int(params.get("limit", 50)), 1), 200)
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "bad-query"}, status_code=400)
+    if parse_flag(params.get("free", "0")):
+        # 还有空位：没有人数上限，或人数未达上限
+        query["where"] = lambda rid, room: has_space(room)
+    after = params.get("cursor") or None
+
+    def run():
+        page, cursor, total = rooms.query(after=after, limit=limit, **query)
+        return [room_view(room) for _, room in page], cursor, total
+
+    res, cursor, total = await on_game(run)
+    return {"rooms": res, "total": total, "next": cursor}
+
+
+def room_view(room):
+    """/room 与 /room/feed 中一个房间的公开信息"""
+    host_info = {"id": room.host, "name": str(room.host)}
+    players = []
+    for uid, ruser in room.users.items():
+        name = getattr(ruser.info, "name", str(uid))
+        players.append({"id": uid, "name": name})
+        if uid == room.host:
+            host_info["name"] = name
+    return {
+        "roomid": str(room.id),
+        "cycle": getattr(room, "cycle", False),
+        "lock": getattr(room, "locked", False),
+        "host": host_info,
+        "state": type(room.state).__name__.lower(),
+        "chart": {
+            "id": getattr(room, "chart", None),
+            "name": str(getattr(room, "chart", "Unknown")),
+        },
+        "players": players,
+        "max_users": room_capacity(room),
+    }
+
+
+# 房间列表快照由游戏循环每个 tick 增量更新；HTTP 侧（无论是否在独立线程）只读快照
+room_snapshots = RoomSnapshots(room_view)
+room_feed: Optional[RoomFeed] = None
+FEED_KEEPALIVE = 15.0
+
+
+@app.get("/room/feed")
+async def room_feed_stream(request: Request):
+    """Server-sent events：先发一次 snapshot，之后每个 tick 合并发送 delta（见 utils/roomfeed.py）"""
+    sub = room_feed.subscribe()
+
+    async def stream():
+        try:
+            yield room_feed.snapshot()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(sub.queue.get(), FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if chunk is None:
+                    yield b"event: dropped\ndata: {}\n\n"
+                    return
+                yield chunk
+        finally:
+            room_feed.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/admin/rooms")
 async def admin_get_rooms():
-    res = []
-    for rid, room in rooms.items():
-        users_list = []
-        for uid, ruser in room.users.items():
-            users_list.append(
+    def collect():
+        res = []
+        for rid, room in rooms.items():
+            users_list = []
+            for uid, ruser in room.users.items():
+                users_list.append(
+                    {
+                        "id": uid,
+                        "name": getattr(ruser.info, "name", str(uid)),
+                        "connected": ruser.connection is not None,
+                        "is_host": uid == room.host,
+                        "finished": uid in getattr(room, "finished", {}),
+                        "ready": uid in getattr(room, "ready", {}),
+                    }
+                )
+
+            res.append(
                 {
-                    "id": uid,
-                    "name": getattr(ruser.info, "name", str(uid)),
-                    "connected": ruser.connection is not None,
-                    "is_host": uid == room.host,
-                    "finished": uid in getattr(room, "finished", {}),
-                    "ready": uid in getattr(room, "ready", {}),
+                    "roomid": str(rid),
+                    "max_users": room_capacity(room) or "无限制",
+                    "live": getattr(room, "live", False),
+                    "locked": getattr(room, "locked", False),
+                    "cycle": getattr(room, "cycle", False),
+                    "host": {"id": room.host},
+                    "state": {"type": type(room.state).__name__.lower()},
+                    "chart": {"id": getattr(room, "chart", None)},
+                    "users": users_list,
+                    "contest": getattr(room, "contest_mode", False),
+                    "whitelist": list(getattr(room, "whitelist", [])),
                 }
             )
+        return res
 
-        res.append(
-            {
-                "roomid": str(rid),
-                "max_users": room_limits_ref.get(rid, "无限制"),
-                "live": getattr(room, "live", False),
-                "locked": getattr(room, "locked", False),
-                "cycle": getattr(room, "cycle", False),
-                "host": {"id": room.host},
-                "state": {"type": type(room.state).__name__.lower()},
-                "chart": {"id": getattr(room, "chart", None)},
-                "users": users_list,
-                "contest": getattr(room, "contest_mode", False),
-                "whitelist": getattr(room, "whitelist", []),
-            }
-        )
-    return {"ok": True, "rooms": res}
+    return {"ok": True, "rooms": await on_game(collect)}
+
+
+@app.get("/admin/loop")
+async def admin_loop():
+    """事件循环调度延迟与最近的卡顿（含卡顿时主线程的调用栈）"""
+    return dict(loop_monitor.report(), ok=True)
+
+
+@app.get("/admin/perf")
+async def admin_perf(limit: int = 20):
+    """收发管线各阶段耗时直方图（按包类型）与按房间/玩家的流量计数"""
+    def collect():
+        online = getattr(main_module, "online_user_list", {})
+        return {
+            "ok": True,
+            "sample_every": metrics.sample_every,
+            "stages": metrics.report(),
+            "rooms": top_traffic(((rid, room.traffic) for rid, room in rooms.items()), limit=limit),
+            "users": top_traffic(((uid, getattr(conn, "traffic", None)) for uid, conn in online.items()), limit=limit),
+        }
+
+    return await on_game(collect)
+
+
+@app.get("/admin/plugins/stats")
+async def admin_plugin_stats(by: str = "owner", limit: int = 50):
+    """插件回调耗时；by = owner（按插件）/ event（按事件与指令）/ both"""
+    if by not in ("owner", "event", "both"):
+        return JSONResponse({"ok": False, "error": "bad-by"}, status_code=400)
+    return await on_game(lambda: {"ok": True, "enabled": callbacks.enabled, "window_s": callbacks.window,
+                                  "rows": callbacks.report(by)[:limit]})
+
+
+@app.post("/admin/plugins/stats")
+async def admin_set_plugin_stats(request: Request):
+    """{"enabled": bool, "reset": bool}，只处理出现的字段"""
+    data = await read_json_body(request)
+    if "enabled" in data and not isinstance(data["enabled"], bool):
+        return JSONResponse({"ok": False, "error": "bad-enabled"}, status_code=400)
+
+    def apply():
+        if "enabled" in data:
+            callbacks.set_enabled(data["enabled"])
+        if data.get("reset"):
+            callbacks.reset()
+        return {"ok": True, "enabled": callbacks.enabled}
+
+    return await on_game(apply)
+
+
+def collect_metrics() -> Exposition:
+    """在游戏循环上读取各计数并生成指标行（线程模式下 HTTP 线程只负责拼接文本）"""
+    out = Exposition()
+    out.gauge("pyphira_online_users", "Authenticated players online", len(getattr(main_module, "online_user_list", {})))
+    out.gauge("pyphira_connections", "Open client connections", totals.connections)
+    for kind, count in rooms.by_state.items():
+        out.gauge("pyphira_rooms", "Rooms by state", count, {"state": kind.__name__.lower()})
+    out.gauge("pyphira_send_queue_packets", "Encoded packets waiting in connection write queues", totals.queued)
+    for direction in ("in", "out"):
+        out.counter("pyphira_packets_total", "Packets received/sent", getattr(totals, f"packets_{direction}"),
+                    {"direction": direction})
+    for direction in ("in", "out"):
+        out.counter("pyphira_bytes_total", "Packet payload bytes received/sent", getattr(totals, f"bytes_{direction}"),
+                    {"direction": direction})
+
+    for endpoint, histogram in sorted(PhiraFetcher.latency.items()):
+        out.summary("pyphira_phira_api_seconds", "Phira API request time including retries", histogram,
+                    {"endpoint": endpoint})
+    for endpoint, count in sorted(PhiraFetcher.failures.items()):
+        out.counter("pyphira_phira_api_failures_total", "Phira API requests that failed after retries", count,
+                    {"endpoint": endpoint})
+    for name, stats in sorted(caches.items()):
+        out.counter("pyphira_cache_hits_total", "Cache hits", stats.hits, {"cache": name})
+    for name, stats in sorted(caches.items()):
+        out.counter("pyphira_cache_misses_total", "Cache misses", stats.misses, {"cache": name})
+    for name, stats in sorted(caches.items()):
+        out.gauge("pyphira_cache_hit_ratio", "Cache hits / lookups since start", round(stats.ratio(), 4), {"cache": name})
+    auth_cache = getattr(main_module, "auth_cache", None)
+    if auth_cache is not None:
+        out.gauge("pyphira_auth_cache_entries", "Tokens in the auth cache", len(auth_cache))
+
+    store = getattr(main_module, "security_store", None)
+    if store is not None:
+        for kind, count in sorted(store.lookups.items()):
+            out.counter("pyphira_ban_lookups_total", "Ban/blacklist store lookups", count, {"kind": kind})
+        for kind, count in sorted(store.matches.items()):
+            out.counter("pyphira_ban_matches_total", "Ban/blacklist store lookups that matched", count, {"kind": kind})
+
+    out.summary("pyphira_event_loop_lag_seconds", "Event loop scheduling lag", loop_monitor.lag)
+    out.counter("pyphira_event_loop_stalls_total", "Times the event loop was blocked past the threshold",
+                loop_monitor.stall_count)
+    out.counter("pyphira_chat_rate_limited_total", "Chat messages refused by the per-user rate limit",
+                chat_limiter.limited)
+    out.counter("pyphira_chat_filtered_total", "Chat messages that matched the word filter", word_filter.filtered)
+    if callbacks.enabled:
+        cpu_by_owner: Dict[str, int] = {}
+        for (_kind, owner, _name), entry in list(callbacks.entries.items()):
+            cpu_by_owner[owner] = cpu_by_owner.get(owner, 0) + entry.cpu_ns
+        for owner, ns in sorted(cpu_by_owner.items()):
+            out.counter("pyphira_plugin_callback_cpu_seconds_total", "CPU time spent in event/command handlers",
+                        ns / 1e9, {"owner": owner})
+    return out
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 文本格式指标；全部取自核心里增量维护的计数，不遍历房间与连接"""
+    out = await on_game(collect_metrics)
+    return PlainTextResponse(out.text(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/admin/rooms/{room_id}/max_users")
 async def admin_set_max_users(room_id: str, request: Request):
     data = await read_json_body(request)
     max_users = data.get("maxUsers")
-    if not isinstance(max_users, int) or not (1 <= max_users <= 64):
+    # null：取消单独设置，使用服务器默认上限
+    if max_users is not None and (not isinstance(max_users, int) or not (1 <= max_users <= 64)):
         return JSONResponse({"ok": False, "error": "bad-max-users"}, status_code=400)
 
     rid = parse_room_id(room_id)
     if rid is None:
         return JSONResponse({"ok": False, "error": "bad-room-id"}, status_code=400)
 
-    if rid not in rooms:
-        return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
+    def apply():
+        if set_max_users(rid, max_users)["status"] == "1":
+            return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
+        return {"ok": True, "roomid": str(rid), "max_users": room_capacity(rooms[rid])}
+
+    return await on_game(apply)
+
+
+@app.get("/admin/limits")
+async def admin_get_limits():
+    return await on_game(lambda: {"ok": True, "room_default": limits.room_default, "online": limits.online,
+                                  "online_now": len(getattr(main_module, "online_user_list", {}))})
+
+
+@app.post("/admin/limits")
+async def admin_set_limits(request: Request):
+    """{"roomDefault": n|null, "online": n|null}，只修改出现的字段；null 表示不限"""
+    data = await read_json_body(request)
+    for key in ("roomDefault", "online"):
+        value = data.get(key)
+        if value is not None and (not isinstance(value, int) or value < 1):
+            return JSONResponse({"ok": False, "error": f"bad-{key}"}, status_code=400)
+
+    def apply():
+        if "roomDefault" in data:
+            set_default_max_users(data["roomDefault"])
+        if "online" in data:
+            limits.online = data["online"]
+        return {"ok": True, "room_default": limits.room_default, "online": limits.online}
 
-    room_limits_ref[rid] = max_users
-    return {"ok": True, "roomid": str(rid), "max_users": max_users}
+    return await on_game(apply)
 
 
 @app.post("/admin/rooms/{room_id}/disband")
@@ -264,25 +523,28 @@ async def admin_disband_room(room_id: str):
     if rid is None:
         return JSONResponse({"ok": False, "error": "bad-room-id"}, status_code=400)
 
-    room = rooms.get(rid)
-    if not room:
-        return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
-
     from rymc.phira.protocol.data.message import LeaveRoomMessage
     from rymc.phira.protocol.packet.clientbound import (
         ClientBoundLeaveRoomPacket,
         ClientBoundMessagePacket,
     )
 
-    for _, ruser in list(room.users.items()):
-        try:
-            ruser.connection.send(ClientBoundMessagePacket(LeaveRoomMessage(-1, "房间已被管理员强制解散")))
-            ruser.connection.send(ClientBoundLeaveRoomPacket.Success())
-        except Exception:
-            pass
+    def apply():
+        room = rooms.get(rid)
+        if not room:
+            return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
 
-    destroy_room(rid)
-    return {"ok": True, "roomid": str(rid)}
+        for _, ruser in list(room.users.items()):
+            try:
+                ruser.connection.send(ClientBoundMessagePacket(LeaveRoomMessage(-1, "房间已被管理员强制解散")))
+                ruser.connection.send(ClientBoundLeaveRoomPacket.Success())
+            except Exception:
+                pass
+
+        destroy_room(rid)
+        return {"ok": True, "roomid": str(rid)}
+
+    return await on_game(apply)
 
 
 @app.get("/admin/room-creation/config")
@@ -311,19 +573,19 @@ async def admin_ban_user(request: Request):
     if not uid:
         return JSONResponse({"ok": False, "error": "bad-user-id"}, status_code=400)
 
-    if banned:
-        main_module.security_store.add_ban("id", str(uid), None, "API 封禁")
-    else:
-        main_module.security_store.remove_ban("id", str(uid))
+    def apply():
+        if banned:
+            main_module.security_store.add_ban("id", str(uid), None, "API 封禁")
+        else:
+            main_module.security_store.remove_ban("id", str(uid))
 
-    if disconnect and banned:
-        conn = main_module.online_user_list.get(uid) or main_module.online_user_list.get(str(uid))
-        if conn:
+        if disconnect and banned:
             try:
-                conn.close()
+                main_module.kick(uid) or main_module.kick(str(uid))
             except Exception:
                 pass
 
+    await on_game(apply)
     return {"ok": True}
 
 
@@ -333,15 +595,15 @@ async def admin_kick_user(user_id: str):
     if uid is None:
         return JSONResponse({"ok": False, "error": "bad-user-id"}, status_code=400)
 
-    conn = main_module.online_user_list.get(uid)
-    if not conn:
-        return JSONResponse({"ok": False, "error": "user-not-connected"}, status_code=404)
+    def apply():
+        try:
+            if not main_module.kick(uid):
+                return JSONResponse({"ok": False, "error": "user-not-connected"}, status_code=404)
+        except Exception:
+            pass
+        return {"ok": True}
 
-    try:
-        conn.close()
-    except Exception:
-        pass
-    return {"ok": True}
+    return await on_game(apply)
 
 
 @app.post("/admin/broadcast")
@@ -357,14 +619,12 @@ async def admin_broadcast(request: Request):
     from rymc.phira.protocol.packet.clientbound import ClientBoundMessagePacket
 
     packet = ClientBoundMessagePacket(ChatMessage(0, f"[管理员通知] {msg}"))
-    rooms_count = len(rooms)
 
-    for _, conn in main_module.online_user_list.items():
-        try:
-            conn.send(packet)
-        except Exception:
-            pass
+    def apply():
+        broadcast(list(main_module.online_user_list.values()), packet)
+        return len(rooms)
 
+    rooms_count = await on_game(apply)
     return {"ok": True, "rooms": rooms_count}
 
 
@@ -381,27 +641,25 @@ async def admin_room_chat(room_id: str, request: Request):
     if rid is None:
         return JSONResponse({"ok": False, "error": "bad-room-id"}, status_code=400)
 
-    room = rooms.get(rid)
-    if not room:
-        return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
-
     from rymc.phira.protocol.data.message import ChatMessage
     from rymc.phira.protocol.packet.clientbound import ClientBoundMessagePacket
 
     packet = ClientBoundMessagePacket(ChatMessage(0, f"[系统] {msg}"))
 
-    for _, ruser in room.users.items():
-        try:
-            ruser.connection.send(packet)
-        except Exception:
-            pass
+    def apply():
+        room = rooms.get(rid)
+        if not room:
+            return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
 
-    return {"ok": True}
+        broadcast([ruser.connection for ruser in room.users.values()], packet)
+        return {"ok": True}
+
+    return await on_game(apply)
 
 
 @app.get("/admin/ip-blacklist")
 async def admin_get_blacklist():
-    bl = main_module.security_store.list_blacklist_ips()
+    bl = await on_game(main_module.security_store.list_blacklist_ips)
     res = [
         {"ip": ip, "expiresIn": int((exp - time.time()) * 1000) if exp else None}
         for ip, exp in bl.items()
@@ -414,14 +672,17 @@ async def admin_remove_blacklist(request: Request):
     data = await read_json_body(request)
     ip = data.get("ip")
     if ip:
-        main_module.security_store.remove_blacklist_ip(ip)
+        await on_game(main_module.security_store.remove_blacklist_ip, ip)
     return {"ok": True}
 
 
 @app.post("/admin/ip-blacklist/clear")
 async def admin_clear_blacklist():
-    main_module.security_store.blacklist_ips.clear()
-    main_module.security_store.save()
+    def apply():
+        main_module.security_store.blacklist_ips.clear()
+        main_module.security_store.save()
+
+    await on_game(apply)
     return {"ok": True}
 
 
@@ -432,21 +693,23 @@ async def admin_contest_config(room_id: str, request: Request):
     if rid is None:
         return JSONResponse({"ok": False, "error": "bad-room-id"}, status_code=400)
 
-    room = rooms.get(rid)
-    if not room:
-        return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
+    def apply():
+        room = rooms.get(rid)
+        if not room:
+            return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
 
-    enabled = data.get("enabled", False)
-    room.contest_mode = enabled
-    if enabled:
-        whitelist = data.get("whitelist")
-        if not whitelist:
-            whitelist = list(room.users.keys())
-        room.whitelist = whitelist
-    else:
-        room.whitelist = []
+        enabled = data.get("enabled", False)
+        room.contest_mode = enabled
+        if enabled:
+            whitelist = data.get("whitelist")
+            if not whitelist:
+                whitelist = list(room.users.keys())
+            room.whitelist = whitelist
+        else:
+            room.whitelist = []
+        return {"ok": True}
 
-    return {"ok": True}
+    return await on_game(apply)
 
 
 @app.post("/admin/contest/rooms/{room_id}/start")
@@ -456,17 +719,6 @@ async def admin_contest_start(room_id: str, request: Request):
     if rid is None:
         return JSONResponse({"ok": False, "error": "bad-room-id"}, status_code=400)
 
-    room = rooms.get(rid)
-    if not room:
-        return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
-
-    if not getattr(room, "contest_mode", False):
-        return JSONResponse({"ok": False, "error": "not-a-contest-room"}, status_code=400)
-
-    force = data.get("force", False)
-    if not force and len(room.ready) < len(room.users):
-        return JSONResponse({"ok": False, "error": "not-all-ready"}, status_code=400)
-
     from rymc.phira.protocol.data.message import StartPlayingMessage
     from rymc.phira.protocol.data.state import Playing
     from rymc.phira.protocol.packet.clientbound import (
@@ -474,16 +726,34 @@ async def admin_contest_start(room_id: str, request: Request):
         ClientBoundMessagePacket,
     )
 
-    room.ready.clear()
-    room.state = Playing()
-    for _, ru in room.users.items():
-        try:
-            ru.connection.send(ClientBoundMessagePacket(StartPlayingMessage()))
-            ru.connection.send(ClientBoundChangeStatePacket(Playing()))
-        except Exception:
-            pass
+    def apply():
+        room = rooms.get(rid)
+        if not room:
+            return JSONResponse({"ok": False, "error": "room-not-found"}, status_code=404)
 
-    return {"ok": True}
+        if not getattr(room, "contest_mode", False):
+            return JSONResponse({"ok": False, "error": "not-a-contest-room"}, status_code=400)
+
+        force = data.get("force", False)
+        if not force and len(room.ready) < len(room.users):
+            return JSONResponse({"ok": False, "error": "not-all-ready"}, status_code=400)
+
+        # 状态切换交给房间状态机，非等待准备阶段会被拒绝
+        result = room_engine.apply(rid, "start_playing")
+        if result["status"] != "0":
+            return JSONResponse(
+                {"ok": False, "error": "illegal-transition", "reason": result.get("reason") or result.get("message")},
+                status_code=409,
+            )
+        for _, ru in room.users.items():
+            try:
+                ru.connection.send(ClientBoundMessagePacket(StartPlayingMessage()))
+                ru.connection.send(ClientBoundChangeStatePacket(Playing()))
+            except Exception:
+                pass
+        return {"ok": True}
+
+    return await on_game(apply)
 
 
 def on_room_create(roomId, user_info, **kwargs):
@@ -493,33 +763,75 @@ def on_room_create(roomId, user_info, **kwargs):
 
 
 def setup(ctx):
-    def on_commands_init(registry=None, ctx=None, **_):
-        global room_limits_ref
-        if ctx and hasattr(ctx, "server_state"):
-            room_limits_ref = ctx.server_state.room_limits
-
-    ctx.on("commands.init", on_commands_init)
     ctx.on("room.before_create", on_room_create)
 
     port = int(os.environ.get("HTTP_PORT", 12347))
-    logger.info("正在启动 HTTP API 服务 (端口 %s)...", port)
-
+    # 多进程模式下每个 worker 各开一个端口（HTTP_PORT + 序号 × HTTP_PORT_STRIDE，默认 12347, 12447, ...），
+    # 只反映本 worker 的房间；步长为 0 时只有 0 号 worker 提供 HTTP API
+    worker_id = getattr(getattr(main_module, "cluster", None), "worker_id", 0)
+    if worker_id:
+        stride = int(os.environ.get("HTTP_PORT_STRIDE", 100))
+        if stride <= 0:
+            logger.info("HTTP_PORT_STRIDE=0，worker %s 不启动 HTTP API", worker_id)
+            return None
+        port += worker_id * stride
+    # HTTP_API_MODE=thread：在独立线程的事件循环上运行，序列化、中间件和慢客户端不占用游戏循环
+    threaded = os.environ.get("HTTP_API_MODE", "inline").lower() == "thread"
+    logger.info("正在启动 HTTP API 服务 (端口 %s%s)...", port, "，独立线程" if threaded else "")
+
+    global bridge, room_feed
     loop = asyncio.get_event_loop()
+    bridge = LoopBridge(loop)
+    room_snapshots.start()
+    room_feed = RoomFeed(room_snapshots.current)
+
     config = uvicorn.Config(
         app=app,
         host="0.0.0.0",
         port=port,
         log_level="warning",
+        # 不让 uvicorn 用 dictConfig 重新配置日志：那会关闭 utils/logpipe 的队列处理器，之后的日志全部丢失
+        log_config=None,
         access_log=False,
         loop="asyncio",
+        # /room/feed 是长连接：关闭时不等它们自己结束
+        timeout_graceful_shutdown=2,
     )
     server = uvicorn.Server(config)
-    web_task = loop.create_task(server.serve())
+
+    if not threaded:
+        room_snapshots.listeners.append(room_feed.on_snapshot)
+        web_task = loop.create_task(server.serve())
+
+        def teardown():
+            logger.info("正在关闭 HTTP API 服务...")
+            room_snapshots.close()
+            server.should_exit = True
+            if not web_task.done():
+                web_task.cancel()
+
+        return teardown
+
+    http_loop = asyncio.new_event_loop()
+    # 快照在游戏循环上生成，交给 HTTP 线程的循环去算 delta、分发给订阅者
+    room_snapshots.listeners.append(lambda snapshot: http_loop.call_soon_threadsafe(room_feed.on_snapshot, snapshot))
+
+    def run_http():
+        asyncio.set_event_loop(http_loop)
+        try:
+            http_loop.run_until_complete(server.serve())
+        except Exception:
+            logger.exception("HTTP API 线程异常退出")
+        finally:
+            http_loop.close()
+
+    thread = threading.Thread(target=run_http, name="http-api", daemon=True)
+    thread.start()
 
     def teardown():
         logger.info("正在关闭 HTTP API 服务...")
+        room_snapshots.close()
         server.should_exit = True
-        if not web_task.done():
-            web_task.cancel()
+        thread.join(timeout=5)
 
     return teardown
@@ -0,0 +1,3 @@
+# Developer tools (load generator, local Phira API stand-in, benchmarks).
+# Run from the repository root, e.g. ``python -m tools.loadgen --help``.
+__all__ = []
@@ -0,0 +1,132 @@
+"""Chat relay benchmark: word filter and encode-once broadcast.
+
+The filter table compares :class:`utils.chat.Automaton` (one Aho-Corasick
+pass per message) with the naive filter, which does a ``word in text``
+per listed word, for growing word lists. Messages are random mixed
+Chinese / ASCII text of up to 200 characters (the protocol limit), and a
+share of them contain a listed word.
+
+The relay table compares sending one chat message to a room by encoding
+the packet once per member against :func:`utils.connection.broadcast`
+(encode once, enqueue the same bytes).
+
+Usage::
+
+    python -m tools.bench_chat
+    python -m tools.bench_chat --words 100 10000 --messages 20000 --room-size 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from typing import List, Optional
+
+from rymc.phira.protocol import PacketRegistry
+from rymc.phira.protocol.data.message import ChatMessage
+from rymc.phira.protocol.packet.clientbound import ClientBoundMessagePacket
+from utils.chat import Automaton
+from utils.connection import broadcast
+
+_ALPHABET = "abcdefghijklmnopqrstuvwxyz" + "的一是不了人我在有他这中大来上个国到说们为子和你地出会也时要就可以"
+
+
+def random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(_ALPHABET) for _ in range(rng.randint(2, 6)))
+
+
+def random_messages(rng: random.Random, count: int, words: List[str], hit_rate: float) -> List[str]:
+    messages = []
+    for _ in range(count):
+        text = "".join(rng.choice(_ALPHABET + "    ,.!?") for _ in range(rng.randint(10, 190)))
+        if words and rng.random() < hit_rate:
+            at = rng.randrange(len(text))
+            text = (text[:at] + rng.choice(words).upper() + text[at:])[:200]
+        messages.append(text)
+    return messages
+
+
+def naive_find(words: List[str], text: str) -> List[str]:
+    folded = text.lower()
+    return [word for word in words if word in folded]
+
+
+def bench_filter(word_count: int, messages: int, hit_rate: float, seed: int) -> str:
+    rng = random.Random(seed)
+    words = sorted({random_word(rng) for _ in range(word_count)})
+    texts = random_messages(rng, messages, words, hit_rate)
+
+    started = time.perf_counter()
+    automaton = Automaton(words)
+    build_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    naive_hits = sum(1 for text in texts if naive_find(words, text))
+    naive_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ac_hits = sum(1 for text in texts if automaton.find(text))
+    ac_s = time.perf_counter() - started
+
+    if naive_hits != ac_hits:
+        raise SystemExit(f"filters disagree: naive {naive_hits} vs automaton {ac_hits} messages matched")
+    return (f"{len(words):>8}{messages / naive_s:>14,.0f}{messages / ac_s:>14,.0f}"
+            f"{naive_s / ac_s:>10.1f}x{build_s * 1000:>12.1f}{ac_hits:>10}")
+
+
+class CountingConnection:
+    """Stands in for Connection; only queues what it is given."""
+
+    def __init__(self) -> None:
+        self.queue: list = []
+
+    def send(self, packet) -> None:
+        self.queue.append(PacketRegistry.encode(packet).toBytes())
+
+    def send_raw(self, data: bytes) -> None:
+        self.queue.append(data)
+
+
+def bench_relay(room_size: int, messages: int) -> str:
+    members = [CountingConnection() for _ in range(room_size)]
+    packets = [ClientBoundMessagePacket(ChatMessage(100000 + i % room_size, f"message {i} " + "x" * (i % 120)))
+               for i in range(messages)]
+
+    started = time.perf_counter()
+    for packet in packets:
+        for connection in members:
+            connection.send(packet)
+    per_member_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for packet in packets:
+        broadcast(members, packet)
+    broadcast_s = time.perf_counter() - started
+    return (f"{room_size:>8}{messages / per_member_s:>18,.0f}{messages / broadcast_s:>18,.0f}"
+            f"{per_member_s / broadcast_s:>10.1f}x")
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Chat word filter and relay throughput")
+    parser.add_argument("--words", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--hit-rate", type=float, default=0.1, help="share of messages containing a listed word")
+    parser.add_argument("--room-size", type=int, nargs="+", default=[2, 8, 32])
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list] = None) -> None:
+    args = parse_args(argv)
+    print(f"{'words':>8}{'naive msg/s':>14}{'AC msg/s':>14}{'speedup':>11}{'build ms':>12}{'matched':>10}")
+    for count in args.words:
+        print(bench_filter(count, args.messages, args.hit_rate, args.seed))
+    print()
+    print(f"{'members':>8}{'per-member msg/s':>18}{'broadcast msg/s':>18}{'speedup':>11}")
+    for size in args.room_size:
+        print(bench_relay(size, args.messages))
+
+
+if __name__ == "__main__":
+    main()
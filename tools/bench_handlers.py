@@ -0,0 +1,220 @@
+"""Room-logic throughput benchmark over the in-process loopback transport.
+
+Drives ``main.handle_connection`` / ``MainHandler`` with thousands of virtual
+clients connected through :class:`utils.loopback.LoopbackConnection`, so the
+numbers reflect handler and room bookkeeping cost only — no sockets, no
+event loop, no Phira API (lookups are answered in-process by the
+:mod:`tools.mock_api` generators).
+
+Per iteration every room goes through::
+
+    create + join (room-size - 1) -> (select chart -> request start -> ready
+    -> played) x --rounds -> leave
+
+and the report gives join/ready/played cycles per second plus per-packet
+handler cost. ``--breakdown`` adds a per-packet-type table.
+
+Usage::
+
+    python -m tools.bench_handlers --clients 4000 --room-size 4 --iterations 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from rymc.phira.protocol.packet.serverbound import (
+    ServerBoundAbortPacket,
+    ServerBoundAuthenticatePacket,
+    ServerBoundCreateRoomPacket,
+    ServerBoundJoinRoomPacket,
+    ServerBoundLeaveRoomPacket,
+    ServerBoundPlayedPacket,
+    ServerBoundReadyPacket,
+    ServerBoundRequestStartPacket,
+    ServerBoundSelectChartPacket,
+)
+from tools import mock_api
+from tools.phira_client import decode_frame, encode, make
+from utils.loopback import LoopbackConnection
+from utils.phiraapi import ChartInfo, RecordResult, UserInfo
+
+
+class LocalFetcher:
+    """Answers PhiraFetcher lookups from the mock_api generators, in-process."""
+
+    def get_user_info(self, token: str) -> UserInfo:
+        return UserInfo(**mock_api.user_for_token(token))
+
+    def get_chart_info(self, chartid: int) -> ChartInfo:
+        return ChartInfo(**mock_api.chart_for_id(chartid))
+
+    def get_record_result(self, recordid: int) -> RecordResult:
+        return RecordResult(**mock_api.record_for_id(recordid))
+
+
+class VirtualClient:
+    """One loopback client; server-bound frames are pre-encoded once."""
+
+    def __init__(self, index: int, *, verify: bool) -> None:
+        self.index = index
+        self.verify = verify
+        self.frames_in = 0
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.connection = LoopbackConnection(self._on_send, name=f"vc{index}")
+
+    def _on_send(self, data: bytes) -> None:
+        self.frames_in += 1
+        if self.verify:
+            frame = decode_frame(data)
+            if frame.ok is False:
+                self.failures[frame.name] += 1
+
+
+class Bench:
+    def __init__(self, main_module, args: argparse.Namespace) -> None:
+        self.main = main_module
+        self.args = args
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.clients: List[VirtualClient] = []
+        self.frames = {
+            "Ready": encode(make(ServerBoundReadyPacket)),
+            "RequestStart": encode(make(ServerBoundRequestStartPacket)),
+            "LeaveRoom": encode(make(ServerBoundLeaveRoomPacket)),
+            "Abort": encode(make(ServerBoundAbortPacket)),
+        }
+
+    def feed(self, client: VirtualClient, name: str, data: bytes) -> None:
+        if self.args.breakdown:
+            started = time.perf_counter()
+            client.connection.on_receive(data)
+            self.timings[name] += time.perf_counter() - started
+        else:
+            client.connection.on_receive(data)
+        self.counts[name] += 1
+
+    def connect_all(self) -> float:
+        started = time.perf_counter()
+        for i in range(self.args.clients):
+            client = VirtualClient(i, verify=self.args.verify)
+            self.main.handle_connection(client.connection)
+            token = f"lg-{self.args.token_offset + i}"
+            self.feed(client, "Authenticate", encode(make(ServerBoundAuthenticatePacket, token=token)))
+            self.clients.append(client)
+        return time.perf_counter() - started
+
+    def run_iteration(self, iteration: int) -> None:
+        size = self.args.room_size
+        frames = self.frames
+        for start in range(0, len(self.clients), size):
+            members = self.clients[start:start + size]
+            host, others = members[0], members[1:]
+            room_id = f"b{start}"
+            self.feed(host, "CreateRoom", encode(make(ServerBoundCreateRoomPacket, roomId=room_id)))
+            join = encode(make(ServerBoundJoinRoomPacket, roomId=room_id, monitor=False))
+            for member in others:
+                self.feed(member, "JoinRoom", join)
+
+            for round_no in range(self.args.rounds):
+                chart = encode(make(ServerBoundSelectChartPacket, id=1 + (start + round_no) % 10000))
+                self.feed(host, "SelectChart", chart)
+                self.feed(host, "RequestStart", frames["RequestStart"])
+                for member in others:
+                    self.feed(member, "Ready", frames["Ready"])
+                for n, member in enumerate(members):
+                    if self.args.abort_every and (n + round_no) % self.args.abort_every == 0:
+                        self.feed(member, "Abort", frames["Abort"])
+                    else:
+                        played = encode(make(ServerBoundPlayedPacket, id=iteration * 100000 + start + n))
+                        self.feed(member, "Played", played)
+
+            for member in reversed(members):
+                self.feed(member, "LeaveRoom", frames["LeaveRoom"])
+
+    def disconnect_all(self) -> float:
+        started = time.perf_counter()
+        for client in self.clients:
+            client.connection.close()
+        return time.perf_counter() - started
+
+    def report(self, auth_s: float, run_s: float, close_s: float) -> str:
+        args = self.args
+        rooms = (len(self.clients) + args.room_size - 1) // args.room_size
+        cycles = rooms * args.rounds * args.iterations
+        joins = sum(self.counts[k] for k in ("CreateRoom", "JoinRoom"))
+        inbound = sum(v for k, v in self.counts.items() if k != "Authenticate")
+        outbound = sum(c.frames_in for c in self.clients)
+        lines = [
+            f"clients        {len(self.clients)} in {rooms} rooms of {args.room_size}, "
+            f"{args.rounds} round(s) x {args.iterations} iteration(s)",
+            f"authenticate   {len(self.clients) / auth_s:>12,.0f} /s",
+            f"round cycles   {cycles / run_s:>12,.0f} /s   (select -> start -> ready -> played, whole room)",
+            f"joins          {joins / run_s:>12,.0f} /s",
+            f"packets in     {inbound / run_s:>12,.0f} /s   ({run_s / max(1, inbound) * 1e6:.2f} us/packet)",
+            f"packets out    {outbound / (auth_s + run_s):>12,.0f} /s",
+            f"disconnect     {len(self.clients) / close_s:>12,.0f} /s",
+        ]
+        if args.breakdown:
+            lines.append("")
+            lines.append(f"{'packet':<14}{'count':>10}{'total ms':>12}{'mean us':>10}")
+            for name in sorted(self.timings, key=self.timings.get, reverse=True):
+                count = self.counts[name]
+                total = self.timings[name]
+                lines.append(f"{name:<14}{count:>10}{total * 1000:>12.1f}{total / count * 1e6:>10.2f}")
+        failures: Dict[str, int] = defaultdict(int)
+        for client in self.clients:
+            for name, n in client.failures.items():
+                failures[name] += n
+        if failures:
+            lines.append("failures       " + ", ".join(f"{k}={v}" for k, v in sorted(failures.items())))
+        return "\n".join(lines)
+
+
+def load_main(log_level: str):
+    """Import main.py as a library and wire the globals that ``__main__`` normally sets."""
+    import main
+    from utils.eventbus import EventBus
+
+    # main 在导入时配置了 DEBUG 日志; 基准默认只保留 WARNING 以上，避免测到的是日志 I/O
+    logging.getLogger().setLevel(getattr(logging, log_level.upper()))
+    main.event_bus = EventBus()
+    main.security_store = None
+    main.fetcher = LocalFetcher()
+    return main
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="MainHandler throughput over the loopback transport")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--room-size", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3, help="play rounds per room per iteration")
+    parser.add_argument("--iterations", type=int, default=3, help="join/play/leave passes over all rooms")
+    parser.add_argument("--abort-every", type=int, default=0, help="every N-th player aborts instead of playing")
+    parser.add_argument("--token-offset", type=int, default=0)
+    parser.add_argument("--breakdown", action="store_true", help="time each packet type separately")
+    parser.add_argument("--verify", action="store_true", help="decode responses and count failed results")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args(argv)
+    args.room_size = max(1, args.room_size)
+    return args
+
+
+def main(argv: Optional[list] = None) -> None:
+    args = parse_args(argv)
+    bench = Bench(load_main(args.log_level), args)
+    auth_s = bench.connect_all()
+    started = time.perf_counter()
+    for iteration in range(args.iterations):
+        bench.run_iteration(iteration)
+    run_s = time.perf_counter() - started
+    close_s = bench.disconnect_all()
+    print(bench.report(auth_s, run_s, close_s))
+
+
+if __name__ == "__main__":
+    main()
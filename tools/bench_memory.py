@@ -0,0 +1,190 @@
+"""Memory footprint of online players.
+
+Builds N online players the way the server does — a real
+:class:`utils.connection.Connection` (with its write queue and sender task)
+per client, ``handle_connection`` + Authenticate, rooms of ``--room-size``
+players — and reports traced bytes per online player via
+:mod:`tracemalloc`. A second table compares the per-object cost of the
+runtime records against their unslotted / full-``UserInfo`` equivalents.
+
+The Phira API is answered in-process with realistic full profiles (avatar
+URL, bio, e-mail, timestamps), so the profile savings are representative.
+
+Usage::
+
+    python -m tools.bench_memory                 # 10k and 50k players
+    python -m tools.bench_memory --players 20000 --room-size 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from rymc.phira.protocol.packet.serverbound import (
+    ServerBoundAuthenticatePacket,
+    ServerBoundCreateRoomPacket,
+    ServerBoundJoinRoomPacket,
+)
+from tools import mock_api
+from tools.bench_handlers import LocalFetcher, load_main
+from tools.phira_client import encode, make
+from utils import room as room_mod
+from utils.connection import Connection
+from utils.phiraapi import OnlineProfile, UserInfo
+
+
+def full_user_info(token: str) -> UserInfo:
+    """A UserInfo shaped like a real /me response."""
+    base = mock_api.user_for_token(token)
+    uid = base["id"]
+    joined = datetime(2023, 1, 1) + timedelta(minutes=uid % 500000)
+    return UserInfo(
+        id=uid,
+        name=base["name"],
+        avatar=f"https://api.phira.cn/files/avatar/{uid:08x}-3b2c-4f6a-9d1e-5a7c{uid:08x}",
+        language=base["language"],
+        bio=f"Phira player #{uid}. Mostly plays IN/AT charts, sometimes charts too.",
+        exp=uid * 37 % 100000,
+        rks=13.0 + (uid % 300) / 100,
+        joined=joined,
+        lastLogin=joined + timedelta(days=300),
+        roles=0,
+        banned=False,
+        loginBanned=False,
+        followerCount=uid % 97,
+        followingCount=uid % 53,
+        email=f"user{uid}@example.com",
+    )
+
+
+class RealisticFetcher(LocalFetcher):
+    def get_user_info(self, token: str) -> UserInfo:
+        return full_user_info(token)
+
+
+class NullWriter:
+    """Stands in for asyncio.StreamWriter; Connection only needs these."""
+
+    def write(self, data: bytes) -> None:
+        pass
+
+    async def drain(self) -> None:
+        pass
+
+    def is_closing(self) -> bool:
+        return False
+
+
+def traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def online_players(main, count: int, room_size: int) -> float:
+    """Bring ``count`` players online through the real handler path; bytes per player."""
+    auth = [encode(make(ServerBoundAuthenticatePacket, token=f"lg-{i}")) for i in range(count)]
+    rooms_frames = []
+    for i in range(count):
+        rid = f"m{i // room_size}"
+        if i % room_size == 0:
+            rooms_frames.append(encode(make(ServerBoundCreateRoomPacket, roomId=rid)))
+        else:
+            rooms_frames.append(encode(make(ServerBoundJoinRoomPacket, roomId=rid, monitor=False)))
+
+    connections: List[Connection] = []
+    before = traced()
+    for i in range(count):
+        conn = Connection(NullWriter())
+        main.handle_connection(conn)
+        conn.on_receive(auth[i])
+        conn.on_receive(rooms_frames[i])
+        connections.append(conn)
+        if i % 1000 == 999:
+            await asyncio.sleep(0)   # 让发送任务清空队列，和真实服务器一致
+    for _ in range(3):
+        await asyncio.sleep(0)
+    # the list holding the connections is harness overhead, not server state
+    after = traced() - (len(connections) * 8 + 56)
+    per_player = (after - before) / count
+
+    for conn in connections:
+        conn._sender_task.cancel()
+    await asyncio.sleep(0)
+    room_mod.rooms.clear()
+    main.online_user_list.clear()
+    main.online_profiles.clear()
+    main.auth_cache.clear()
+    return per_player
+
+
+def per_object(factory: Callable[[int], object], count: int = 20000) -> float:
+    keep = []
+    before = traced()
+    for i in range(count):
+        keep.append(factory(i))
+    after = traced() - (len(keep) * 8 + 56)
+    return (after - before) / count
+
+
+# Same constructors as Room / RoomUser but with an instance __dict__ (the pre-slots layout)
+_DictRoom = type("_DictRoom", (), {"__init__": room_mod.Room.__init__})
+_DictRoomUser = type("_DictRoomUser", (), {"__init__": room_mod.RoomUser.__init__})
+
+
+def component_table() -> List[str]:
+    profiles = [full_user_info(f"lg-{i}") for i in range(1000)]
+
+    def room(cls):
+        def make_room(i):
+            r = cls(f"r{i}")
+            r.host = i
+            return r
+        return make_room
+
+    rows = [
+        ("profile", per_object(lambda i: full_user_info(f"lg-{i}")),
+         per_object(lambda i: OnlineProfile.from_user_info(profiles[i % 1000], token=f"lg-{i}"))),
+        ("Room", per_object(room(_DictRoom)), per_object(room(room_mod.Room))),
+        ("RoomUser", per_object(lambda i: _DictRoomUser(None, None)), per_object(lambda i: room_mod.RoomUser(None, None))),
+    ]
+    lines = [f"{'record':<12}{'before B':>12}{'after B':>12}", ]
+    for name, old, new in rows:
+        lines.append(f"{name:<12}{old:>12.0f}{new:>12.0f}")
+    lines.append("(before = full UserInfo / instance __dict__, after = OnlineProfile / __slots__)")
+    return lines
+
+
+async def run(args: argparse.Namespace) -> None:
+    main = load_main(args.log_level)
+    main.fetcher = RealisticFetcher()
+    # auth_cache 默认只保留 1000 个 token；基准不受其容量影响
+    tracemalloc.start()
+    print(f"{'players':>10}{'bytes/player':>16}")
+    for count in args.players:
+        print(f"{count:>10}{await online_players(main, count, args.room_size):>16.0f}")
+    print()
+    print("\n".join(component_table()))
+    tracemalloc.stop()
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Bytes per online player")
+    parser.add_argument("--players", type=int, nargs="+", default=[10_000, 50_000])
+    parser.add_argument("--room-size", type=int, default=4)
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args(argv)
+    args.room_size = max(1, args.room_size)
+    return args
+
+
+def main(argv: Optional[list] = None) -> None:
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
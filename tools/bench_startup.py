@@ -0,0 +1,133 @@
+"""Server startup benchmark: time from spawn to the first accepted connection.
+
+Starts ``python main.py`` several times from a scratch directory (every
+repository entry symlinked, its own ``config.json``) and measures how long
+it takes until a TCP connection to the game port succeeds. Each setting of
+``plugin_import_threads`` is run ``--runs`` times after one unmeasured
+warm-up run (bytecode caches, OS page cache); the table shows the median
+and best time and the plugin summary the server logs when its startup
+loading is done ("N plugins ready in X ms").
+
+With threaded imports the game port opens while plugins are still being
+imported, so "first accept" drops while "plugins ready" stays about the
+same.
+
+Usage::
+
+    python -m tools.bench_startup
+    python -m tools.bench_startup --threads 0 2 4 --runs 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+_READY = re.compile(r"(\d+) plugins ready in (\d+) ms")
+# 每次运行都会写入的文件/目录，不链接回仓库
+_LOCAL = {"config.json", "logs", ".git", "__pycache__", "restart_snapshot.bin"}
+
+
+def prepare(workdir: Path, port: int, threads: int) -> None:
+    for entry in ROOT.iterdir():
+        if entry.name not in _LOCAL and not (workdir / entry.name).exists():
+            (workdir / entry.name).symlink_to(entry)
+    with open(ROOT / "config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config.update(host="127.0.0.1", port=port, plugin_import_threads=threads)
+    with open(workdir / "config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f)
+
+
+def wait_accept(port: int, deadline: float) -> Optional[float]:
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return time.perf_counter()
+        except OSError:
+            time.sleep(0.002)
+    return None
+
+
+def ready_ms(workdir: Path) -> Optional[float]:
+    """The "plugins ready in X ms" figure from the server's log file, once written."""
+    for path in (workdir / "logs").glob("*.log"):
+        match = _READY.search(path.read_text(encoding="utf-8", errors="replace"))
+        if match:
+            return float(match.group(2))
+    return None
+
+
+def run_once(workdir: Path, port: int, http_port: int, timeout: float) -> Tuple[Optional[float], Optional[float]]:
+    """``(seconds to first accept, plugins-ready ms)``; None when not reached within ``timeout``."""
+    env = dict(os.environ, HTTP_PORT=str(http_port))
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "main.py"], cwd=workdir, env=env, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        accepted = wait_accept(port, started + timeout)
+        ready = None
+        # 线程导入时插件可能在端口打开之后才加载完，再等它的汇总日志
+        while accepted is not None and proc.poll() is None and time.perf_counter() < started + timeout:
+            ready = ready_ms(workdir)
+            if ready is not None:
+                break
+            time.sleep(0.05)
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(workdir / "logs", ignore_errors=True)
+    return (accepted - started if accepted is not None else None), ready
+
+
+def bench(threads: int, runs: int, port: int, http_port: int, timeout: float) -> str:
+    with tempfile.TemporaryDirectory(prefix="pyphira-startup-") as tmp:
+        workdir = Path(tmp)
+        prepare(workdir, port, threads)
+        run_once(workdir, port, http_port, timeout)         # warm-up
+        accepts: List[float] = []
+        readies: List[float] = []
+        for _ in range(runs):
+            accept_s, ready = run_once(workdir, port, http_port, timeout)
+            if accept_s is not None:
+                accepts.append(accept_s * 1000)
+            if ready is not None:
+                readies.append(ready)
+    if not accepts:
+        return f"{threads:>8}{'(server did not accept within the timeout)':>40}"
+    plugins = f"{statistics.median(readies):>14.0f}" if readies else f"{'-':>14}"
+    return f"{threads:>8}{statistics.median(accepts):>14.0f}{min(accepts):>12.0f}{plugins}{len(accepts):>6}"
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Time from server spawn to first accepted connection")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0, 4],
+                        help="plugin_import_threads settings to compare (0 = import inline)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=12391)
+    parser.add_argument("--http-port", type=int, default=12392)
+    parser.add_argument("--timeout", type=float, default=20.0)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list] = None) -> None:
+    args = parse_args(argv)
+    print(f"{'threads':>8}{'accept p50 ms':>14}{'best ms':>12}{'plugins ms':>14}{'runs':>6}")
+    for threads in args.threads:
+        print(bench(threads, args.runs, args.port, args.http_port, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Reference broker for the cluster-wide room directory.
+
+Serves a :class:`utils.directory.DirectoryState` over TCP or a Unix socket
+so several pyphira-mp nodes share one room namespace. Each node points
+``cluster_broker`` in its ``config.json`` at it::
+
+    {"cluster_broker": "10.0.0.5:12360", "node_id": "node-a", "node_address": "10.0.0.11:12346"}
+
+State lives in memory only; a node's rooms and players are dropped when
+its connection to the broker closes and re-registered when it reconnects.
+
+Usage::
+
+    python -m tools.directory_broker --listen 0.0.0.0:12360
+    python -m tools.directory_broker --listen unix:/run/pyphira/directory.sock
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+from typing import Optional
+
+from utils.directory import DirectoryServer
+
+logger = logging.getLogger("directory_broker")
+
+
+async def _serve(address: str, stats_every: float) -> None:
+    server = DirectoryServer()
+    await server.start(address)
+    try:
+        while True:
+            await asyncio.sleep(stats_every)
+            state = server.state
+            logger.info("%s nodes, %s rooms, %s players", len(state.nodes), len(state.rooms), len(state.users))
+    finally:
+        server.close()
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="pyphira-mp room directory broker")
+    parser.add_argument("--listen", default="127.0.0.1:12360", help="host:port or unix:/path")
+    parser.add_argument("--stats-every", type=float, default=60.0, help="seconds between summary log lines")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s %(levelname)s]: [%(name)s] %(message)s")
+    try:
+        asyncio.run(_serve(args.listen, args.stats_every))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""Synthetic Phira client swarm for load testing.
+
+Opens ``--clients`` TCP connections, groups them into rooms of
+``--room-size`` and runs a scripted scenario per room:
+
+    authenticate -> create/join room -> (select chart -> ready -> play
+    [touches/judges at --hz for --play-seconds] -> played/abort) x --rounds
+
+At the end it prints p50/p99 request latency per packet type and overall
+throughput. With ``--mock-api`` a local Phira API stand-in
+(:mod:`tools.mock_api`) is started as well; set ``phira_api_host`` in the
+server's ``config.json`` to the same address to run entirely offline.
+
+Usage::
+
+    python -m tools.mock_api --port 12348 &      # or --mock-api below
+    python main.py                               # with phira_api_host set
+    python -m tools.loadgen --clients 200 --room-size 4 --rounds 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from rymc.phira.protocol.packet.serverbound import (
+    ServerBoundAbortPacket,
+    ServerBoundAuthenticatePacket,
+    ServerBoundCreateRoomPacket,
+    ServerBoundJoinRoomPacket,
+    ServerBoundJudgesPacket,
+    ServerBoundPingPacket,
+    ServerBoundPlayedPacket,
+    ServerBoundReadyPacket,
+    ServerBoundRequestStartPacket,
+    ServerBoundSelectChartPacket,
+    ServerBoundTouchesPacket,
+)
+from tools import mock_api
+from tools.phira_client import (
+    STATE_PLAYING,
+    STATE_SELECT_CHART,
+    STATE_WAIT_FOR_READY,
+    Frame,
+    PhiraClient,
+    RequestFailed,
+    make,
+)
+
+
+logger = logging.getLogger("loadgen")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+@dataclass
+class Stats:
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    frames_in: int = 0
+    bytes_in: int = 0
+    errors: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    rounds: int = 0
+
+    def record_latency(self, name: str, seconds: float) -> None:
+        self.latencies[name].append(seconds)
+
+    def record_frame(self, frame: Frame, nbytes: int) -> None:
+        self.frames_in += 1
+        self.bytes_in += nbytes
+
+    def record_error(self, what: str) -> None:
+        self.errors[what] += 1
+
+    def report(self, clients: List[PhiraClient], elapsed: float) -> str:
+        packets_out = sum(c.packets_sent for c in clients)
+        bytes_out = sum(c.bytes_sent for c in clients)
+        lines = [
+            f"{'packet':<14}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            lines.append(
+                f"{name:<14}{len(values):>8}"
+                f"{percentile(values, 0.50) * 1000:>10.2f}"
+                f"{percentile(values, 0.99) * 1000:>10.2f}"
+                f"{values[-1] * 1000:>10.2f}"
+            )
+        lines.append("")
+        lines.append(f"elapsed        {elapsed:.2f}s, rounds completed: {self.rounds}")
+        lines.append(f"sent           {packets_out} packets ({packets_out / elapsed:.0f}/s), {bytes_out / elapsed / 1024:.1f} KiB/s")
+        lines.append(f"received       {self.frames_in} packets ({self.frames_in / elapsed:.0f}/s), {self.bytes_in / elapsed / 1024:.1f} KiB/s")
+        if self.errors:
+            lines.append("errors         " + ", ".join(f"{k}={v}" for k, v in sorted(self.errors.items())))
+        return "\n".join(lines)
+
+
+async def stream_play(client: PhiraClient, args: argparse.Namespace, rng: random.Random) -> None:
+    """Stream touches and judges at ``args.hz`` for ``args.play_seconds``."""
+    touches = make(ServerBoundTouchesPacket, data=bytes(rng.getrandbits(8) for _ in range(args.touch_bytes)))
+    judges = make(ServerBoundJudgesPacket, data=bytes(rng.getrandbits(8) for _ in range(args.judge_bytes)))
+    if args.hz <= 0:
+        return
+    interval = 1.0 / args.hz
+    deadline = time.perf_counter() + args.play_seconds
+    next_tick = time.perf_counter()
+    tick = 0
+    while time.perf_counter() < deadline:
+        await client.send(touches)
+        if tick % args.judge_every == 0:
+            await client.send(judges)
+        if args.ping_every and tick % args.ping_every == 0:
+            await client.request(make(ServerBoundPingPacket), timeout=args.timeout)
+        tick += 1
+        next_tick += interval
+        await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+
+
+async def run_room(index: int, members: List[PhiraClient], args: argparse.Namespace, stats: Stats) -> None:
+    rng = random.Random(args.seed + index)
+    host, others = members[0], members[1:]
+    room_id = f"lg{index}"
+    timeout = args.timeout
+
+    try:
+        await host.request(make(ServerBoundCreateRoomPacket, roomId=room_id), timeout=timeout)
+        for member in others:
+            await member.request(make(ServerBoundJoinRoomPacket, roomId=room_id, monitor=False), timeout=timeout)
+
+        for round_no in range(args.rounds):
+            chart_id = rng.randint(1, 10000)
+            await host.request(make(ServerBoundSelectChartPacket, id=chart_id), timeout=timeout)
+
+            waiting = [m.wait_state(STATE_WAIT_FOR_READY) for m in others]
+            playing = [c.wait_state(STATE_PLAYING) for c in members]
+            await host.request(make(ServerBoundRequestStartPacket), timeout=timeout)
+            await asyncio.wait_for(asyncio.gather(*waiting), timeout)
+            await asyncio.gather(*(m.request(make(ServerBoundReadyPacket), timeout=timeout) for m in others))
+            await asyncio.wait_for(asyncio.gather(*playing), timeout)
+
+            back_to_select = [c.wait_state(STATE_SELECT_CHART) for c in members]
+            await asyncio.gather(*(stream_play(c, args, rng) for c in members))
+
+            async def finish(client: PhiraClient) -> None:
+                if rng.random() < args.abort_ratio:
+                    await client.request(make(ServerBoundAbortPacket), timeout=timeout)
+                else:
+                    await client.request(make(ServerBoundPlayedPacket, id=rng.randint(1, 10_000_000)), timeout=timeout)
+
+            await asyncio.gather(*(finish(c) for c in members))
+            await asyncio.wait_for(asyncio.gather(*back_to_select), timeout)
+            stats.rounds += 1
+    except RequestFailed as e:
+        stats.record_error(e.name)
+        logger.warning("room %s: %s", room_id, e)
+    except asyncio.TimeoutError:
+        stats.record_error("timeout")
+        logger.warning("room %s: timed out", room_id)
+    except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+        stats.record_error("connection")
+        logger.warning("room %s: connection lost: %s", room_id, e)
+
+
+async def run(args: argparse.Namespace) -> Stats:
+    stats = Stats()
+    clients: List[PhiraClient] = []
+    sem = asyncio.Semaphore(args.connect_concurrency)
+
+    async def open_client(i: int) -> Optional[PhiraClient]:
+        client = PhiraClient(args.host, args.port, on_latency=stats.record_latency, on_frame=stats.record_frame)
+        async with sem:
+            try:
+                started = time.perf_counter()
+                await client.connect()
+                stats.record_latency("Connect", time.perf_counter() - started)
+                await client.request(make(ServerBoundAuthenticatePacket, token=f"lg-{args.token_offset + i}"),
+                                     timeout=args.timeout)
+            except (RequestFailed, asyncio.TimeoutError, OSError) as e:
+                stats.record_error("Authenticate")
+                logger.warning("client %d: %s", i, e)
+                await client.close()
+                return None
+        return client
+
+    started = time.perf_counter()
+    opened = await asyncio.gather(*(open_client(i) for i in range(args.clients)))
+    clients = [c for c in opened if c is not None]
+    logger.info("%d/%d clients authenticated", len(clients), args.clients)
+
+    groups = [clients[i:i + args.room_size] for i in range(0, len(clients), args.room_size)]
+    await asyncio.gather(*(run_room(i, group, args, stats) for i, group in enumerate(groups) if group))
+    elapsed = time.perf_counter() - started
+
+    print(stats.report(clients, elapsed))
+    await asyncio.gather(*(c.close() for c in clients))
+    return stats
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Synthetic Phira client swarm")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12346)
+    parser.add_argument("--clients", type=int, default=40)
+    parser.add_argument("--room-size", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--hz", type=float, default=20.0, help="touch frames per second per client")
+    parser.add_argument("--play-seconds", type=float, default=5.0)
+    parser.add_argument("--judge-every", type=int, default=4, help="send a judges frame every N touch frames")
+    parser.add_argument("--ping-every", type=int, default=20, help="ping every N touch frames (0 = off)")
+    parser.add_argument("--touch-bytes", type=int, default=64)
+    parser.add_argument("--judge-bytes", type=int, default=32)
+    parser.add_argument("--abort-ratio", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=15.0)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--token-offset", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mock-api", metavar="PORT", type=int, default=None,
+                        help="also start the local Phira API stand-in on this port")
+    mock_api.add_arguments(parser, prefix="mock-")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    args.room_size = max(1, args.room_size)
+    args.judge_every = max(1, args.judge_every)
+    return args
+
+
+def main(argv: Optional[list] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="[%(asctime)s %(levelname)s]: [%(name)s] %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    mock = None
+    if args.mock_api is not None:
+        mock, _ = mock_api.serve_in_thread("127.0.0.1", args.mock_api, mock_api.config_from_args(args, "mock-"))
+    try:
+        asyncio.run(run(args))
+    finally:
+        if mock is not None:
+            mock.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Local stand-in for the Phira HTTP API.
+
+Serves the three endpoints used by :class:`utils.phiraapi.PhiraFetcher`
+(``/me``, ``/chart/{id}`` and ``/record/{id}``) from a fixtures file and/or
+deterministic generators, so the server and the load generator can run
+fully offline and API-path benchmarks are reproducible.
+
+Injected latency, error rate and a token-bucket rate limit are
+configurable, and ``GET /_stats`` returns per-endpoint request counters.
+
+Point the server at it through ``config.json``::
+
+    {"phira_api_host": "http://127.0.0.1:12348/", "phira_api_retries": 1}
+
+Fixtures are JSON, every section optional; entries not found fall back to
+the generators unless ``--strict`` is given::
+
+    {"users":   {"<token>": {"id": 1, "name": "a", "language": "en-US"}},
+     "charts":  {"<id>": {...ChartInfo...}},
+     "records": {"<id>": {...RecordResult...}}}
+
+Usage::
+
+    python -m tools.mock_api --port 12348 --latency-ms 40 --jitter-ms 10 \\
+        --error-rate 0.01 --rate-limit 500 --fixtures fixtures.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+def user_for_token(token: str) -> Dict[str, Any]:
+    """Derive a stable fake user from an auth token.
+
+    Tokens shaped like ``lg-<n>`` (used by :mod:`tools.loadgen`) map to user
+    id ``100000 + n``; anything else is hashed into the same id space.
+    """
+    if token.startswith("lg-") and token[3:].isdigit():
+        uid = 100000 + int(token[3:])
+    else:
+        uid = 100000 + zlib.crc32(token.encode("utf-8")) % 900000
+    return {
+        "id": uid,
+        "name": f"user{uid}",
+        "language": "zh-CN",
+        "exp": 0,
+        "rks": 0.0,
+    }
+
+
+def chart_for_id(chart_id: int) -> Dict[str, Any]:
+    return {
+        "id": chart_id,
+        "name": f"Chart {chart_id}",
+        "level": "IN 13",
+        "difficulty": 13.0,
+        "charter": "mock",
+    }
+
+
+def record_for_id(record_id: int) -> Dict[str, Any]:
+    # 分数由 record id 确定，便于复现
+    score = 600000 + (record_id * 7919) % 400001
+    return {
+        "score": score,
+        "perfect": 900,
+        "good": 80,
+        "bad": 10,
+        "miss": 10,
+        "max_combo": 500,
+        "accuracy": round(score / 1000000, 4),
+        "full_combo": score == 1000000,
+        "std": 0.0,
+        "std_score": 0.0,
+    }
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+    rate_limit: float = 0.0          # requests per second, 0 = unlimited
+    burst: int = 0                   # bucket size, defaults to rate_limit
+    strict: bool = False             # 404 for ids/tokens missing from fixtures
+    seed: int = 0
+    fixtures: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    @staticmethod
+    def load_fixtures(path: str) -> Dict[str, Dict[str, Any]]:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        return {
+            section: {str(k): v for k, v in (data.get(section) or {}).items()}
+            for section in ("users", "charts", "records")
+        }
+
+
+class TokenBucket:
+    """Thread-safe token bucket used for the global rate limit."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.capacity = float(max(1, burst or int(rate) or 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+
+class MockPhiraServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: MockConfig) -> None:
+        super().__init__(address, MockPhiraHandler)
+        self.config = config
+        self.bucket = TokenBucket(config.rate_limit, config.burst) if config.rate_limit > 0 else None
+        self.stats: Dict[str, int] = defaultdict(int)
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+
+    def draw(self) -> Tuple[float, bool]:
+        """Return (delay seconds, inject error) for one request."""
+        cfg = self.config
+        with self._lock:
+            jitter = self._rng.uniform(-cfg.jitter_ms, cfg.jitter_ms) if cfg.jitter_ms else 0.0
+            fail = cfg.error_rate > 0 and self._rng.random() < cfg.error_rate
+        return max(0.0, cfg.latency_ms + jitter) / 1000.0, fail
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+
+class MockPhiraHandler(BaseHTTPRequestHandler):
+    server: MockPhiraServer
+    server_version = "pyphira-mock/0.2"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _lookup(self, section: str, key: str, generate) -> Tuple[int, Dict[str, Any]]:
+        entry = self.server.config.fixtures.get(section, {}).get(key)
+        if entry is not None:
+            return 200, entry
+        if self.server.config.strict:
+            return 404, {"error": "not-found"}
+        return 200, generate()
+
+    def _route(self, parts) -> Tuple[int, Dict[str, Any]]:
+        if parts == ["me"]:
+            auth = self.headers.get("Authorization", "")
+            if not auth.startswith("Bearer ") or not auth[7:]:
+                return 401, {"error": "unauthorized"}
+            token = auth[7:]
+            return self._lookup("users", token, lambda: user_for_token(token))
+        if len(parts) == 2 and parts[0] in ("chart", "record"):
+            try:
+                ident = int(parts[1])
+            except ValueError:
+                return 400, {"error": "bad-id"}
+            if parts[0] == "chart":
+                return self._lookup("charts", str(ident), lambda: chart_for_id(ident))
+            return self._lookup("records", str(ident), lambda: record_for_id(ident))
+        return 404, {"error": "not-found"}
+
+    def do_GET(self) -> None:  # noqa: N802
+        parts = [p for p in self.path.split("?", 1)[0].split("/") if p]
+        if parts == ["_stats"]:
+            self._send_json(200, dict(self.server.stats))
+            return
+
+        endpoint = parts[0] if parts else "/"
+        self.server.count(f"{endpoint}.requests")
+        if self.server.bucket is not None and not self.server.bucket.take():
+            self.server.count(f"{endpoint}.rate_limited")
+            self._send_json(429, {"error": "rate-limited"})
+            return
+
+        delay, fail = self.server.draw()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            self.server.count(f"{endpoint}.injected_errors")
+            self._send_json(self.server.config.error_status, {"error": "injected"})
+            return
+
+        status, body = self._route(parts)
+        self.server.count(f"{endpoint}.{status}")
+        self._send_json(status, body)
+
+
+def make_server(host: str = "127.0.0.1", port: int = 12348, config: Optional[MockConfig] = None) -> MockPhiraServer:
+    return MockPhiraServer((host, port), config or MockConfig())
+
+
+def serve_in_thread(
+    host: str = "127.0.0.1",
+    port: int = 12348,
+    config: Optional[MockConfig] = None,
+) -> Tuple[MockPhiraServer, threading.Thread]:
+    """Start the stand-in on a daemon thread. Call ``server.shutdown()`` to stop."""
+    server = make_server(host, port, config)
+    thread = threading.Thread(target=server.serve_forever, name="mock-phira-api", daemon=True)
+    thread.start()
+    logger.info("Mock Phira API listening on http://%s:%s/", *server.server_address[:2])
+    return server, thread
+
+
+def add_arguments(parser: argparse.ArgumentParser, prefix: str = "") -> None:
+    """Register the behaviour knobs; ``prefix`` lets other tools embed them."""
+    parser.add_argument(f"--{prefix}latency-ms", type=float, default=0.0, help="added latency per request")
+    parser.add_argument(f"--{prefix}jitter-ms", type=float, default=0.0, help="uniform +/- jitter on the latency")
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=0.0, help="fraction of requests failing")
+    parser.add_argument(f"--{prefix}error-status", type=int, default=500)
+    parser.add_argument(f"--{prefix}rate-limit", type=float, default=0.0, help="requests/s before 429 (0 = off)")
+    parser.add_argument(f"--{prefix}burst", type=int, default=0)
+    parser.add_argument(f"--{prefix}fixtures", default=None, help="JSON fixtures file")
+    parser.add_argument(f"--{prefix}strict", action="store_true", help="404 for entries missing from fixtures")
+    parser.add_argument(f"--{prefix}seed", type=int, default=0)
+
+
+def config_from_args(args: argparse.Namespace, prefix: str = "") -> MockConfig:
+    attr = prefix.replace("-", "_")
+    get = lambda name: getattr(args, attr + name)  # noqa: E731
+    fixtures_path = get("fixtures")
+    return MockConfig(
+        latency_ms=get("latency_ms"),
+        jitter_ms=get("jitter_ms"),
+        error_rate=get("error_rate"),
+        error_status=get("error_status"),
+        rate_limit=get("rate_limit"),
+        burst=get("burst"),
+        strict=get("strict"),
+        seed=get("seed"),
+        fixtures=MockConfig.load_fixtures(fixtures_path) if fixtures_path else {},
+    )
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Local Phira API stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12348)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s %(levelname)s]: [%(name)s] %(message)s")
+    server = make_server(args.host, args.port, config_from_args(args))
+    cfg = server.config
+    logger.info(
+        "Mock Phira API listening on http://%s:%s/ (latency=%sms±%s error_rate=%s rate_limit=%s fixtures=%s)",
+        args.host, args.port, cfg.latency_ms, cfg.jitter_ms, cfg.error_rate, cfg.rate_limit or "off",
+        sum(len(v) for v in cfg.fixtures.values()),
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
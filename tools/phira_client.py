@@ -0,0 +1,275 @@
+"""Minimal client side of the Phira protocol, for tools and benchmarks.
+
+``rymc.phira.protocol`` only implements the server direction: server-bound
+packets know how to ``decode`` and client-bound packets how to ``encode``.
+This module provides the mirror image on top of the same packet classes:
+it encodes :class:`ServerBoundPacket` instances and decodes the header of
+incoming client-bound frames (packet type, result flag, state and message
+discriminators) which is all a scripted client needs.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Type
+
+from rymc.phira.protocol import PacketRegistry
+from rymc.phira.protocol.packet.ServerBoundPacket import ServerBoundPacket
+from rymc.phira.protocol.packet.serverbound import (
+    ServerBoundAbortPacket,
+    ServerBoundAuthenticatePacket,
+    ServerBoundCancelReadyPacket,
+    ServerBoundChatPacket,
+    ServerBoundCreateRoomPacket,
+    ServerBoundCycleRoomPacket,
+    ServerBoundJoinRoomPacket,
+    ServerBoundJudgesPacket,
+    ServerBoundLeaveRoomPacket,
+    ServerBoundLockRoomPacket,
+    ServerBoundPingPacket,
+    ServerBoundPlayedPacket,
+    ServerBoundReadyPacket,
+    ServerBoundRequestStartPacket,
+    ServerBoundSelectChartPacket,
+    ServerBoundTouchesPacket,
+)
+from rymc.phira.protocol.util import ByteBuf, readString, writeString
+from utils.asyncioutil import receive_message, write_message
+
+
+# GameState discriminators (see rymc.phira.protocol.data.state)
+STATE_SELECT_CHART = 0x00
+STATE_WAIT_FOR_READY = 0x01
+STATE_PLAYING = 0x02
+
+# ClientBound packet ids we react to
+CB_PONG = 0x00
+CB_MESSAGE = 0x05
+CB_CHANGE_STATE = 0x06
+
+SERVERBOUND_IDS: Dict[Type[ServerBoundPacket], int] = {
+    cls: pid for pid, cls in PacketRegistry._client_bound_packet_map.items()
+}
+CLIENTBOUND_NAMES: Dict[int, str] = {
+    pid: cls.__name__ for cls, pid in PacketRegistry._server_bound_packet_map.items()
+}
+
+# ServerBound packet -> id of the ClientBound packet that answers it
+RESPONSE_IDS: Dict[Type[ServerBoundPacket], int] = {
+    ServerBoundPingPacket: 0x00,
+    ServerBoundAuthenticatePacket: 0x01,
+    ServerBoundChatPacket: 0x02,
+    ServerBoundCreateRoomPacket: 0x08,
+    ServerBoundJoinRoomPacket: 0x09,
+    ServerBoundLeaveRoomPacket: 0x0B,
+    ServerBoundLockRoomPacket: 0x0C,
+    ServerBoundCycleRoomPacket: 0x0D,
+    ServerBoundSelectChartPacket: 0x0E,
+    ServerBoundRequestStartPacket: 0x0F,
+    ServerBoundReadyPacket: 0x10,
+    ServerBoundCancelReadyPacket: 0x11,
+    ServerBoundPlayedPacket: 0x12,
+    ServerBoundAbortPacket: 0x13,
+}
+
+# Packets whose answer starts with a PacketResult byte
+_RESULT_IDS = frozenset(RESPONSE_IDS.values()) - {0x00}
+
+
+def _encode_body(packet: ServerBoundPacket, buf: ByteBuf) -> None:
+    """Write the payload of ``packet``; the inverse of each ``decode``."""
+    if isinstance(packet, ServerBoundAuthenticatePacket):
+        writeString(buf, packet.token or "")
+    elif isinstance(packet, ServerBoundChatPacket):
+        writeString(buf, packet.message or "")
+    elif isinstance(packet, (ServerBoundTouchesPacket, ServerBoundJudgesPacket)):
+        buf.writeBytes(packet.data or b"")
+    elif isinstance(packet, ServerBoundCreateRoomPacket):
+        writeString(buf, packet.roomId or "")
+    elif isinstance(packet, ServerBoundJoinRoomPacket):
+        writeString(buf, packet.roomId or "")
+        buf.writeBoolean(bool(packet.monitor))
+    elif isinstance(packet, ServerBoundLockRoomPacket):
+        buf.writeBoolean(bool(packet.lock))
+    elif isinstance(packet, ServerBoundCycleRoomPacket):
+        buf.writeBoolean(bool(packet.cycle))
+    elif isinstance(packet, (ServerBoundSelectChartPacket, ServerBoundPlayedPacket)):
+        buf.writeIntLE(int(packet.id or 0))
+    # Ping / LeaveRoom / RequestStart / Ready / CancelReady / Abort have no payload
+
+
+def encode(packet: ServerBoundPacket) -> bytes:
+    """Encode a server-bound packet (id byte + payload), without length prefix."""
+    pid = SERVERBOUND_IDS.get(type(packet))
+    if pid is None:
+        raise TypeError(f"Unknown ServerBound packet class: {type(packet).__name__}")
+    buf = ByteBuf()
+    buf.writeByte(pid)
+    _encode_body(packet, buf)
+    return buf.toBytes()
+
+
+def make(cls: Type[ServerBoundPacket], **fields) -> ServerBoundPacket:
+    """Construct a server-bound packet and set its decoded fields directly."""
+    packet = cls()
+    for key, value in fields.items():
+        setattr(packet, key, value)
+    return packet
+
+
+@dataclass
+class Frame:
+    """Decoded header of a client-bound frame."""
+
+    packet_id: int
+    ok: Optional[bool] = None          # PacketResult for response packets
+    reason: Optional[str] = None       # failure reason, if any
+    state: Optional[int] = None        # GameState discriminator for ChangeState
+    message_id: Optional[int] = None   # Message discriminator for MessagePacket
+
+    @property
+    def name(self) -> str:
+        return CLIENTBOUND_NAMES.get(self.packet_id, f"0x{self.packet_id:02X}")
+
+
+def decode_frame(data: bytes) -> Frame:
+    buf = ByteBuf(data)
+    frame = Frame(packet_id=buf.readUnsignedByte())
+    if frame.packet_id in _RESULT_IDS and buf.isReadable():
+        frame.ok = buf.readBoolean()
+        if not frame.ok and buf.isReadable():
+            try:
+                frame.reason = readString(buf, 4096)
+            except Exception:
+                frame.reason = None
+    elif frame.packet_id == CB_CHANGE_STATE and buf.isReadable():
+        frame.state = buf.readUnsignedByte()
+    elif frame.packet_id == CB_MESSAGE and buf.isReadable():
+        frame.message_id = buf.readUnsignedByte()
+    return frame
+
+
+class RequestFailed(Exception):
+    def __init__(self, name: str, reason: Optional[str]) -> None:
+        super().__init__(f"{name} failed: {reason}")
+        self.name = name
+        self.reason = reason
+
+
+LatencyRecorder = Callable[[str, float], None]
+
+
+class PhiraClient:
+    """An asyncio Phira client that pairs requests with their responses.
+
+    Responses of one type arrive in request order, so pending requests are
+    kept in a FIFO per response id. ``on_latency(name, seconds)`` is called
+    for every answered request; ``on_frame(frame, nbytes)`` for every frame.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        *,
+        on_latency: Optional[LatencyRecorder] = None,
+        on_frame: Optional[Callable[[Frame, int], None]] = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.on_latency = on_latency
+        self.on_frame = on_frame
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self._pending: Dict[int, Deque[Tuple[str, float, asyncio.Future]]] = defaultdict(deque)
+        self._state_waiters: List[Tuple[int, asyncio.Future]] = []
+        self._recv_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    async def connect(self, version: int = 1) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(bytes([version]))
+        await self.writer.drain()
+        self._recv_task = asyncio.create_task(self._recv_loop())
+
+    async def close(self) -> None:
+        if self._recv_task:
+            self._recv_task.cancel()
+        if self.writer is not None:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+        self._fail_pending(ConnectionError("client closed"))
+
+    async def send(self, packet: ServerBoundPacket) -> None:
+        """Fire-and-forget send (touches, judges)."""
+        data = encode(packet)
+        async with self._write_lock:
+            await write_message(self.writer, data)
+        self.bytes_sent += len(data)
+        self.packets_sent += 1
+
+    async def request(self, packet: ServerBoundPacket, *, timeout: float = 10.0) -> Frame:
+        """Send ``packet`` and wait for its response frame; raise on failure."""
+        response_id = RESPONSE_IDS[type(packet)]
+        name = type(packet).__name__.replace("ServerBound", "").replace("Packet", "")
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[response_id].append((name, time.perf_counter(), fut))
+        await self.send(packet)
+        frame = await asyncio.wait_for(fut, timeout)
+        if frame.ok is False:
+            raise RequestFailed(name, frame.reason)
+        return frame
+
+    def wait_state(self, state: int) -> asyncio.Future:
+        """Future resolved on the next ChangeState to ``state``. Create it before triggering."""
+        fut = asyncio.get_running_loop().create_future()
+        self._state_waiters.append((state, fut))
+        return fut
+
+    async def _recv_loop(self) -> None:
+        try:
+            while True:
+                data = await receive_message(self.reader)
+                now = time.perf_counter()
+                frame = decode_frame(data)
+                if self.on_frame:
+                    self.on_frame(frame, len(data))
+                queue = self._pending.get(frame.packet_id)
+                if queue:
+                    name, started, fut = queue.popleft()
+                    if self.on_latency:
+                        self.on_latency(name, now - started)
+                    if not fut.done():
+                        fut.set_result(frame)
+                if frame.state is not None and self._state_waiters:
+                    keep = []
+                    for state, fut in self._state_waiters:
+                        if state == frame.state and not fut.done():
+                            fut.set_result(frame)
+                        elif not fut.done():
+                            keep.append((state, fut))
+                    self._state_waiters = keep
+        except asyncio.CancelledError:
+            pass
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            self._fail_pending(e)
+
+    def _fail_pending(self, exc: BaseException) -> None:
+        for queue in self._pending.values():
+            while queue:
+                _, _, fut = queue.popleft()
+                if not fut.done():
+                    fut.set_exception(exc)
+        for _, fut in self._state_waiters:
+            if not fut.done():
+                fut.set_exception(exc)
+        self._state_waiters = []
@@ -0,0 +1,455 @@
+"""Deterministic simulation of room lifecycles.
+
+Replays randomized client behaviour (connect/authenticate, create, join,
+select, start, ready/cancel, played/abort, leave, disconnect mid-round,
+reconnect, plus a share of out-of-order "chaos" packets and chat) through
+``MainHandler`` and :mod:`utils.room` over the loopback transport.
+
+Everything is driven by one seeded RNG and a :class:`utils.clock.VirtualClock`
+(the auth TTL cache expires in virtual time, host transfer uses the seeded
+``utils.room.rng``), so a run is fully reproducible from its seed. The same
+clock drives a :class:`utils.timerwheel.TimerWheel` with the server's
+:class:`utils.timeouts.TimeoutManager` (ready / playing stall / max duration)
+and :class:`utils.resume.ResumeRegistry`, so players dropping mid-round have
+their slot held and either resume on reconnect or expire. After every
+operation (or every ``--check-every``) the world is checked against:
+
+- a user is in at most one room
+- every room has at least one member and its host is a member
+- ready/finished sets only contain members
+- every room member is online on an open connection, or disconnected with
+  a resume ticket for that room
+- no room holds more players than its limit, no more players are online
+  (held slots included) than the server-wide cap
+- no Playing room whose unfinished members are all disconnected lasts
+  longer than ``--stall-timeout`` + ``--resume-grace``
+
+On a violation the seed, operation index and the tail of the operation
+trace are printed and the exit status is 1.
+
+Usage::
+
+    python -m tools.simulate --ops 1000000 --clients 64 --seed 7
+    python -m tools.simulate --runs 20 --ops 50000      # seeds 1..20
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from rymc.phira.protocol.data.state import Playing, SelectChart, WaitForReady
+from rymc.phira.protocol.packet.serverbound import (
+    ServerBoundAbortPacket,
+    ServerBoundAuthenticatePacket,
+    ServerBoundCancelReadyPacket,
+    ServerBoundChatPacket,
+    ServerBoundCreateRoomPacket,
+    ServerBoundCycleRoomPacket,
+    ServerBoundJoinRoomPacket,
+    ServerBoundLeaveRoomPacket,
+    ServerBoundLockRoomPacket,
+    ServerBoundPlayedPacket,
+    ServerBoundReadyPacket,
+    ServerBoundRequestStartPacket,
+    ServerBoundSelectChartPacket,
+)
+from tools.bench_handlers import LocalFetcher, load_main
+from tools.phira_client import encode, make
+from utils import chat, clock, room_engine
+from utils import room as room_mod
+from utils.loopback import LoopbackConnection
+from utils.resume import DetachedConnection, ResumeRegistry
+from utils.timeouts import TimeoutManager, TimeoutPolicy
+from utils.timerwheel import TimerWheel
+
+
+class CountingFetcher(LocalFetcher):
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+
+    def get_user_info(self, token):
+        self.calls["me"] += 1
+        return super().get_user_info(token)
+
+    def get_chart_info(self, chartid):
+        self.calls["chart"] += 1
+        return super().get_chart_info(chartid)
+
+    def get_record_result(self, recordid):
+        self.calls["record"] += 1
+        return super().get_record_result(recordid)
+
+
+class SimClient:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.uid = 100000 + index      # 与 mock_api.user_for_token("lg-<n>") 一致
+        self.token = f"lg-{index}"
+        self.connection: Optional[LoopbackConnection] = None
+
+    def online(self, main) -> bool:
+        conn = self.connection
+        return conn is not None and not conn.is_closed() and main.online_user_list.get(self.uid) is conn
+
+
+class Simulation:
+    CHAOS_PACKETS = (
+        ServerBoundReadyPacket, ServerBoundCancelReadyPacket, ServerBoundRequestStartPacket,
+        ServerBoundAbortPacket, ServerBoundLeaveRoomPacket, ServerBoundPlayedPacket,
+        ServerBoundSelectChartPacket, ServerBoundLockRoomPacket, ServerBoundCycleRoomPacket,
+        ServerBoundChatPacket,
+    )
+
+    def __init__(self, main, args: argparse.Namespace, seed: int) -> None:
+        self.main = main
+        self.args = args
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.clock = clock.VirtualClock()
+        self.clients = [SimClient(i) for i in range(args.clients)]
+        self.trace: Deque[str] = deque(maxlen=args.trace)
+        self.ops: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.rooms_created = 0
+        self.next_room = 0
+        self.checks = 0
+        self.listing: list = []
+        self.listing_version = -1
+        self.orphaned: Dict[object, float] = {}     # Playing 房间 -> 未完成的成员全部断线的起始时间
+        self.fetcher = CountingFetcher()
+        self._reset_world()
+
+    def _reset_world(self) -> None:
+        main = self.main
+        clock.install(self.clock)
+        room_mod.rng.seed(self.seed)
+        room_mod.rooms.clear()
+        main.online_user_list.clear()
+        main.online_profiles.clear()
+        main.auth_cache.clear()
+        main.fetcher = self.fetcher
+        chat.limiter.clear()
+        room_mod.limits.room_default = self.args.room_max_users or None
+        room_mod.limits.online = self.args.max_online or None
+
+        # 与 main._main 相同的接线，只是时间轮由虚拟时钟驱动（step() 里 advance）
+        args = self.args
+        if main.timeouts is not None:
+            room_engine.remove_hook(main.timeouts.room_transition)
+        self.wheel = TimerWheel(clock=clock.monotonic)
+        main.timeouts = TimeoutManager(
+            self.wheel,
+            TimeoutPolicy(
+                auth_timeout=args.auth_timeout,
+                idle_timeout=args.idle_timeout,
+                ready_timeout=args.ready_timeout,
+                playing_stall_timeout=args.stall_timeout,
+                playing_max_duration=args.max_duration,
+            ),
+            on_auth_timeout=self._timer("auth", lambda connection: connection.close()),
+            on_idle=self._timer("idle", lambda connection: connection.close()),
+            on_ready_timeout=self._timer("ready", main.MainHandler.cancelStartByTimeout),
+            on_stalled=self._timer("stalled", lambda handler, roomId, user_id: (
+                handler or main.MainHandler(DetachedConnection(user_id), main.event_bus)).abortStalled(roomId, user_id)),
+        )
+        room_engine.add_hook(after=main.timeouts.room_transition)
+        main.resume_registry = ResumeRegistry(args.resume_grace, wheel=self.wheel)
+
+    def _timer(self, name: str, callback):
+        """包装超时回调：记入操作轨迹，异常按 handler 错误计数（时间轮自身只会记日志）"""
+        def fire(*args) -> None:
+            self.ops[f"timeout:{name}"] += 1
+            self.trace.append(f"t={self.clock.now():.2f} timeout {name} {args[1:] or args}")
+            try:
+                callback(*args)
+            except Exception as e:
+                self.errors[f"timeout:{name}:{type(e).__name__}"] += 1
+                self.trace.append(f"  timeout callback raised {e!r}")
+        return fire
+
+    def timeouts(self) -> Dict[str, int]:
+        return {key[len("timeout:"):]: n for key, n in sorted(self.ops.items()) if key.startswith("timeout:")}
+
+    # ---- operations -------------------------------------------------------
+
+    def _send(self, client: SimClient, packet) -> None:
+        name = type(packet).__name__[len("ServerBound"):-len("Packet")]
+        self.ops[name] += 1
+        self.trace.append(f"t={self.clock.now():.2f} uid={client.uid} {name} {self._describe(packet)}")
+        conn = client.connection
+        try:
+            conn.on_receive(encode(packet))
+        except Exception as e:
+            # 与 utils.server.Server 行为一致: handler 抛异常会断开该连接
+            self.errors[f"{name}:{type(e).__name__}"] += 1
+            conn.close()
+
+    @staticmethod
+    def _describe(packet) -> str:
+        for attr in ("roomId", "id", "lock", "cycle"):
+            value = getattr(packet, attr, None)
+            if value is not None:
+                return f"{attr}={value}"
+        return ""
+
+    def _connect(self, client: SimClient) -> None:
+        self.ops["connect"] += 1
+        conn = LoopbackConnection(name=f"sim{client.index}")
+        self.main.handle_connection(conn)
+        handler = conn.closeHandler
+
+        def _on_close() -> None:
+            try:
+                handler()
+            except Exception as e:
+                self.errors[f"disconnect:{type(e).__name__}"] += 1
+                self.trace.append(f"  disconnect handler raised {e!r}")
+
+        conn.on_close(_on_close)
+        client.connection = conn
+        self._send(client, make(ServerBoundAuthenticatePacket, token=client.token))
+
+    def _disconnect(self, client: SimClient) -> None:
+        self.ops["disconnect"] += 1
+        self.trace.append(f"t={self.clock.now():.2f} uid={client.uid} disconnect")
+        client.connection.close()
+
+    def step(self) -> None:
+        rng = self.rng
+        main = self.main
+        self.clock.advance(rng.expovariate(1.0 / self.args.mean_dt))
+        self.wheel.advance()
+        client = self.clients[rng.randrange(len(self.clients))]
+
+        if not client.online(main):
+            if client.connection is not None and not client.connection.is_closed():
+                self._disconnect(client)
+            self._connect(client)
+            return
+
+        roll = rng.random()
+        if roll < self.args.disconnect_rate:
+            self._disconnect(client)
+            return
+        if roll < self.args.disconnect_rate + self.args.chaos_rate:
+            cls = rng.choice(self.CHAOS_PACKETS)
+            fields = {}
+            if cls in (ServerBoundPlayedPacket, ServerBoundSelectChartPacket):
+                fields["id"] = rng.randint(1, 5000)
+            elif cls is ServerBoundLockRoomPacket:
+                fields["lock"] = rng.random() < 0.5
+            elif cls is ServerBoundCycleRoomPacket:
+                fields["cycle"] = rng.random() < 0.5
+            elif cls is ServerBoundChatPacket:
+                fields["message"] = f"hi {rng.randint(0, 99)}"
+            self._send(client, make(cls, **fields))
+            return
+
+        rid = room_mod.get_roomId(client.uid).get("roomId")
+        if rid is None:
+            if room_mod.rooms and rng.random() < 0.7:
+                rid = rng.choice(list(room_mod.rooms))
+                self._send(client, make(ServerBoundJoinRoomPacket, roomId=rid, monitor=False))
+            else:
+                rid = f"s{self.next_room}"
+                self.next_room += 1
+                before = len(room_mod.rooms)
+                self._send(client, make(ServerBoundCreateRoomPacket, roomId=rid))
+                if len(room_mod.rooms) > before:
+                    self.rooms_created += 1
+            return
+
+        room = room_mod.rooms[rid]
+        is_host = room.host == client.uid
+        if rng.random() < self.args.leave_rate:
+            self._send(client, make(ServerBoundLeaveRoomPacket))
+        elif isinstance(room.state, SelectChart):
+            if not is_host:
+                return
+            pick = rng.random()
+            if pick < 0.5:
+                self._send(client, make(ServerBoundSelectChartPacket, id=rng.randint(1, 5000)))
+            elif pick < 0.9:
+                self._send(client, make(ServerBoundRequestStartPacket))
+            elif pick < 0.95:
+                self._send(client, make(ServerBoundLockRoomPacket, lock=not room.locked))
+            else:
+                self._send(client, make(ServerBoundCycleRoomPacket, cycle=not room.cycle))
+        elif isinstance(room.state, WaitForReady):
+            if client.uid in room.ready and rng.random() < 0.2:
+                self._send(client, make(ServerBoundCancelReadyPacket))
+            elif client.uid not in room.ready:
+                self._send(client, make(ServerBoundReadyPacket))
+        elif isinstance(room.state, Playing):
+            if client.uid not in room.finished:
+                if rng.random() < 0.15:
+                    self._send(client, make(ServerBoundAbortPacket))
+                else:
+                    self._send(client, make(ServerBoundPlayedPacket, id=rng.randint(1, 10_000_000)))
+
+    # ---- invariants -------------------------------------------------------
+
+    def check(self) -> List[str]:
+        self.checks += 1
+        main = self.main
+        problems = []
+        seen: Dict[int, str] = {}
+        for rid, room in room_mod.rooms.items():
+            if not room.users:
+                problems.append(f"room {rid} is empty")
+            elif room.host not in room.users:
+                problems.append(f"room {rid} host {room.host} is not a member {list(room.users)}")
+            for uid, member in room.users.items():
+                if uid in seen:
+                    problems.append(f"user {uid} is in rooms {seen[uid]} and {rid}")
+                seen[uid] = rid
+                conn = member.connection
+                if isinstance(conn, DetachedConnection):
+                    ticket = main.resume_registry.ticket_of(uid)
+                    if ticket is None or ticket.room_id != rid:
+                        problems.append(f"user {uid} in room {rid} is disconnected without a resume ticket")
+                elif conn.is_closed() or main.online_user_list.get(uid) is not conn:
+                    problems.append(f"user {uid} in room {rid} is not online on its connection")
+            for name in ("ready", "finished"):
+                stray = set(getattr(room, name)) - set(room.users)
+                if stray:
+                    problems.append(f"room {rid} {name} has non-members {sorted(stray)}")
+            capacity = room_mod.room_capacity(room)
+            if capacity is not None and len(room.users) > capacity:
+                problems.append(f"room {rid} has {len(room.users)} players, limit {capacity}")
+        if room_mod.limits.online is not None and main.online_count() > room_mod.limits.online:
+            problems.append(f"{main.online_count()} players online (with held slots), cap {room_mod.limits.online}")
+        for ticket in main.resume_registry:
+            room = room_mod.rooms.get(ticket.room_id)
+            if ticket.room_id is not None and (room is None or ticket.user_id not in room.users):
+                problems.append(f"resume ticket of user {ticket.user_id} holds a slot in room {ticket.room_id} "
+                                f"that no longer has them")
+        problems.extend(self._check_orphaned())
+        if room_mod.rooms.members != seen:
+            problems.append(f"member index {room_mod.rooms.members} != {seen}")
+        # 房间索引（/metrics 的按状态计数、房间查询）是增量维护的，必须与重新计算的一致
+        expected: Dict[str, Dict] = {field: {} for field in room_mod.INDEXED}
+        for rid, room in room_mod.rooms.items():
+            keys = (type(room.state), room.chart, bool(room.locked), bool(room.live),
+                    room_mod.occupancy_bucket(len(room.users)))
+            for field, value in zip(room_mod.INDEXED, keys):
+                expected[field].setdefault(value, set()).add(rid)
+        for field in room_mod.INDEXED:
+            if room_mod.rooms.index[field] != expected[field]:
+                problems.append(f"room index {field} {room_mod.rooms.index[field]} != {expected[field]}")
+        # /room 的缓存以 rooms.version 为准：列表内容变了版本号就必须变
+        listing = sorted((str(rid), room.host, room.locked, room.cycle, type(room.state).__name__, room.chart,
+                          tuple(room.users)) for rid, room in room_mod.rooms.items())
+        if listing != self.listing and room_mod.rooms.version == self.listing_version:
+            problems.append(f"room listing changed without a version bump (version {self.listing_version})")
+        self.listing, self.listing_version = listing, room_mod.rooms.version
+        return problems
+
+    def _check_orphaned(self) -> List[str]:
+        # 断线保留位置的玩家不会再发包：卡死超时（从最后一个包算起）或保留期到期必有一个先结束他的这一局
+        now = self.clock.now()
+        limit = self.args.stall_timeout + self.args.resume_grace + self.wheel.resolution
+        problems = []
+        orphaned = {}
+        for rid, room in room_mod.rooms.items():
+            if not isinstance(room.state, Playing):
+                continue
+            pending = [member.connection for uid, member in room.users.items() if uid not in room.finished]
+            if pending and all(isinstance(conn, DetachedConnection) or conn.is_closed() for conn in pending):
+                since = orphaned[room] = self.orphaned.get(room, now)
+                if now - since > limit:
+                    problems.append(f"room {rid} has been Playing with only disconnected unfinished members "
+                                    f"for {now - since:.1f}s (limit {limit:.1f}s)")
+        self.orphaned = orphaned
+        return problems
+
+    def run(self) -> Tuple[int, List[str]]:
+        check_every = max(1, self.args.check_every)
+        for i in range(1, self.args.ops + 1):
+            self.step()
+            if i % check_every == 0:
+                problems = self.check()
+                if problems:
+                    return i, problems
+        return self.args.ops, self.check()
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Deterministic room lifecycle simulation")
+    parser.add_argument("--ops", type=int, default=200_000, help="operations per run")
+    parser.add_argument("--runs", type=int, default=1, help="independent runs with consecutive seeds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--mean-dt", type=float, default=2.0, help="mean virtual seconds between operations")
+    parser.add_argument("--disconnect-rate", type=float, default=0.02)
+    parser.add_argument("--leave-rate", type=float, default=0.03)
+    parser.add_argument("--chaos-rate", type=float, default=0.05, help="share of random out-of-order packets")
+    parser.add_argument("--check-every", type=int, default=1)
+    parser.add_argument("--room-max-users", type=int, default=8, help="default room player limit (0: none)")
+    parser.add_argument("--max-online", type=int, default=0, help="server-wide online cap (0: none)")
+    # 超时默认值按模拟的节奏放大（每个客户端平均 clients * mean-dt 秒才动作一次）；0 关闭
+    parser.add_argument("--auth-timeout", type=float, default=30.0)
+    parser.add_argument("--idle-timeout", type=float, default=0.0, help="simulated clients send no heartbeats")
+    parser.add_argument("--ready-timeout", type=float, default=300.0)
+    parser.add_argument("--stall-timeout", type=float, default=300.0, help="playing_stall_timeout")
+    parser.add_argument("--max-duration", type=float, default=1800.0, help="playing_max_duration")
+    parser.add_argument("--resume-grace", type=float, default=120.0, help="seconds a dropped player's slot is held")
+    parser.add_argument("--trace", type=int, default=40, help="operations kept for failure reports")
+    parser.add_argument("--show-errors", action="store_true", help="list handler exceptions by packet/type")
+    parser.add_argument("--log-level", default="critical")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list] = None) -> int:
+    args = parse_args(argv)
+    main_module = load_main(args.log_level)
+    total_ops = 0
+    total_rooms = 0
+    errors: Counter = Counter()
+    started = time.perf_counter()
+    try:
+        for seed in range(args.seed, args.seed + args.runs):
+            sim = Simulation(main_module, args, seed)
+            run_started = time.perf_counter()
+            done, problems = sim.run()
+            elapsed = time.perf_counter() - run_started
+            total_ops += done
+            total_rooms += sim.rooms_created
+            errors.update(sim.errors)
+            print(
+                f"seed {seed}: {done} ops in {elapsed:.2f}s ({done / elapsed:,.0f} ops/s), "
+                f"{sim.rooms_created} rooms, {sim.checks} checks, {sim.clock.now() / 3600:.1f}h virtual, "
+                f"api calls {dict(sim.fetcher.calls)}, handler errors {sum(sim.errors.values())}, "
+                f"timeouts {sim.timeouts()}, resume {main_module.resume_registry.stats}"
+            )
+            if problems:
+                print(f"\nINVARIANT VIOLATION (seed {seed}, op {done}):")
+                for problem in problems:
+                    print(f"  - {problem}")
+                print("last operations:")
+                for line in sim.trace:
+                    print(f"  {line}")
+                return 1
+    finally:
+        clock.reset()
+        if main_module.timeouts is not None:
+            room_engine.remove_hook(main_module.timeouts.room_transition)
+        main_module.timeouts = main_module.resume_registry = None
+
+    elapsed = time.perf_counter() - started
+    print(f"\ntotal: {total_ops:,} ops, {total_rooms:,} room lifecycles in {elapsed:.2f}s "
+          f"({total_ops / elapsed:,.0f} ops/s)")
+    if args.show_errors and errors:
+        print("handler errors:")
+        for key, count in errors.most_common():
+            print(f"  {key:<40}{count:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Replaceable time source.
+
+Core code that depends on elapsed time (the auth TTL cache, timers) reads
+:func:`monotonic` instead of calling :func:`time.monotonic` directly, so the
+simulation harness can ``install`` a :class:`VirtualClock` and step time
+deterministically.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Callable
+
+TimeSource = Callable[[], float]
+
+_source: TimeSource = time.monotonic
+
+
+def monotonic() -> float:
+    return _source()
+
+
+def install(source: TimeSource) -> None:
+    """Switch the global time source.
+
+    Anything that already stored deadlines from the previous source (e.g.
+    ``main.auth_cache``) should be cleared by the caller.
+    """
+    global _source
+    _source = source
+
+
+def reset() -> None:
+    install(time.monotonic)
+
+
+class VirtualClock:
+    """A manually advanced clock; calling the instance returns the current time."""
+
+    def __init__(self, start: float = 0.0) -> None:
+        self._now = float(start)
+
+    def __call__(self) -> float:
+        return self._now
+
+    def now(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float) -> float:
+        if seconds < 0:
+            raise ValueError("VirtualClock cannot go backwards")
+        self._now += seconds
+        return self._now
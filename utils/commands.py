@@ -50,6 +50,11 @@ class CommandRegistry:
         self._commands: Dict[str, Command] = {}
         # primary commands in registration order
         self._primary: Dict[str, Command] = {}
+        # utils.metrics.CallbackStats while command timing is on
+        self._stats = None
+
+    def set_profiling(self, stats) -> None:
+        self._stats = stats
 
     def register(self, cmd: Command) -> None:
         """Register command under name and aliases.
@@ -132,7 +137,10 @@ class CommandRegistry:
             return True
 
         try:
-            result = cmd.handler(ctx, args)
+            if self._stats is None:
+                result = cmd.handler(ctx, args)
+            else:
+                result = self._stats.call(self._stats.entry("command", cmd.owner, cmd.name), cmd.handler, ctx, args)
             # If handler returns an awaitable, schedule it.
             try:
                 import inspect
@@ -13,3 +13,10 @@ def get_port(key: str, default: int) -> int:
             return config.get(key, default)
     except FileNotFoundError:
         return default
+def get_value(key: str, default):
+    try:
+        with open("config.json", "r") as f:
+            config = json.load(f)
+            return config.get(key, default)
+    except FileNotFoundError:
+        return default
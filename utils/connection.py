@@ -1,32 +1,56 @@
 # 修改 connection.py
 import asyncio
 import logging
+from time import perf_counter_ns
 
 from utils.asyncioutil import write_message
+from utils.metrics import Traffic, metrics, totals
+from utils.packettrace import tracer
 from rymc.phira.protocol import PacketRegistry
 from rymc.phira.protocol.util import ByteBuf
 
 logger = logging.getLogger(__name__)
 
 class Connection:
+    __slots__ = ("writer", "reader", "receiver", "relay", "closeHandler", "write_queue", "_sender_task",
+                 "traffic", "room_traffic", "_sample_in", "_sample_out")
+
     def __init__(self, writer: asyncio.StreamWriter):
         self.writer = writer
+        # 由 Server 设置；多进程模式交接连接时需要取出其中尚未解析的字节
+        self.reader = None
         self.receiver = None
+        # 跨节点转发时设置：收到的原始帧直接交给它，不再解码（见 utils/directory.py）
+        self.relay = None
         self.closeHandler = None
+        # 收发计数；room_traffic 指向所在房间的计数（由 utils.room 在加入/离开时设置）
+        self.traffic = Traffic()
+        self.room_traffic = None
+        # 计时采样倒计数（见 utils/metrics.py），每个方向独立
+        self._sample_in = 1
+        self._sample_out = 1
         # 【新增】创建一个队列来管理发送任务
         self.write_queue = asyncio.Queue()
         # 【新增】启动一个后台任务专门负责发送
         self._sender_task = asyncio.create_task(self._send_loop())
+        self._sender_task.add_done_callback(self._drop_queued)
 
     # 【新增】发送循环，确保同一时间只有一个包写入 Socket
     async def _send_loop(self):
         try:
             while True:
-                # 等待队列中有数据
-                data = await self.write_queue.get()
+                # 等待队列中有数据；queued 为入队时间（仅被采样的包非 0）
+                data, queued = await self.write_queue.get()
+                totals.queued -= 1
                 # 写数据 (此时是串行的，不会冲突)
                 try:
-                    await write_message(self.writer, data)
+                    if queued:
+                        start = perf_counter_ns()
+                        metrics.record("queue", data[0], start - queued)
+                        await write_message(self.writer, data)
+                        metrics.record("flush", data[0], perf_counter_ns() - start)
+                    else:
+                        await write_message(self.writer, data)
                 except Exception as e:
                     logger.error(f"Error writing to socket: {e}")
                     self.close()
@@ -36,26 +60,82 @@ class Connection:
         except asyncio.CancelledError:
             pass  # 任务被取消，正常退出
 
+    def _drop_queued(self, _task):
+        # 发送任务结束后队列里剩下的包不会再发出（之后的 send 也不再入队），从积压计数中扣除
+        totals.queued -= self.write_queue.qsize()
+
     def send(self, packet):
         try:
-            data = PacketRegistry.encode(packet).toBytes()
-            if data[0] != 0x00:
-                logger.debug(f"Send packet: {data.hex()}")
-            
+            self._sample_out -= 1
+            if self._sample_out > 0 or not metrics.sample_every:
+                data = PacketRegistry.encode(packet).toBytes()
+                queued = 0
+            else:
+                self._sample_out = metrics.sample_every
+                start = perf_counter_ns()
+                data = PacketRegistry.encode(packet).toBytes()
+                queued = perf_counter_ns()
+                metrics.record("encode", data[0], queued - start)
+            if tracer.active:
+                tracer.trace(self, True, data)
+
             # 【修改】不再创建新任务，而是放入队列
-            self.write_queue.put_nowait(data)
+            self._enqueue(data, queued)
         except Exception as e:
             logger.error(f"Failed to enqueue packet: {e}")
 
+    def send_raw(self, data: bytes):
+        """发送已编码的包（跨节点中继转发的帧、broadcast 共用的编码结果）"""
+        if tracer.active:
+            tracer.trace(self, True, data)
+        self._enqueue(data, 0)
+
+    def _enqueue(self, data: bytes, queued: int):
+        if self._sender_task.done():
+            return
+        traffic = self.traffic
+        traffic.packets_out += 1
+        traffic.bytes_out += len(data)
+        room_traffic = self.room_traffic
+        if room_traffic is not None:
+            room_traffic.packets_out += 1
+            room_traffic.bytes_out += len(data)
+        totals.packets_out += 1
+        totals.bytes_out += len(data)
+        totals.queued += 1
+        self.write_queue.put_nowait((data, queued))
+
     def set_receiver(self, receiver):
         self.receiver = receiver
 
     def on_receive(self, data):
-        if data[0] != 0x00:
-            logger.debug(f"Receive packet: {data.hex()}")
+        traffic = self.traffic
+        traffic.packets_in += 1
+        traffic.bytes_in += len(data)
+        room_traffic = self.room_traffic
+        if room_traffic is not None:
+            room_traffic.packets_in += 1
+            room_traffic.bytes_in += len(data)
+        totals.packets_in += 1
+        totals.bytes_in += len(data)
+        if self.relay is not None:
+            self.relay(data)
+            return
+        if tracer.active:
+            tracer.trace(self, False, data)
         if self.receiver is None:
             return
-        self.receiver(PacketRegistry.decode(ByteBuf(data)))
+        self._sample_in -= 1
+        if self._sample_in > 0 or not metrics.sample_every:
+            self.receiver(PacketRegistry.decode(ByteBuf(data)))
+            return
+        self._sample_in = metrics.sample_every
+        start = perf_counter_ns()
+        packet = PacketRegistry.decode(ByteBuf(data))
+        decoded = perf_counter_ns()
+        self.receiver(packet)
+        metrics.record("decode", data[0], decoded - start)
+        metrics.record("handle", data[0], perf_counter_ns() - decoded)
 
     def is_closed(self):
         return self.writer.is_closing()
@@ -87,4 +167,27 @@ class Connection:
                 logger.error(f'[Connection] closeHandler exception: {e}')
 
     def on_close(self, close_handler):
-        self.closeHandler = close_handler
\ No newline at end of file
+        self.closeHandler = close_handler
+
+
+def broadcast(connections, packet, exclude=None) -> int:
+    """把同一个包发给多个连接：只编码一次，每个连接入队同一份字节。返回发送的连接数"""
+    data = None
+    sent = 0
+    for connection in connections:
+        if connection is exclude:
+            continue
+        send_raw = getattr(connection, "send_raw", None)
+        if send_raw is None:
+            # 替身连接（LoopbackConnection、DetachedConnection）自己处理包对象
+            connection.send(packet)
+        else:
+            if data is None:
+                try:
+                    data = PacketRegistry.encode(packet).toBytes()
+                except Exception as e:
+                    logger.error(f"Failed to encode broadcast packet: {e}")
+                    return sent
+            send_raw(data)
+        sent += 1
+    return sent
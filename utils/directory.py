@@ -0,0 +1,497 @@
+"""Room directory shared by several server processes or nodes.
+
+The directory is the only state that has to be global for rooms to work
+across processes:
+
+- rooms: room id -> node that hosts it (atomic create-if-absent, so room
+  ids stay unique cluster-wide);
+- presence: user id -> node the player is online on (or has a held resume
+  slot on);
+- nodes: node id -> address other nodes can reach its game port on.
+
+:class:`DirectoryState` holds it and answers JSON requests. It is served
+either in-process (several servers in one interpreter, e.g. tests) or by a
+:class:`DirectoryServer` over a TCP / Unix socket, one JSON object per
+line; ``python -m tools.directory_broker`` runs one. Everything a node
+registered is dropped when its broker connection goes away.
+
+:class:`DirectoryClient` is a node's view of the directory and doubles as
+the :data:`utils.room.room_directory` hook. Calls are short blocking round
+trips made from packet handlers, like the Phira API calls. The worker mode
+(:mod:`utils.workers`) uses the same protocol with the coordinator process
+as broker; :class:`NodeCluster` is the multi-machine variant, which cannot
+pass sockets between nodes and relays the connection instead.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from rymc.phira.protocol import PacketRegistry
+from rymc.phira.protocol.packet.serverbound import ServerBoundAuthenticatePacket, ServerBoundJoinRoomPacket
+from rymc.phira.protocol.util import ByteBuf, writeString
+from utils.asyncioutil import receive_message, write_message
+
+logger = logging.getLogger(__name__)
+
+_CALL_TIMEOUT = 5.0
+# 游戏循环上（packet handler 中）的目录请求最多等待这么久
+_LOOP_CALL_TIMEOUT = 0.3
+_MAX_BACKOFF = 30.0
+
+
+def parse_address(address: str):
+    """``"host:port"`` -> ``(host, port)``; ``"unix:/path"`` -> ``"/path"``."""
+    if address.startswith("unix:"):
+        return address[5:]
+    host, _, port = address.rpartition(":")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+# ---- shared state / broker ----------------------------------------------------
+
+
+class DirectoryState:
+    """Room ownership, presence and node addresses; requests are handled one at a time."""
+
+    def __init__(self) -> None:
+        self.rooms: Dict[str, Any] = {}
+        self.users: Dict[Any, Any] = {}
+        self.nodes: Dict[Any, Any] = {}
+
+    def register(self, node, address) -> None:
+        self.nodes[node] = address
+
+    def handle(self, node, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "claim_room":
+            owner = self.rooms.setdefault(request["room"], node)
+            return {"ok": owner == node, "owner": owner}
+        if op == "release_room":
+            if self.rooms.get(request["room"]) == node:
+                del self.rooms[request["room"]]
+            return {"ok": True}
+        if op == "room_owner":
+            return {"owner": self.rooms.get(request["room"])}
+        if op == "set_user":
+            previous = self.users.get(request["user"])
+            self.users[request["user"]] = node
+            return {"previous": previous}
+        if op == "drop_user":
+            if self.users.get(request["user"]) == node:
+                del self.users[request["user"]]
+            return {"ok": True}
+        if op == "user_count":
+            return {"users": len(self.users)}
+        if op == "user_node":
+            return {"node": self.users.get(request["user"])}
+        if op == "node_address":
+            return {"address": self.nodes.get(request["node"])}
+        if op == "stats":
+            per_node: Dict[Any, List[int]] = {n: [0, 0] for n in self.nodes}
+            for n in self.rooms.values():
+                per_node.setdefault(n, [0, 0])[0] += 1
+            for n in self.users.values():
+                per_node.setdefault(n, [0, 0])[1] += 1
+            return {"rooms": len(self.rooms), "users": len(self.users),
+                    "nodes": {str(k): {"rooms": v[0], "users": v[1]} for k, v in per_node.items()}}
+        return {"error": f"unknown op {op!r}"}
+
+    def forget_node(self, node) -> None:
+        """A node went away: everything it owned is gone with it."""
+        self.rooms = {k: v for k, v in self.rooms.items() if v != node}
+        self.users = {k: v for k, v in self.users.items() if v != node}
+        self.nodes.pop(node, None)
+
+
+class DirectoryServer:
+    """Serves a :class:`DirectoryState` to remote :class:`DirectoryClient`\\ s."""
+
+    def __init__(self, state: Optional[DirectoryState] = None) -> None:
+        self.state = state if state is not None else DirectoryState()
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self, address: Optional[str] = None, *, sock: Optional[socket.socket] = None) -> None:
+        if sock is not None:
+            if sock.family == socket.AF_UNIX:
+                self._server = await asyncio.start_unix_server(self._serve_node, sock=sock)
+            else:
+                self._server = await asyncio.start_server(self._serve_node, sock=sock)
+            return
+        target = parse_address(address)
+        if isinstance(target, str):
+            self._server = await asyncio.start_unix_server(self._serve_node, path=target)
+        else:
+            self._server = await asyncio.start_server(self._serve_node, target[0], target[1])
+        logger.info("Directory broker listening on %s", address)
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _serve_node(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        node = None
+        try:
+            hello = json.loads(await reader.readline())
+            node = hello["node"]
+            self.state.register(node, hello.get("address"))
+            logger.info("Node %s joined (address %s)", node, hello.get("address"))
+            writer.write(b'{"ok": true}\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.state.handle(node, json.loads(line))
+                except Exception as e:
+                    response = {"error": str(e)}
+                writer.write(json.dumps(response).encode() + b"\n")
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        except asyncio.CancelledError:
+            # 服务退出时被取消；不再向外抛出（3.11 的 start_server 回调会把它当作未处理异常打印）
+            pass
+        finally:
+            if node is not None:
+                self.state.forget_node(node)
+                logger.info("Node %s left", node)
+            writer.close()
+
+
+# ---- node side ------------------------------------------------------------------
+
+
+class DirectoryClient:
+    """A node's view of the directory, backed by a broker address or an in-process state.
+
+    Failures to reach the broker never raise into packet handlers: claims
+    are refused (room ids must stay unique) and lookups answer "not
+    elsewhere", so a node keeps serving its own rooms while the broker is
+    down. After a failed connect, calls fail at once for a back-off that
+    doubles up to ``_MAX_BACKOFF`` seconds instead of reconnecting on every
+    call. While :meth:`keepalive` runs it pings and reconnects from a worker
+    thread, and packet handlers never reconnect themselves, so an unreachable
+    (blackholed) broker does not stall the game loop. Calls from the loop
+    also give up after ``call_timeout`` seconds (waiting for the lock, the
+    connect and the reply together, default 0.3) and are then treated like
+    an unreachable broker, so a slow but connected broker cannot hold up
+    every player on the node either. After reconnecting, ``on_reconnect``
+    is called on the loop to re-register the node's rooms and players.
+    """
+
+    def __init__(self, node, *, broker: Optional[str] = None, state: Optional[DirectoryState] = None,
+                 address=None) -> None:
+        if (broker is None) == (state is None):
+            raise ValueError("exactly one of broker / state is required")
+        self.node = node
+        self.broker = broker
+        self.state = state
+        self.address = address
+        self.on_reconnect: Optional[Callable[[], None]] = None
+        self._lock = threading.RLock()
+        self._sock: Optional[socket.socket] = None
+        self._file = None
+        self._connected_once = False
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._background = False        # keepalive 正在后台线程中负责重连
+        self.call_timeout = _LOOP_CALL_TIMEOUT
+
+    def connect(self) -> None:
+        if self.state is not None:
+            self.state.register(self.node, self.address)
+            return
+        with self._lock:
+            self._open()
+
+    def _open(self, timeout: float = _CALL_TIMEOUT) -> bool:
+        """Connect and introduce this node; True when this was a reconnect (``on_reconnect`` is due)."""
+        target = parse_address(self.broker)
+        if isinstance(target, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(target)
+        else:
+            sock = socket.create_connection(target, timeout=timeout)
+        self._sock = sock
+        self._file = sock.makefile("rwb")
+        self._roundtrip({"node": self.node, "address": self.address}, timeout)
+        self._backoff = 0.0
+        reconnected, self._connected_once = self._connected_once, True
+        if reconnected:
+            logger.warning("Reconnected to directory broker %s", self.broker)
+        return reconnected
+
+    def _reconnected(self) -> None:
+        if self.on_reconnect is not None:
+            self.on_reconnect()
+
+    def _failed(self) -> None:
+        # 连接失败后退避：期间的调用直接失败，不再每次都等待连接超时
+        self._backoff = min(_MAX_BACKOFF, self._backoff * 2 or 1.0)
+        self._retry_at = time.monotonic() + self._backoff
+
+    def _roundtrip(self, request: Dict[str, Any], timeout: float = _CALL_TIMEOUT) -> Dict[str, Any]:
+        self._sock.settimeout(timeout)
+        self._file.write(json.dumps(request).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("directory broker went away")
+        return json.loads(line)
+
+    def _drop(self) -> None:
+        for closeable in (self._file, self._sock):
+            try:
+                if closeable is not None:
+                    closeable.close()
+            except OSError:
+                pass
+        self._file = self._sock = None
+
+    def _call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if self.state is not None:
+            return self.state.handle(self.node, request)
+        if self._file is None and (self._background or time.monotonic() < self._retry_at):
+            raise ConnectionError("directory broker unreachable")
+        deadline = time.monotonic() + self.call_timeout
+        # keepalive 线程可能正等着慢 broker 的回复：等不到锁时同样按不可达处理
+        if not self._lock.acquire(timeout=self.call_timeout):
+            raise ConnectionError("directory broker busy")
+        reconnected = False
+        try:
+            # 已有连接可能早已失效（broker 重启），失败时重连并重试一次；超时则不再重试
+            for retry in (self._file is not None, False):
+                try:
+                    if self._file is None:
+                        reconnected = self._open(max(0.01, deadline - time.monotonic()))
+                    response = self._roundtrip(request, max(0.01, deadline - time.monotonic()))
+                    break
+                except OSError as e:
+                    # 超时后连接上可能还有迟到的回复，只能断开
+                    self._drop()
+                    if not retry or isinstance(e, socket.timeout):
+                        self._failed()
+                        raise ConnectionError(f"directory broker unreachable: {e}") from e
+        finally:
+            self._lock.release()
+        if reconnected:
+            self._reconnected()
+        return response
+
+    def _ping(self) -> bool:
+        """Keepalive round trip, run in a worker thread; True when it reconnected."""
+        if self._file is None and time.monotonic() < self._retry_at:
+            return False
+        with self._lock:
+            try:
+                reconnected = self._open() if self._file is None else False
+                self._roundtrip({"op": "ping"})
+                return reconnected
+            except OSError as e:
+                self._drop()
+                self._failed()
+                logger.warning("Directory broker %s unreachable, retrying in %.0fs: %s", self.broker, self._backoff, e)
+                return False
+
+    async def keepalive(self, interval: float = 2.0) -> None:
+        """Ping the broker so a restarted one gets this node's state back within ``interval``."""
+        if self.state is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._background = True
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if await loop.run_in_executor(None, self._ping):
+                    self._reconnected()
+        finally:
+            self._background = False
+
+    # -- directory (also the utils.room.room_directory hook) --
+
+    def claim(self, room_id) -> bool:
+        """Atomic create-if-absent of ``room_id`` for this node."""
+        try:
+            return self._call({"op": "claim_room", "room": room_id})["ok"]
+        except ConnectionError as e:
+            logger.warning("Refusing to create room %s: %s", room_id, e)
+            return False
+
+    def release(self, room_id) -> None:
+        self._try({"op": "release_room", "room": room_id})
+
+    def room_owner(self, room_id):
+        return (self._try({"op": "room_owner", "room": room_id}) or {}).get("owner")
+
+    def user_online(self, user_id):
+        return (self._try({"op": "set_user", "user": user_id}) or {}).get("previous")
+
+    def user_offline(self, user_id) -> None:
+        self._try({"op": "drop_user", "user": user_id})
+
+    def user_node(self, user_id):
+        return (self._try({"op": "user_node", "user": user_id}) or {}).get("node")
+
+    def online_count(self) -> Optional[int]:
+        """Players online (or holding a resume slot) on all nodes; None while the broker is unreachable."""
+        return (self._try({"op": "user_count"}) or {}).get("users")
+
+    def node_address(self, node):
+        return (self._try({"op": "node_address", "node": node}) or {}).get("address")
+
+    def cluster_stats(self) -> Dict[str, Any]:
+        return self._call({"op": "stats"})
+
+    def _try(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            return self._call(request)
+        except ConnectionError as e:
+            logger.warning("Directory %s failed: %s", request.get("op"), e)
+            return None
+
+    def close(self) -> None:
+        if self.state is not None:
+            self.state.forget_node(self.node)
+            return
+        with self._lock:
+            self._drop()
+
+
+# ---- cross-node relay -------------------------------------------------------------
+
+
+_SERVERBOUND_IDS = {cls: pid for pid, cls in PacketRegistry._client_bound_packet_map.items()}
+_CB_AUTHENTICATE = 0x01
+
+
+def _encode_authenticate(token: str) -> bytes:
+    buf = ByteBuf()
+    buf.writeByte(_SERVERBOUND_IDS[ServerBoundAuthenticatePacket])
+    writeString(buf, token or "")
+    return buf.toBytes()
+
+
+def _encode_join(room_id: str, monitor: bool) -> bytes:
+    buf = ByteBuf()
+    buf.writeByte(_SERVERBOUND_IDS[ServerBoundJoinRoomPacket])
+    writeString(buf, room_id)
+    buf.writeBoolean(bool(monitor))
+    return buf.toBytes()
+
+
+class _Relay:
+    """Pipes a client connection to another node, frame by frame.
+
+    The upstream connection is opened as a fresh client: version byte, then
+    the login of the player (its answer is swallowed, the client already
+    saw its own), then the replayed request, whose answer goes back to the
+    client as usual.
+    """
+
+    __slots__ = ("connection", "outbox", "swallow_auth", "task")
+
+    def __init__(self, connection, swallow_auth: bool) -> None:
+        self.connection = connection
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.swallow_auth = swallow_auth
+        self.task: Optional[asyncio.Task] = None
+
+    def forward(self, data: bytes) -> None:
+        self.outbox.put_nowait(data)
+
+    def close(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    async def run(self, address: Tuple[str, int], version: int, frames: List[bytes], stats: Dict[str, int]) -> None:
+        writer = None
+        pump = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(address[0], address[1]), _CALL_TIMEOUT)
+            writer.write(bytes([version]))
+            for frame in frames:
+                await write_message(writer, frame)
+            pump = asyncio.create_task(self._pump(writer))
+            stats["relay_open"] += 1
+            while True:
+                frame = await receive_message(reader)
+                if self.swallow_auth and frame[0] == _CB_AUTHENTICATE:
+                    self.swallow_auth = False
+                    if len(frame) < 2 or not frame[1]:
+                        logger.warning("Relay login rejected by %s", address)
+                        break
+                    continue
+                self.connection.send_raw(frame)
+        except asyncio.CancelledError:
+            pass
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            if pump is None:
+                stats["relay_failed"] += 1
+                logger.warning("Cannot relay to %s: %s", address, e)
+        finally:
+            if pump is not None:
+                pump.cancel()
+                stats["relay_open"] -= 1
+            if writer is not None:
+                writer.close()
+            self.connection.close()
+
+    async def _pump(self, writer: asyncio.StreamWriter) -> None:
+        while True:
+            await write_message(writer, await self.outbox.get())
+
+
+class NodeCluster(DirectoryClient):
+    """A standalone node in a multi-machine cluster.
+
+    A connection that has to move to another node (joining a room hosted
+    there, or logging in while still present there) is relayed: this node
+    keeps the client socket and opens a connection to the owner's game
+    port, replaying the player's login and the request.
+    """
+
+    def __init__(self, node, address: Tuple[str, int], *, broker: Optional[str] = None,
+                 state: Optional[DirectoryState] = None) -> None:
+        super().__init__(node, broker=broker, state=state, address=list(address))
+        self.stats: Dict[str, int] = {"relayed": 0, "relay_open": 0, "relay_failed": 0}
+
+    def hand_off(self, connection, node, payload: Dict[str, Any]) -> None:
+        """Relay ``connection`` (a :class:`utils.connection.Connection`) to ``node``.
+
+        Must be called from the packet handler; frames the client sends from
+        now on are queued for the owner instead of being handled here.
+        """
+        from utils.server import SUPPORTED_VERSIONS
+
+        user = payload.get("user")
+        replay = payload["replay"]
+        frames = []
+        if user is not None:
+            frames.append(_encode_authenticate(user["token"]))
+        if replay["packet"] == "authenticate":
+            frames.append(_encode_authenticate(replay["token"]))
+        else:
+            frames.append(_encode_join(replay["roomId"], replay["monitor"]))
+
+        relay = _Relay(connection, swallow_auth=user is not None)
+        connection.relay = relay.forward
+        connection.on_close(relay.close)
+        address = self.node_address(node)
+        if not address:
+            logger.warning("Node %s has no address, closing connection", node)
+            self.stats["relay_failed"] += 1
+            connection.close()
+            return
+        self.stats["relayed"] += 1
+        relay.task = asyncio.get_running_loop().create_task(
+            relay.run(tuple(address), SUPPORTED_VERSIONS[0], frames, self.stats))
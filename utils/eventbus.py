@@ -27,10 +27,19 @@ class EventBus:
     - Supports sync and async callbacks.
     - Async callbacks are scheduled via asyncio.create_task.
     - Exceptions are caught and logged, never leaking into core logic.
+    - Optional per-subscriber timing (``set_profiling``); when off, handlers
+      are invoked without any measuring code in the path.
     """
 
     def __init__(self) -> None:
         self._subs: Dict[str, List[Subscription]] = {}
+        self._stats = None
+        self._invoke = self._safe_invoke
+
+    def set_profiling(self, stats) -> None:
+        """Time every handler call into ``stats`` (a :class:`utils.metrics.CallbackStats`); None turns it off."""
+        self._stats = stats
+        self._invoke = self._safe_invoke if stats is None else self._profiled_invoke
 
     def on(self, event: str, callback: Callback, *, owner: Any = None) -> Subscription:
         sub = Subscription(event=event, callback=callback, owner=owner, once=False)
@@ -67,7 +76,18 @@ class EventBus:
             if sub.once:
                 # remove first to prevent re-entrance duplications
                 self.off(sub)
-            self._safe_invoke(sub, payload)
+            self._invoke(sub, payload)
+
+    def emit_owner(self, owner: Any, event: str, **payload: Any) -> None:
+        """Emit ``event`` to the subscriptions of ``owner`` only.
+
+        Used to replay an event that already happened (e.g. ``commands.init``)
+        to a plugin loaded after it.
+        """
+        for sub in [s for s in self._subs.get(event, []) if s.owner == owner]:
+            if sub.once:
+                self.off(sub)
+            self._invoke(sub, payload)
 
     def _safe_invoke(self, sub: Subscription, payload: Dict[str, Any]) -> None:
         try:
@@ -79,6 +99,14 @@ class EventBus:
         except Exception:
             logger.exception("[EventBus] Error in handler for event=%s callback=%r", sub.event, sub.callback)
 
+    def _profiled_invoke(self, sub: Subscription, payload: Dict[str, Any]) -> None:
+        try:
+            result = self._stats.call(self._stats.entry("event", sub.owner, sub.event), sub.callback, **payload)
+            if inspect.isawaitable(result):
+                asyncio.create_task(self._await_and_log(result, sub))
+        except Exception:
+            logger.exception("[EventBus] Error in handler for event=%s callback=%r", sub.event, sub.callback)
+
     async def _await_and_log(self, aw: Awaitable[Any], sub: Subscription) -> None:
         try:
             await aw
@@ -0,0 +1,167 @@
+"""Directory change notification via Linux inotify (ctypes, no extra deps).
+
+:class:`DirWatcher` watches one directory and hands the names of changed
+entries to a callback on the event loop. The inotify descriptor is
+registered with ``loop.add_reader``, so an idle server does not wake up
+at all. A change shows up as soon as the kernel reports it rather than on
+the next poll.
+
+Editors and ``cp`` write a file in several steps (truncate, several
+writes, close; or write a temp file and rename it over). Events are
+collected until none has arrived for ``debounce`` seconds, and then the
+set of changed names is delivered once. The callback gets ``None``
+instead of names when events were lost (kernel queue overflow) or the
+directory itself went away; the caller should rescan everything then. In
+the latter case the watcher is closed (``closed`` is True).
+
+:meth:`DirWatcher.start` returns False where inotify is unavailable
+(non-Linux, no libc symbol, watch limit reached); callers fall back to
+polling.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+from pathlib import Path
+from typing import Callable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[len]; }
+_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                if hasattr(libc, "inotify_init1") and hasattr(libc, "inotify_add_watch"):
+                    _libc = libc
+            except OSError:
+                pass
+    return _libc or None
+
+
+def parse_events(buf: bytes):
+    """``(mask, name)`` for every event in a ``read()`` of the inotify descriptor."""
+    offset = 0
+    while offset + _EVENT.size <= len(buf):
+        _wd, mask, _cookie, length = _EVENT.unpack_from(buf, offset)
+        offset += _EVENT.size
+        name = buf[offset:offset + length].split(b"\0", 1)[0]
+        offset += length
+        yield mask, os.fsdecode(name)
+
+
+class DirWatcher:
+    def __init__(self, path: Path, callback: Callable[[Optional[Set[str]]], None], *, debounce: float = 0.2,
+                 suffix: str = "") -> None:
+        self.path = Path(path)
+        self.callback = callback
+        self.debounce = debounce
+        self.suffix = suffix        # 只关心以此结尾的文件名（"" 表示全部）
+        self.closed = True
+        self._fd = -1
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Set[str] = set()
+        self._rescan = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> bool:
+        """Start watching (on the running loop); False when inotify cannot be used here."""
+        libc = _load_libc()
+        if libc is None:
+            return False
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning("inotify_init1 failed: %s", os.strerror(ctypes.get_errno()))
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(str(self.path)), WATCH_MASK) < 0:
+            logger.warning("inotify_add_watch %s failed: %s", self.path, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return False
+        self._fd = fd
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(fd, self._on_readable)
+        self.closed = False
+        return True
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._fd = -1
+
+    def _on_readable(self) -> None:
+        lost = False
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            for mask, name in parse_events(buf):
+                if mask & IN_Q_OVERFLOW:
+                    self._rescan = True
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    lost = True
+                elif name and name.endswith(self.suffix):
+                    self._changed.add(name)
+        if lost:
+            # 目录本身被删除/移走：监视已失效，交给调用方全量扫描后改用轮询
+            logger.warning("Watched directory %s went away", self.path)
+            self.close()
+            self._changed.clear()
+            self._rescan = False
+            try:
+                self.callback(None)
+            except Exception:
+                logger.exception("Directory watch callback failed")
+            return
+        if self._changed or self._rescan:
+            # 连续写入时不断推迟，静默 debounce 秒后才整体交付一次
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._flush_handle = self._loop.call_later(self.debounce, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        changed, self._changed = self._changed, set()
+        rescan, self._rescan = self._rescan, False
+        try:
+            self.callback(None if rescan else changed)
+        except Exception:
+            logger.exception("Directory watch callback failed")
@@ -0,0 +1,81 @@
+"""Hot restart: re-exec the server without closing the listening socket.
+
+The old process duplicates its listening socket as an inheritable fd, writes
+the room snapshot (:mod:`utils.snapshot`) and ``execve``\\ s itself with two
+environment variables:
+
+- ``PYPHIRA_LISTEN_FD``: the inherited listening socket. Connection attempts
+  made during the restart wait in the kernel backlog instead of being
+  refused.
+- ``PYPHIRA_SNAPSHOT``: path of the snapshot to restore.
+
+Where fds cannot be inherited (Windows) the new process binds again as
+before; the snapshot is still carried over.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import sys
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+LISTEN_FD_ENV = "PYPHIRA_LISTEN_FD"
+SNAPSHOT_ENV = "PYPHIRA_SNAPSHOT"
+
+
+def supported() -> bool:
+    return os.name == "posix"
+
+
+def inherited_socket() -> Optional[socket.socket]:
+    """The listening socket handed over by the previous process, if any (consumes the env var)."""
+    value = os.environ.pop(LISTEN_FD_ENV, None)
+    if not value:
+        return None
+    try:
+        sock = socket.socket(fileno=int(value))
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring inherited listening fd %r: %s", value, e)
+        return None
+    if sock.type != socket.SOCK_STREAM:
+        logger.warning("Inherited fd %s is not a stream socket, ignoring", value)
+        sock.detach()
+        return None
+    sock.set_inheritable(False)
+    sock.setblocking(False)
+    logger.info("Reusing listening socket %s from previous process", sock.getsockname())
+    return sock
+
+
+def inherited_snapshot() -> Optional[str]:
+    return os.environ.pop(SNAPSHOT_ENV, None) or None
+
+
+def keep_listener(listen_sock) -> Optional[int]:
+    """Duplicate the listening socket as an inheritable fd.
+
+    Must be called before the server is stopped (stopping closes the
+    original); the duplicate keeps the port bound and its backlog alive.
+    """
+    if listen_sock is None or not supported():
+        return None
+    fd = os.dup(listen_sock.fileno())
+    os.set_inheritable(fd, True)
+    return fd
+
+
+def exec_self(listen_fd: Optional[int] = None, snapshot_path: Optional[str] = None) -> None:
+    """Replace this process with a fresh copy of the server; does not return."""
+    env = dict(os.environ)
+    env.pop(LISTEN_FD_ENV, None)
+    env.pop(SNAPSHOT_ENV, None)
+    if listen_fd is not None:
+        env[LISTEN_FD_ENV] = str(listen_fd)
+    if snapshot_path:
+        env[SNAPSHOT_ENV] = os.path.abspath(snapshot_path)
+    logging.shutdown()
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
@@ -0,0 +1,71 @@
+"""Logging off the event loop.
+
+The root logger gets a single :class:`QueueHandler`; a
+:class:`logging.handlers.QueueListener` thread does the formatting and the
+console / file writes. Logging from a packet handler only interpolates the
+message and appends the record to a queue; a slow disk never stalls the
+loop.
+
+Forked workers (:mod:`utils.workers`) get their own listener thread, since
+threads do not survive ``fork``. ``logging.shutdown()`` (also called before
+a hot restart's ``execve``) drains the queue first.
+"""
+
+from __future__ import annotations
+
+import logging
+import logging.handlers
+import os
+import queue
+from typing import List, Optional
+
+_handler: Optional["QueueHandler"] = None
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread; stopping it drains the queue."""
+
+    def __init__(self, handlers: List[logging.Handler]) -> None:
+        super().__init__(queue.SimpleQueue())
+        self.targets = handlers
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        self.listener = logging.handlers.QueueListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只在调用方线程完成参数插值（参数可能是随后会被修改的对象），格式化交给监听线程
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def close(self) -> None:
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+        super().close()
+
+    def _after_fork(self) -> None:
+        # 子进程中没有监听线程，队列的内部锁也可能处于被持有的状态：换一个新队列重新启动
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self.start()
+
+
+def setup(level: int, handlers: List[logging.Handler], fmt: str, datefmt: Optional[str] = None) -> QueueHandler:
+    """Route the root logger through a queue to ``handlers``."""
+    global _handler
+    formatter = logging.Formatter(fmt, datefmt=datefmt)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    _handler = QueueHandler(handlers)
+    _handler.start()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=lambda: _handler is not None and _handler._after_fork())
+    return _handler
@@ -0,0 +1,70 @@
+"""Run code on the game loop from another thread.
+
+Game state (``rooms``, ``online_user_list``, the security store ...) is only
+ever touched from the game loop. A service running on its own event loop
+thread (``http_api`` with ``HTTP_API_MODE=thread``) hands every action that
+reads live state or changes it to :meth:`LoopBridge.run`. The call goes into a
+command queue, and the game loop drains the queue in one callback per
+wake-up. The caller awaits the result on its own loop.
+
+When the caller already is on the game loop, ``run`` calls the function
+directly, so code can be written once for both modes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Callable, Deque, Tuple
+
+logger = logging.getLogger(__name__)
+
+_Command = Tuple[Callable[..., Any], tuple, concurrent.futures.Future]
+
+
+class LoopBridge:
+    def __init__(self, loop: asyncio.AbstractEventLoop, *, timeout: float = 10.0) -> None:
+        self.loop = loop
+        self.timeout = timeout
+        self.executed = 0
+        self._commands: Deque[_Command] = collections.deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    @property
+    def pending(self) -> int:
+        return len(self._commands)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run ``fn(*args)`` on the game loop and return its result (exceptions propagate)."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.executed += 1
+            return fn(*args)
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._lock:
+            self._commands.append((fn, args, future))
+            wake = not self._scheduled
+            self._scheduled = True
+        if wake:
+            self.loop.call_soon_threadsafe(self._drain)
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    def _drain(self) -> None:
+        with self._lock:
+            commands, self._commands = self._commands, collections.deque()
+            self._scheduled = False
+        for fn, args, future in commands:
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.executed += 1
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
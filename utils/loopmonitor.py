@@ -0,0 +1,169 @@
+"""Event-loop lag monitor with a stack-capturing watchdog.
+
+A task sleeps ``interval`` seconds in a loop and records how late it wakes
+up (the scheduling lag) into a :class:`utils.metrics.Histogram`. Anything
+that blocks the loop, such as a synchronous Phira API call, a slow plugin
+callback or file I/O in a handler, shows up as lag.
+
+A watchdog thread checks the task's heartbeat. When the loop has not come
+back for longer than ``threshold`` seconds, the thread captures the loop
+thread's current stack with :func:`sys._current_frames`, while the
+blocking call is still running. The stack is logged and kept with the
+stall record; once the loop comes back the stall gets its total duration.
+
+Shown by the console ``/status`` and ``GET /admin/loop`` of ``http_api``.
+Both threads add to ``stalls``; readers take a copy via :meth:`recent`
+(``http_api`` may call :meth:`report` from its own thread).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from utils.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# 保存的栈帧层数（从最内层起）
+_STACK_DEPTH = 25
+
+
+class Stall:
+    __slots__ = ("started", "duration", "stack")
+
+    def __init__(self, started: float, duration: float, stack: Optional[List[str]]) -> None:
+        self.started = started          # wall clock (time.time)
+        self.duration = duration        # seconds; grows until the loop comes back
+        self.stack = stack
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "duration_ms": round(self.duration * 1000, 1),
+            "stack": self.stack,
+        }
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, keep: int = 20) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = Histogram()
+        self.stalls: Deque[Stall] = deque(maxlen=keep)
+        self._stalls_lock = threading.Lock()
+        self.stall_count = 0
+        self._beat = time.monotonic()
+        self._pending: Optional[Stall] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    # -- lifecycle --
+
+    def start(self) -> None:
+        """Start measuring on the running loop (and the watchdog, if ``threshold`` > 0)."""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        if self.threshold > 0:
+            self._stop.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # -- loop side --
+
+    async def _run(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - before - self.interval)
+            self._beat = now
+            self.lag.record(int(lag * 1e9))
+            if self.threshold > 0 and lag >= self.threshold:
+                self._stalled(lag)
+
+    def _stalled(self, lag: float) -> None:
+        # 看门狗可能已经抓到了这次卡顿的栈；这里补上最终时长
+        stall, self._pending = self._pending, None
+        if stall is None:
+            stall = Stall(time.time() - lag, lag, None)
+            with self._stalls_lock:
+                self.stalls.append(stall)
+        stall.duration = lag
+        self.stall_count += 1
+        logger.warning("Event loop blocked for %.0f ms", lag * 1000)
+
+    # -- watchdog thread --
+
+    def _watch(self) -> None:
+        captured_beat = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == captured_beat:
+                continue
+            captured_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = [line.rstrip() for line in traceback.format_stack(frame)[-_STACK_DEPTH:]]
+            del frame
+            stall = Stall(time.time() - blocked, blocked, stack)
+            self._pending = stall
+            with self._stalls_lock:
+                self.stalls.append(stall)
+            logger.warning("Event loop blocked for over %.0f ms, loop thread is at:\n%s",
+                           blocked * 1000, "\n".join(stack))
+
+    # -- reporting --
+
+    def recent(self) -> List[Stall]:
+        """Copy of the kept stalls, oldest first (safe from any thread)."""
+        with self._stalls_lock:
+            return list(self.stalls)
+
+    def report(self) -> Dict[str, Any]:
+        summary = self.lag.summary()
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag": {k.replace("_us", "_ms"): (round(v / 1000, 3) if k.endswith("_us") else v)
+                    for k, v in summary.items()},
+            "stalls": self.stall_count,
+            "recent": [s.as_dict() for s in reversed(self.recent())],
+        }
+
+    def status_lines(self) -> List[str]:
+        s = self.lag.summary()
+        if not s["count"]:
+            return ["事件循环延迟: 暂无数据"]
+        lines = [
+            f"事件循环延迟: p50 {s['p50_us'] / 1000:.2f} ms, p99 {s['p99_us'] / 1000:.2f} ms, "
+            f"max {s['max_us'] / 1000:.1f} ms ({s['count']} 次采样)",
+            f"卡顿次数 (>= {self.threshold * 1000:.0f} ms): {self.stall_count}",
+        ]
+        stalls = self.recent()
+        if stalls:
+            last = stalls[-1]
+            lines.append(f"最近一次卡顿: {last.as_dict()['at']}, {last.duration * 1000:.0f} ms")
+            if last.stack:
+                lines.extend("  " + line.replace("\n", "\n  ") for line in last.stack[-6:])
+        return lines
+
+
+monitor = LoopMonitor()
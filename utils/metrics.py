@@ -0,0 +1,420 @@
+"""Where time goes in the packet pipeline.
+
+Every connection counts packets and bytes in both directions, and so does
+the room it is currently in (:class:`Traffic`, plain integer increments).
+
+Timing is sampled: every ``sample_every``-th packet a connection handles
+(per direction) is timed through the stages of the pipeline and recorded
+into fixed-size log-bucketed histograms per stage and packet type:
+
+- ``decode``  bytes -> server-bound packet object
+- ``handle``  the packet handler (synchronous part)
+- ``encode``  client-bound packet object -> bytes
+- ``queue``   time the encoded packet waits in the connection's write queue
+- ``flush``   socket write + drain (includes waiting on a slow client)
+
+:class:`Histogram` keeps 4 buckets per power of two of nanoseconds
+(quantiles within 25%, from 1 ns to ~18 min) in a flat list, so memory
+never grows with traffic. Exposed through the console ``/perf`` command and
+``GET /admin/perf`` of the ``http_api`` plugin.
+
+Server-wide :data:`totals` (connections, queued packets, traffic) and named
+:class:`CacheStats` are plain counters updated where things happen; the
+``GET /metrics`` endpoint renders them with :class:`Exposition`.
+
+:data:`callbacks` times event bus subscribers and console commands per
+``(owner, event)`` when switched on (``plugin_profiling`` in
+``config.json``, console ``/plugins stats on``, ``POST
+/admin/plugins/stats``). While it is off, the bus and the command
+registry call handlers exactly as before.
+"""
+
+from __future__ import annotations
+
+import time
+import types
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.packettrace import IN_NAMES, OUT_NAMES
+
+_SUB = 4
+_BUCKETS = 40 * _SUB
+
+
+def _bucket(ns: int) -> int:
+    if ns < _SUB:
+        return max(ns, 0)
+    e = ns.bit_length() - 1
+    index = e * _SUB + ((ns >> (e - 2)) & (_SUB - 1))
+    return index if index < _BUCKETS else _BUCKETS - 1
+
+
+def _upper(index: int) -> int:
+    """Largest value that falls into bucket ``index``."""
+    if index < _SUB:
+        return index
+    e, sub = divmod(index, _SUB)
+    return ((_SUB + sub + 1) << (e - 2)) - 1
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns: int) -> None:
+        self.counts[_bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def quantile(self, q: float) -> int:
+        """Upper bound of the bucket holding the ``q`` quantile, in ns."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(_upper(index), self.max)
+        return self.max
+
+    def merge(self, other: "Histogram") -> None:
+        for index, n in enumerate(other.counts):
+            if n:
+                self.counts[index] += n
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def summary(self) -> Dict[str, Any]:
+        """Microsecond summary (``count`` is the number of samples)."""
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count / 1000, 2),
+            "p50_us": round(self.quantile(0.5) / 1000, 2),
+            "p90_us": round(self.quantile(0.9) / 1000, 2),
+            "p99_us": round(self.quantile(0.99) / 1000, 2),
+            "max_us": round(self.max / 1000, 2),
+        }
+
+
+class Traffic:
+    __slots__ = ("packets_in", "packets_out", "bytes_in", "bytes_out")
+
+    def __init__(self) -> None:
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"packets_in": self.packets_in, "packets_out": self.packets_out,
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+
+class Totals(Traffic):
+    """Server-wide counters kept up to date by :class:`utils.connection.Connection`
+    and :class:`utils.server.Server`, so reading them never walks connections."""
+
+    __slots__ = ("connections", "queued")
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.connections = 0    # open client connections
+        self.queued = 0         # encoded packets waiting in write queues
+
+
+class CacheStats:
+    __slots__ = ("hits", "misses")
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def ratio(self) -> float:
+        looked = self.hits + self.misses
+        return self.hits / looked if looked else 0.0
+
+
+caches: Dict[str, CacheStats] = {}
+
+
+def cache_stats(name: str) -> CacheStats:
+    """Hit/miss counters of a named cache (shared by every caller using the name)."""
+    stats = caches.get(name)
+    if stats is None:
+        stats = caches[name] = CacheStats()
+    return stats
+
+
+STAGES = ("decode", "handle", "encode", "queue", "flush")
+_INBOUND_STAGES = ("decode", "handle")
+
+
+class PipelineMetrics:
+    """Sampled stage histograms by ``(stage, packet id)``.
+
+    ``sample_every = 0`` turns timing off; the traffic counters stay on.
+    Connections decide whether to time a packet with their own countdown
+    (see :class:`utils.connection.Connection`), so a quiet connection is
+    sampled as often as a busy one.
+    """
+
+    def __init__(self, sample_every: int = 16) -> None:
+        self.sample_every = sample_every
+        self.stages: Dict[str, Dict[int, Histogram]] = {stage: {} for stage in STAGES}
+
+    def record(self, stage: str, packet_id: int, ns: int) -> None:
+        histograms = self.stages[stage]
+        histogram = histograms.get(packet_id)
+        if histogram is None:
+            histogram = histograms[packet_id] = Histogram()
+        histogram.record(ns)
+
+    def reset(self) -> None:
+        self.stages = {stage: {} for stage in STAGES}
+
+    def report(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """``{stage: {packet type: summary}}``."""
+        out: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for stage, histograms in self.stages.items():
+            names = IN_NAMES if stage in _INBOUND_STAGES else OUT_NAMES
+            out[stage] = {names.get(pid, f"0x{pid:02x}"): h.summary() for pid, h in sorted(histograms.items())}
+        return out
+
+    def format_table(self) -> str:
+        lines = [f"采样: 每 {self.sample_every} 个包计时一次" if self.sample_every else "计时采样已关闭",
+                 f"{'stage':<8}{'packet':<16}{'samples':>9}{'p50 us':>10}{'p99 us':>10}{'max us':>10}"]
+        for stage, per_type in self.report().items():
+            for name, s in per_type.items():
+                if s["count"]:
+                    lines.append(f"{stage:<8}{name:<16}{s['count']:>9}{s['p50_us']:>10}{s['p99_us']:>10}{s['max_us']:>10}")
+        return "\n".join(lines)
+
+
+def top_traffic(items: Iterable[Tuple[Any, Optional[Traffic]]], limit: int = 10) -> List[Dict[str, Any]]:
+    """``(key, traffic)`` pairs sorted by total bytes, as dicts."""
+    rows = [(key, t) for key, t in items if t is not None]
+    rows.sort(key=lambda kv: kv[1].bytes_in + kv[1].bytes_out, reverse=True)
+    return [dict(t.as_dict(), id=key) for key, t in rows[:limit]]
+
+
+class Exposition:
+    """Prometheus text exposition format (version 0.0.4) builder."""
+
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+        self._declared: set = set()
+
+    def _declare(self, name: str, kind: str, help: str) -> None:
+        if name not in self._declared:
+            self._declared.add(name)
+            self.lines.append(f"# HELP {name} {help}")
+            self.lines.append(f"# TYPE {name} {kind}")
+
+    @staticmethod
+    def _labels(labels: Optional[Dict[str, Any]]) -> str:
+        if not labels:
+            return ""
+        def esc(v: Any) -> str:
+            return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+    def sample(self, name: str, kind: str, help: str, value: float,
+               labels: Optional[Dict[str, Any]] = None) -> None:
+        self._declare(name, kind, help)
+        self.lines.append(f"{name}{self._labels(labels)} {value}")
+
+    def gauge(self, name: str, help: str, value: float, labels: Optional[Dict[str, Any]] = None) -> None:
+        self.sample(name, "gauge", help, value, labels)
+
+    def counter(self, name: str, help: str, value: float, labels: Optional[Dict[str, Any]] = None) -> None:
+        self.sample(name, "counter", help, value, labels)
+
+    def summary(self, name: str, help: str, histogram: Histogram,
+                labels: Optional[Dict[str, Any]] = None) -> None:
+        """A :class:`Histogram` (ns) as a summary in seconds."""
+        self._declare(name, "summary", help)
+        labels = dict(labels or {})
+        for q in (0.5, 0.9, 0.99):
+            self.lines.append(f"{name}{self._labels(dict(labels, quantile=q))} {histogram.quantile(q) / 1e9}")
+        self.lines.append(f"{name}_sum{self._labels(labels)} {histogram.total / 1e9}")
+        self.lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+class CallbackEntry:
+    """Timings of one subscriber group: cumulative totals plus the last one to two windows as histograms."""
+
+    __slots__ = ("calls", "errors", "wall_ns", "cpu_ns", "wall", "cpu", "previous", "window_end")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.wall_ns = 0
+        self.cpu_ns = 0
+        self.wall = Histogram()
+        self.cpu = Histogram()
+        self.previous: Tuple[Histogram, Histogram] = (Histogram(), Histogram())
+        self.window_end = 0
+
+    def record(self, wall_ns: int, cpu_ns: int, failed: bool, window_ns: int) -> None:
+        now = time.monotonic_ns()
+        if now >= self.window_end:
+            # 滚动窗口：分位数取自上一个窗口与当前窗口
+            stale = now - self.window_end >= window_ns
+            self.previous = (Histogram(), Histogram()) if stale else (self.wall, self.cpu)
+            self.wall, self.cpu = Histogram(), Histogram()
+            self.window_end = now + window_ns
+        self.calls += 1
+        self.errors += failed
+        self.wall_ns += wall_ns
+        self.cpu_ns += cpu_ns
+        self.wall.record(wall_ns)
+        self.cpu.record(cpu_ns)
+
+    def recent(self) -> Tuple[Histogram, Histogram]:
+        wall, cpu = Histogram(), Histogram()
+        if time.monotonic_ns() < self.window_end:
+            for h, parts in ((wall, (self.previous[0], self.wall)), (cpu, (self.previous[1], self.cpu))):
+                for part in parts:
+                    h.merge(part)
+        return wall, cpu
+
+
+class CallbackStats:
+    """Wall and CPU (``thread_time``) time of bus subscribers and commands by ``(kind, owner, name)``.
+
+    ``kind`` is ``"event"`` (name = event) or ``"command"`` (name = command).
+    Async handlers are timed step by step while they run, so time spent
+    awaiting is not counted. Percentiles cover the last ``window`` to
+    2 x ``window`` seconds; totals cover everything since the last reset.
+    """
+
+    def __init__(self, window: float = 60.0) -> None:
+        self.window = window
+        self.enabled = False
+        self.entries: Dict[Tuple[str, str, str], CallbackEntry] = {}
+        self._targets: List[Any] = []
+
+    def attach(self, target: Any) -> None:
+        """Register an object with ``set_profiling(stats or None)`` (EventBus, CommandRegistry)."""
+        self._targets.append(target)
+        target.set_profiling(self if self.enabled else None)
+
+    def set_enabled(self, enabled: bool) -> None:
+        self.enabled = enabled
+        for target in self._targets:
+            target.set_profiling(self if enabled else None)
+
+    def reset(self) -> None:
+        self.entries = {}
+
+    def entry(self, kind: str, owner: Any, name: str) -> CallbackEntry:
+        key = (kind, "core" if owner is None else str(owner), name)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = CallbackEntry()
+        return entry
+
+    def call(self, entry: CallbackEntry, func, *args, **kwargs) -> Any:
+        """Call ``func`` and record it; an awaitable result is wrapped so its steps are recorded instead."""
+        wall, cpu = time.perf_counter_ns(), time.thread_time_ns()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            entry.record(time.perf_counter_ns() - wall, time.thread_time_ns() - cpu, True, int(self.window * 1e9))
+            raise
+        if isinstance(result, types.CoroutineType):
+            return self._timed(result, entry)
+        entry.record(time.perf_counter_ns() - wall, time.thread_time_ns() - cpu, False, int(self.window * 1e9))
+        return result
+
+    async def _timed(self, coro, entry: CallbackEntry) -> Any:
+        return await self._steps(coro, entry)
+
+    @types.coroutine
+    def _steps(self, coro, entry: CallbackEntry):
+        wall = cpu = 0
+        value, error, failed = None, None, False
+        try:
+            while True:
+                w, c = time.perf_counter_ns(), time.thread_time_ns()
+                try:
+                    future = coro.send(value) if error is None else coro.throw(error)
+                except StopIteration as stop:
+                    return stop.value
+                except BaseException:
+                    failed = True
+                    raise
+                finally:
+                    wall += time.perf_counter_ns() - w
+                    cpu += time.thread_time_ns() - c
+                try:
+                    value, error = (yield future), None
+                except BaseException as e:      # 取消等异常原样传给协程
+                    value, error = None, e
+        finally:
+            entry.record(wall, cpu, failed, int(self.window * 1e9))
+
+    def report(self, by: str = "owner") -> List[Dict[str, Any]]:
+        """Rows grouped by ``owner``, ``event`` (event / command name) or ``both``, slowest total CPU first."""
+        groups: Dict[Tuple[str, ...], List[CallbackEntry]] = {}
+        for (kind, owner, name), entry in self.entries.items():
+            if by == "owner":
+                key: Tuple[str, ...] = (owner,)
+            elif by == "event":
+                key = (kind, name)
+            else:
+                key = (owner, kind, name)
+            groups.setdefault(key, []).append(entry)
+        rows = []
+        for key, entries in groups.items():
+            wall, cpu = Histogram(), Histogram()
+            for entry in entries:
+                recent_wall, recent_cpu = entry.recent()
+                wall.merge(recent_wall)
+                cpu.merge(recent_cpu)
+            row: Dict[str, Any] = dict(zip(("owner",) if by == "owner" else ("kind", "name") if by == "event"
+                                           else ("owner", "kind", "name"), key))
+            row.update(
+                calls=sum(e.calls for e in entries),
+                errors=sum(e.errors for e in entries),
+                wall_ms=round(sum(e.wall_ns for e in entries) / 1e6, 3),
+                cpu_ms=round(sum(e.cpu_ns for e in entries) / 1e6, 3),
+                wall_p50_us=round(wall.quantile(0.5) / 1000, 1),
+                wall_p99_us=round(wall.quantile(0.99) / 1000, 1),
+                cpu_p99_us=round(cpu.quantile(0.99) / 1000, 1),
+                max_us=round(wall.max / 1000, 1),
+            )
+            rows.append(row)
+        rows.sort(key=lambda row: row["cpu_ms"], reverse=True)
+        return rows
+
+    def format_table(self, by: str = "owner", limit: int = 20) -> str:
+        lines = ["回调计时: " + ("开启" if self.enabled else "关闭") + f"（分位数为最近 {self.window:.0f}~{self.window * 2:.0f} 秒）",
+                 f"{'owner / event':<36}{'calls':>9}{'cpu ms':>11}{'wall ms':>11}{'p50 us':>9}{'p99 us':>9}"
+                 f"{'max us':>10}{'errors':>7}"]
+        for row in self.report(by)[:limit]:
+            label = row["owner"] if by == "owner" else f"{row['kind']}:{row['name']}" if by == "event" \
+                else f"{row['owner']} {row['name']}"
+            lines.append(f"{label[:35]:<36}{row['calls']:>9}{row['cpu_ms']:>11.1f}{row['wall_ms']:>11.1f}"
+                         f"{row['wall_p50_us']:>9}{row['wall_p99_us']:>9}{row['max_us']:>10}{row['errors']:>7}")
+        return "\n".join(lines)
+
+
+metrics = PipelineMetrics()
+totals = Totals()
+callbacks = CallbackStats()
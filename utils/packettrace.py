@@ -0,0 +1,111 @@
+"""Sampled packet tracer, off by default.
+
+Replaces the unconditional ``data.hex()`` debug lines of
+:class:`utils.connection.Connection`. While it is disabled the only cost
+per packet is one attribute check (``tracer.active``). Once enabled, it
+can be narrowed to:
+
+- connections (``watch(connection)``, e.g. the connection of a user id);
+- packet types by name (``Touches``, ``JoinRoom`` ...), matched in both
+  directions;
+- every N-th matching packet (``sample``).
+
+Ping / Pong are skipped unless asked for by name. Payloads are cut to
+``max_bytes`` in the log line. Driven at runtime by the console ``/log
+trace`` command.
+"""
+
+from __future__ import annotations
+
+import logging
+import weakref
+from typing import Dict, Iterable, List, Optional, Set
+
+from rymc.phira.protocol import PacketRegistry
+
+logger = logging.getLogger("packet")
+
+# 注意 PacketRegistry 中两个表的命名与方向相反：_client_bound_packet_map 存的是客户端发来的包
+IN_NAMES: Dict[int, str] = {pid: cls.__name__[len("ServerBound"):-len("Packet")]
+                             for pid, cls in PacketRegistry._client_bound_packet_map.items()}
+OUT_NAMES: Dict[int, str] = {pid: cls.__name__[len("ClientBound"):-len("Packet")]
+                              for cls, pid in PacketRegistry._server_bound_packet_map.items()}
+_PING_ID = 0x00
+
+
+class PacketTracer:
+    def __init__(self) -> None:
+        self.active = False
+        self.sample = 1
+        self.max_bytes = 64
+        self.connections: "weakref.WeakSet" = weakref.WeakSet()
+        self.in_ids: Optional[Set[int]] = None
+        self.out_ids: Optional[Set[int]] = None
+        self.seen = 0
+        self.logged = 0
+
+    def enable(self, *, sample: Optional[int] = None, max_bytes: Optional[int] = None) -> None:
+        if sample is not None:
+            self.sample = max(1, int(sample))
+        if max_bytes is not None:
+            self.max_bytes = max(0, int(max_bytes))
+        self.active = True
+
+    def disable(self) -> None:
+        self.active = False
+
+    def clear(self) -> None:
+        """Trace everything again (filters removed, sampling reset)."""
+        self.connections = weakref.WeakSet()
+        self.in_ids = self.out_ids = None
+        self.sample = 1
+        self.seen = self.logged = 0
+
+    def watch(self, connection) -> None:
+        self.connections.add(connection)
+
+    def set_types(self, names: Iterable[str]) -> List[str]:
+        """Only trace these packet types; returns the names that matched nothing."""
+        wanted = {n.lower() for n in names}
+        self.in_ids = {pid for pid, name in IN_NAMES.items() if name.lower() in wanted}
+        self.out_ids = {pid for pid, name in OUT_NAMES.items() if name.lower() in wanted}
+        known = {name.lower() for name in IN_NAMES.values()} | {name.lower() for name in OUT_NAMES.values()}
+        return sorted(wanted - known)
+
+    def trace(self, connection, outgoing: bool, data: bytes) -> None:
+        pid = data[0]
+        ids = self.out_ids if outgoing else self.in_ids
+        if ids is None:
+            if pid == _PING_ID:
+                return
+        elif pid not in ids:
+            return
+        if self.connections and connection not in self.connections:
+            return
+        self.seen += 1
+        if self.seen % self.sample:
+            return
+        self.logged += 1
+        names = OUT_NAMES if outgoing else IN_NAMES
+        writer = getattr(connection, "writer", None)
+        peer = writer.get_extra_info("peername") if writer is not None else None
+        shown = data[:self.max_bytes].hex()
+        if len(data) > self.max_bytes:
+            shown += "..."
+        logger.info("%s %s %s (%d bytes): %s", "->" if outgoing else "<-", peer,
+                    names.get(pid, f"0x{pid:02x}"), len(data), shown)
+
+    def describe(self) -> str:
+        if not self.active:
+            return "off"
+        parts = [f"on, 1/{self.sample}", f"max {self.max_bytes} bytes"]
+        if self.connections:
+            parts.append(f"{len(self.connections)} connections")
+        if self.in_ids is not None:
+            names = sorted({IN_NAMES[i] for i in self.in_ids} | {OUT_NAMES[i] for i in self.out_ids})
+            parts.append("types " + ",".join(names))
+        parts.append(f"{self.logged}/{self.seen} logged")
+        return ", ".join(parts)
+
+
+tracer = PacketTracer()
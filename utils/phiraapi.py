@@ -1,9 +1,12 @@
-from typing import Callable, Optional
+from time import perf_counter_ns
+from typing import Callable, Dict, Optional
 import requests
 from requests import Response
 from pydantic import BaseModel
 from datetime import datetime
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import Retrying, stop_after_attempt, wait_fixed
+
+from utils.metrics import Histogram
 
 
 class UserInfo(BaseModel):
@@ -23,6 +26,53 @@ class UserInfo(BaseModel):
     followingCount: Optional[int] = 0
     email: Optional[str] = None
 
+class OnlineProfile:
+    """在线玩家的精简资料：服务器运行时只用到 id / name / language。
+
+    完整的 :class:`UserInfo`（头像、简介、邮箱、时间等）不随在线玩家常驻内存，
+    在插件第一次访问这些字段（或调用 :meth:`full_profile`）时才用登录 token
+    重新拉取，之后缓存在本对象上。
+    """
+
+    __slots__ = ("id", "name", "language", "_token", "_full")
+
+    # token -> UserInfo，main 会替换为走 fetcher 的实现
+    loader: Callable[[str], "UserInfo"] = None
+
+    def __init__(self, id: int, name: str, language: Optional[str] = None, *, token: Optional[str] = None) -> None:
+        self.id = id
+        self.name = name
+        self.language = language
+        self._token = token
+        self._full = None
+
+    @classmethod
+    def from_user_info(cls, info: "UserInfo", token: Optional[str] = None) -> "OnlineProfile":
+        return cls(info.id, info.name, info.language, token=token)
+
+    @property
+    def token(self) -> Optional[str]:
+        """登录时使用的 token（续连票据与热重启快照以它为键）"""
+        return self._token
+
+    def full_profile(self) -> "UserInfo":
+        """按需加载完整资料（阻塞的 HTTP 请求，结果会被缓存）"""
+        if self._full is None:
+            if self._token is None:
+                raise LookupError(f"No token to load the full profile of user {self.id}")
+            loader = OnlineProfile.loader or PhiraFetcher.get_user_info
+            self._full = loader(self._token)
+        return self._full
+
+    def __getattr__(self, item: str):
+        # 只有 UserInfo 的字段会触发懒加载，其他属性照常报错
+        if item in UserInfo.model_fields:
+            return getattr(self.full_profile(), item)
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {item!r}")
+
+    def __repr__(self) -> str:
+        return f"OnlineProfile(id={self.id!r}, name={self.name!r}, language={self.language!r})"
+
 class ChartInfo(BaseModel):
     """谱面信息模型"""
     id: int
@@ -63,23 +113,60 @@ class RecordResult(BaseModel):
 
 class PhiraFetcher:
     host: str = "https://phira.5wyxi.com/"
+    timeout: Optional[float] = None
+    retry_attempts: int = 5   # 默认最多重试5次，每次等待1秒
+    retry_wait: float = 1.0
+    # 按接口统计的请求耗时（含重试，ns）与最终失败次数，供 /metrics 使用
+    latency: Dict[str, Histogram] = {}
+    failures: Dict[str, int] = {}
 
-    @staticmethod
-    @retry(stop=stop_after_attempt(5), wait=wait_fixed(1))  # 最多重试5次，每次等待1秒
-    def fetch(request_func: Callable[[], Response]) -> str:
-        response = request_func()
-        if not (200 <= response.status_code < 300):
-            raise IOError(f"HTTP request failed with status code: {response.status_code}")
-        return response.text
+    @classmethod
+    def configure(
+        cls,
+        *,
+        host: Optional[str] = None,
+        timeout: Optional[float] = None,
+        retry_attempts: Optional[int] = None,
+        retry_wait: Optional[float] = None,
+    ) -> None:
+        """调整 API 地址与重试策略（例如指向 tools/mock_api.py 做可复现的性能测试）"""
+        if host:
+            cls.host = host.rstrip("/") + "/"
+        if timeout is not None:
+            cls.timeout = float(timeout) if timeout > 0 else None
+        if retry_attempts is not None:
+            cls.retry_attempts = max(1, int(retry_attempts))
+        if retry_wait is not None:
+            cls.retry_wait = max(0.0, float(retry_wait))
+
+    @classmethod
+    def fetch(cls, request_func: Callable[[], Response], endpoint: str = "other") -> str:
+        start = perf_counter_ns()
+        try:
+            for attempt in Retrying(stop=stop_after_attempt(cls.retry_attempts), wait=wait_fixed(cls.retry_wait)):
+                with attempt:
+                    response = request_func()
+                    if not (200 <= response.status_code < 300):
+                        raise IOError(f"HTTP request failed with status code: {response.status_code}")
+                    return response.text
+        except Exception:
+            cls.failures[endpoint] = cls.failures.get(endpoint, 0) + 1
+            raise
+        finally:
+            histogram = cls.latency.get(endpoint)
+            if histogram is None:
+                histogram = cls.latency[endpoint] = Histogram()
+            histogram.record(perf_counter_ns() - start)
 
     @classmethod
     def get_user_info(cls, token: str) -> UserInfo:
         def request_func():
             return requests.get(
                 f"{cls.host}me",
-                headers={"Authorization": f"Bearer {token}"}
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=cls.timeout,
             )
-        response_text = cls.fetch(request_func)
+        response_text = cls.fetch(request_func, "me")
         return UserInfo.model_validate_json(response_text)
     @classmethod
     def get_chart_info(cls, chartid: int) -> ChartInfo:
@@ -96,9 +183,9 @@ class PhiraFetcher:
             IOError: 当HTTP请求失败时抛出
         """
         def request_func():
-            return requests.get(f"{cls.host}chart/{chartid}")
+            return requests.get(f"{cls.host}chart/{chartid}", timeout=cls.timeout)
         
-        response_text = cls.fetch(request_func)
+        response_text = cls.fetch(request_func, "chart")
         return ChartInfo.model_validate_json(response_text)
         
     @classmethod
@@ -116,7 +203,7 @@ class PhiraFetcher:
             IOError: 当HTTP请求失败时抛出
         """
         def request_func():
-            return requests.get(f"{cls.host}record/{recordid}")
+            return requests.get(f"{cls.host}record/{recordid}", timeout=cls.timeout)
         
-        response_text = cls.fetch(request_func)
+        response_text = cls.fetch(request_func, "record")
         return RecordResult.model_validate_json(response_text)
\ No newline at end of file
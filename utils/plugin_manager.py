@@ -1,14 +1,58 @@
+"""Plugin loading and hot reload.
+
+Every ``plugins/*.py`` is imported as ``pyphira_plugin_<name>`` and its
+``setup(ctx)`` is called (optionally returning a teardown callable). Import
+and setup time are recorded per plugin and logged once startup loading is
+done (console ``/plugins`` shows them again).
+
+Loading can be shaped per plugin through keys of its ``PLUGIN_INFO`` dict,
+which is read from the source (``ast``) without importing the module:
+
+- ``"lazy": {"events": [...], "commands": [...]}`` — not imported at
+  startup. The first emit of one of the events, or the first use of one of
+  the console commands, loads the plugin and then hands that event / command
+  to it.
+- ``"thread_import": False`` — with ``import_threads`` > 0, plugin modules
+  are imported on a worker thread pool while the server keeps starting (a
+  plugin pulling in fastapi / uvicorn no longer delays the listening
+  socket); ``setup`` still runs on the event loop, in file name order.
+  Plugins whose import must happen on the loop thread opt out with this.
+
+A plugin loaded after ``commands.init`` was emitted (threaded or lazy
+loading, hot reload) gets that event replayed to its own handlers, so its
+console commands are registered either way.
+
+``"sandbox": True`` (or a dict of :class:`utils.pluginhost.SandboxHost`
+options such as ``{"cpu_budget": 0.2}``), or the plugin's name listed in
+``sandbox``, runs the plugin in its own process (POSIX). Events reach it
+in batches, it gets a CPU budget, and a crash only restarts that plugin.
+Sandboxed plugins are never lazy.
+
+Hot reload: on Linux the plugin directory is watched with inotify
+(:mod:`utils.fswatch`). Nothing runs while no file changes, and only the
+plugins whose files changed are reloaded, once their writes have been
+quiet for ``debounce`` seconds. Elsewhere, or with ``watch="poll"``, the
+directory is rescanned every ``poll_interval`` seconds as before.
+"""
+
+import ast
 import asyncio
+import concurrent.futures
+import functools
 import importlib.util
 import logging
 import os
 import sys
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from types import ModuleType
-from typing import Any, Callable, Dict, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
+from utils.commands import Command
 from utils.eventbus import EventBus
+from utils.fswatch import DirWatcher
+from utils import pluginhost
 
 
 logger = logging.getLogger(__name__)
@@ -22,9 +66,45 @@ class LoadedPlugin:
     name: str
     path: Path
     module_name: str
-    module: ModuleType
+    module: Optional[ModuleType]
     teardown: Optional[Teardown]
     mtime: float
+    import_s: float = 0.0
+    setup_s: float = 0.0
+    how: str = "startup"            # startup / thread / lazy / reload / sandbox
+    host: Optional[pluginhost.SandboxHost] = None
+
+
+@dataclass
+class DeferredPlugin:
+    """A lazy plugin that has not been needed yet."""
+    name: str
+    path: Path
+    module_name: str
+    events: Sequence[str]
+    commands: Sequence[str]
+    mtime: float
+
+    @property
+    def owner(self) -> str:
+        # 占位的事件订阅与指令都挂在这个 owner 下，加载时一起移除
+        return f"lazy.{self.module_name}"
+
+
+def read_plugin_info(path: Path) -> Dict[str, Any]:
+    """The literal ``PLUGIN_INFO = {...}`` of a plugin file, without importing it ({} if absent)."""
+    try:
+        tree = ast.parse(path.read_text(encoding="utf-8"), filename=str(path))
+    except (OSError, SyntaxError, ValueError):
+        return {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "PLUGIN_INFO" for t in node.targets):
+            try:
+                info = ast.literal_eval(node.value)
+            except ValueError:
+                return {}
+            return info if isinstance(info, dict) else {}
+    return {}
 
 
 class PluginContext:
@@ -52,48 +132,112 @@ class PluginManager:
         plugins_dir: Union[str, os.PathLike] = "plugins",
         *,
         poll_interval: float = 1.0,
+        import_threads: int = 0,
+        watch: str = "auto",
+        debounce: float = 0.2,
+        sandbox: Sequence[str] = (),
+        sandbox_cpu: float = 0.5,
     ) -> None:
         self.bus = bus
         self.plugins_dir = Path(plugins_dir)
         self.poll_interval = poll_interval
+        self.import_threads = import_threads
+        self.watch = watch              # "auto"（可用时用 inotify）/ "inotify" / "poll" / "off"
+        self.debounce = debounce
+        self.sandbox = set(sandbox)     # 强制在独立进程中运行的插件名
+        self.sandbox_cpu = sandbox_cpu
 
         self._loaded: Dict[Path, LoadedPlugin] = {}
+        self._deferred: Dict[Path, DeferredPlugin] = {}
         self._watch_task: Optional[asyncio.Task] = None
+        self._watcher: Optional[DirWatcher] = None
+        self._startup_task: Optional[asyncio.Task] = None
+        self._started_at = 0.0
+        # commands.init 的参数 (registry, ctx)；之后加载的插件会单独收到一次
+        self._commands: Optional[Tuple[Any, Any]] = None
+        bus.on("commands.init", self._on_commands_init, owner="core.plugin_manager")
+
+    @property
+    def ready(self) -> bool:
+        """Startup loading finished (lazy plugins excluded)."""
+        return self._startup_task is None or self._startup_task.done()
 
     def start(self) -> None:
         self.plugins_dir.mkdir(parents=True, exist_ok=True)
-        self.load_all()
-        if self._watch_task is None:
-            logger.info(
-                "[PluginManager] Hot-reload watcher started. dir=%s interval=%ss",
-                str(self.plugins_dir),
-                self.poll_interval,
-            )
-            self._watch_task = asyncio.create_task(self._watch_loop())
+        self._started_at = time.perf_counter()
+        eager = self._defer_lazy(sorted(self.plugins_dir.glob("*.py")))
+        if self.import_threads > 0 and eager:
+            self._startup_task = asyncio.create_task(self._load_threaded(eager))
+        else:
+            for path in eager:
+                self.load(path)
+            self._log_startup()
+        if self._watch_task is None and self._watcher is None:
+            self._start_watch()
+
+    def _start_watch(self) -> None:
+        if self.watch == "off":
+            return
+        if self.watch in ("auto", "inotify"):
+            watcher = DirWatcher(self.plugins_dir, self._on_fs_change, debounce=self.debounce, suffix=".py")
+            if watcher.start():
+                self._watcher = watcher
+                logger.info("[PluginManager] Hot-reload watcher started (inotify). dir=%s debounce=%ss",
+                            str(self.plugins_dir), self.debounce)
+                return
+            if self.watch == "inotify":
+                logger.warning("[PluginManager] inotify unavailable, falling back to polling")
+        logger.info(
+            "[PluginManager] Hot-reload watcher started. dir=%s interval=%ss",
+            str(self.plugins_dir),
+            self.poll_interval,
+        )
+        self._watch_task = asyncio.create_task(self._watch_loop())
 
     def stop(self) -> None:
         if self._watch_task:
             self._watch_task.cancel()
             self._watch_task = None
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
+        if self._startup_task:
+            self._startup_task.cancel()
+            self._startup_task = None
+        for path in list(self._deferred.keys()):
+            self._drop_deferred(path)
         # unload all
         for path in list(self._loaded.keys()):
             self.unload(path)
 
     def load_all(self) -> None:
         self.plugins_dir.mkdir(parents=True, exist_ok=True)
-        for path in sorted(self.plugins_dir.glob("*.py")):
+        for path in self._defer_lazy(sorted(self.plugins_dir.glob("*.py"))):
             self.load(path)
 
-    def load(self, path: Path) -> None:
+    def load(self, path: Path, *, how: str = "startup") -> None:
         path = path.resolve()
         if path in self._loaded:
             return
-
+        options = self._sandbox_options(path)
+        if options is not None:
+            self._load_sandboxed(path, options)
+            return
         try:
             mtime = path.stat().st_mtime
             module_name = f"pyphira_plugin_{path.stem}"
+            started = time.perf_counter()
             module = self._import_from_path(module_name, path)
+            import_s = time.perf_counter() - started
+        except Exception:
+            logger.exception("[PluginManager] Failed to load plugin: %s", path)
+            return
+        self._setup(path, module_name, module, mtime, import_s, how)
 
+    def _setup(self, path: Path, module_name: str, module: ModuleType, mtime: float, import_s: float,
+               how: str) -> None:
+        try:
+            started = time.perf_counter()
             teardown = None
             if hasattr(module, "setup"):
                 # owner is module_name so off_owner can cleanly remove subscriptions
@@ -101,23 +245,220 @@ class PluginManager:
                 result = module.setup(ctx)
                 if callable(result):
                     teardown = result
+            setup_s = time.perf_counter() - started
 
-            self._loaded[path] = LoadedPlugin(
+            self._register(LoadedPlugin(
                 name=path.stem,
                 path=path,
                 module_name=module_name,
                 module=module,
                 teardown=teardown,
                 mtime=mtime,
-            )
-            logger.info("[PluginManager] Loaded plugin %s (%s)", path.stem, path)
-            try:
-                self.bus.emit("plugin.loaded", name=path.stem, path=str(path), module_name=module_name)
-            except Exception:
-                logger.exception("[PluginManager] Failed to emit plugin.loaded")
+                import_s=import_s,
+                setup_s=setup_s,
+                how=how,
+            ))
         except Exception:
+            sys.modules.pop(module_name, None)
+            self.bus.off_owner(module_name)
             logger.exception("[PluginManager] Failed to load plugin: %s", path)
 
+    def _register(self, plugin: LoadedPlugin) -> None:
+        self._loaded[plugin.path] = plugin
+        logger.info("[PluginManager] Loaded plugin %s (%s, import %.1f ms, setup %.1f ms)",
+                    plugin.name, plugin.how, plugin.import_s * 1000, plugin.setup_s * 1000)
+        if self._commands is not None:
+            registry, ctx = self._commands
+            self.bus.emit_owner(plugin.module_name, "commands.init", registry=registry, ctx=ctx)
+        try:
+            self.bus.emit("plugin.loaded", name=plugin.name, path=str(plugin.path), module_name=plugin.module_name)
+        except Exception:
+            logger.exception("[PluginManager] Failed to emit plugin.loaded")
+
+    # -- sandboxed plugins --
+
+    def _sandbox_options(self, path: Path) -> Optional[Dict[str, Any]]:
+        """SandboxHost options when ``path`` should run out of process, else None."""
+        option = read_plugin_info(path).get("sandbox")
+        if not option and path.stem not in self.sandbox:
+            return None
+        if not pluginhost.supported():
+            logger.warning("[PluginManager] Plugin sandbox needs a POSIX system, loading %s in-process", path.stem)
+            return None
+        options = {"cpu_budget": self.sandbox_cpu}
+        if isinstance(option, dict):
+            options.update(option)
+        return options
+
+    def _load_sandboxed(self, path: Path, options: Dict[str, Any]) -> None:
+        module_name = f"pyphira_plugin_{path.stem}"
+        try:
+            mtime = path.stat().st_mtime
+            started = time.perf_counter()
+            host = pluginhost.SandboxHost(self.bus, path, module_name, **options)
+            host.start()
+        except Exception:
+            self.bus.off_owner(module_name)
+            logger.exception("[PluginManager] Failed to start sandboxed plugin: %s", path)
+            return
+        # 插件的导入与 setup 在子进程中进行，耗时由子进程就绪后上报（见 report）
+        self._register(LoadedPlugin(name=path.stem, path=path, module_name=module_name, module=None,
+                                    teardown=host.stop, mtime=mtime, import_s=time.perf_counter() - started,
+                                    how="sandbox", host=host))
+
+    # -- threaded startup --
+
+    async def _load_threaded(self, paths: List[Path]) -> None:
+        loop = asyncio.get_running_loop()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.import_threads,
+                                                     thread_name_prefix="plugin-import")
+        try:
+            jobs = []
+            for path in paths:
+                path = path.resolve()
+                if read_plugin_info(path).get("thread_import", True) and self._sandbox_options(path) is None:
+                    jobs.append((path, loop.run_in_executor(pool, self._import_timed, path)))
+                else:
+                    jobs.append((path, None))
+            # setup 按文件名顺序在事件循环上执行，与同步加载时一致
+            for path, job in jobs:
+                if job is None:
+                    self.load(path)
+                    continue
+                try:
+                    module_name, module, mtime, import_s = await job
+                except Exception:
+                    logger.exception("[PluginManager] Failed to load plugin: %s", path)
+                    continue
+                if path in self._loaded:
+                    continue
+                self._setup(path, module_name, module, mtime, import_s, "thread")
+        finally:
+            pool.shutdown(wait=False)
+        self._log_startup()
+
+    def _import_timed(self, path: Path) -> Tuple[str, ModuleType, float, float]:
+        mtime = path.stat().st_mtime
+        module_name = f"pyphira_plugin_{path.stem}"
+        started = time.perf_counter()
+        module = self._import_from_path(module_name, path)
+        return module_name, module, mtime, time.perf_counter() - started
+
+    def _log_startup(self) -> None:
+        plugins = sorted(self._loaded.values(), key=lambda p: p.import_s + p.setup_s, reverse=True)
+        detail = ", ".join(f"{p.name} {p.import_s * 1000:.0f}+{p.setup_s * 1000:.0f} ms" for p in plugins)
+        logger.info("[PluginManager] %d plugins ready in %.0f ms (import+setup: %s)", len(plugins),
+                    (time.perf_counter() - self._started_at) * 1000, detail or "-")
+        if self._deferred:
+            logger.info("[PluginManager] Lazy plugins (load on first use): %s",
+                        ", ".join(sorted(p.name for p in self._deferred.values())))
+
+    # -- lazy plugins --
+
+    def _defer_lazy(self, paths: List[Path]) -> List[Path]:
+        """Register triggers for the lazy plugins among ``paths``; returns the others (not yet loaded)."""
+        eager = []
+        for path in paths:
+            path = path.resolve()
+            if path in self._loaded or path in self._deferred:
+                continue
+            info = read_plugin_info(path)
+            lazy = info.get("lazy")
+            if not lazy or info.get("sandbox") or path.stem in self.sandbox:
+                eager.append(path)
+                continue
+            events = tuple(lazy.get("events", ())) if isinstance(lazy, dict) else ()
+            commands = tuple(lazy.get("commands", ())) if isinstance(lazy, dict) else ()
+            if not events and not commands:
+                logger.warning("[PluginManager] Plugin %s is lazy but names no events or commands, loading now",
+                               path.stem)
+                eager.append(path)
+                continue
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            plugin = DeferredPlugin(path.stem, path, f"pyphira_plugin_{path.stem}", events, commands, mtime)
+            self._deferred[path] = plugin
+            for event in events:
+                self.bus.on(event, functools.partial(self._on_trigger_event, path, event), owner=plugin.owner)
+            if self._commands is not None:
+                self._register_placeholders(plugin)
+            logger.info("[PluginManager] Deferred plugin %s until %s", plugin.name,
+                        ", ".join([*events, *(f"/{c}" for c in commands)]))
+        return eager
+
+    def _drop_deferred(self, path: Path) -> Optional[DeferredPlugin]:
+        plugin = self._deferred.pop(path, None)
+        if plugin is not None:
+            self.bus.off_owner(plugin.owner)
+            if self._commands is not None:
+                self._commands[0].off_owner(plugin.owner)
+        return plugin
+
+    def load_deferred(self, name: str) -> bool:
+        """Load a lazy plugin now; True once it is loaded (also when it already was)."""
+        for path, plugin in list(self._deferred.items()):
+            if plugin.name == name:
+                return self._load_deferred(path, "requested")
+        return any(p.name == name for p in self._loaded.values())
+
+    def _load_deferred(self, path: Path, reason: str) -> bool:
+        plugin = self._drop_deferred(path)
+        if plugin is not None:
+            logger.info("[PluginManager] Loading lazy plugin %s (%s)", plugin.name, reason)
+            self.load(path, how="lazy")
+        return path in self._loaded
+
+    def _on_trigger_event(self, path: Path, event: str, **payload: Any) -> None:
+        if self._load_deferred(path, f"event {event}"):
+            # 插件刚订阅的处理函数错过了这次事件：单独补发给它
+            self.bus.emit_owner(self._loaded[path].module_name, event, **payload)
+
+    def _register_placeholders(self, plugin: DeferredPlugin) -> None:
+        registry = self._commands[0]
+        for name in plugin.commands:
+            registry.register(Command(
+                name=name,
+                usage=f"/{name}",
+                help=f"(插件 {plugin.name}，首次使用时加载)",
+                handler=functools.partial(self._on_trigger_command, plugin.path, name),
+                owner=plugin.owner,
+            ))
+
+    def _on_trigger_command(self, path: Path, name: str, c, args: List[str]) -> Any:
+        if not self._load_deferred(path, f"command /{name}"):
+            c.println(f"插件 {path.stem} 加载失败，详见日志")
+            return None
+        command = self._commands[0].get(name)
+        if command is None:
+            c.println(f"插件 {path.stem} 没有注册指令 /{name}")
+            return None
+        return command.handler(c, args)
+
+    def _on_commands_init(self, registry=None, ctx=None, **_) -> None:
+        if registry is None:
+            return
+        self._commands = (registry, ctx)
+        for plugin in self._deferred.values():
+            self._register_placeholders(plugin)
+
+    # -- reporting --
+
+    def report(self) -> List[Dict[str, Any]]:
+        rows = []
+        for p in self._loaded.values():
+            row = {"name": p.name, "state": "loaded", "how": p.how, "import_ms": round(p.import_s * 1000, 1),
+                   "setup_ms": round(p.setup_s * 1000, 1)}
+            if p.host is not None:
+                host = p.host
+                row.update(import_ms=None if host.import_ms is None else round(host.import_ms, 1),
+                           setup_ms=None if host.setup_ms is None else round(host.setup_ms, 1), sandbox=host.stats())
+            rows.append(row)
+        rows.extend({"name": p.name, "state": "lazy", "how": None, "import_ms": None, "setup_ms": None,
+                     "events": list(p.events), "commands": list(p.commands)} for p in self._deferred.values())
+        return sorted(rows, key=lambda row: row["name"])
+
     def unload(self, path: Path) -> None:
         path = path.resolve()
         plugin = self._loaded.pop(path, None)
@@ -151,11 +492,17 @@ class PluginManager:
 
     def reload(self, path: Path) -> None:
         path = path.resolve()
+        if path in self._deferred:
+            # 还没用到的懒加载插件：只重新读取它的触发条件
+            self._drop_deferred(path)
+            self._defer_lazy([path])
+            return
         if path in self._loaded:
             self.unload(path)
-        self.load(path)
+        self.load(path, how="reload")
 
-    def _import_from_path(self, module_name: str, path: Path) -> ModuleType:
+    @staticmethod
+    def _import_from_path(module_name: str, path: Path) -> ModuleType:
         spec = importlib.util.spec_from_file_location(module_name, str(path))
         if spec is None or spec.loader is None:
             raise RuntimeError(f"Failed to create module spec for {path}")
@@ -176,26 +523,47 @@ class PluginManager:
             return
 
     def _scan_once(self) -> None:
+        if not self.ready:
+            return
         self.plugins_dir.mkdir(parents=True, exist_ok=True)
         current = {p.resolve() for p in self.plugins_dir.glob("*.py")}
+        # deletions first, then new/modified
+        for path in (self._loaded.keys() | self._deferred.keys()) - current:
+            self._check(path)
+        for path in current:
+            self._check(path)
 
-        # detect deletions
-        for old in list(self._loaded.keys()):
-            if old not in current:
-                self.unload(old)
+    def _on_fs_change(self, names: Optional[set]) -> None:
+        if not self.ready:
+            # 线程导入尚未结束：稍后再处理这批变化
+            asyncio.get_running_loop().call_later(self.debounce, self._on_fs_change, names)
+            return
+        if names is None:
+            self._scan_once()
+            if self._watcher is not None and self._watcher.closed:
+                # 插件目录被删除或移走，inotify 监视已失效：改回轮询
+                self._watcher = None
+                self.watch = "poll"
+                self._start_watch()
+            return
+        for name in sorted(names):
+            self._check((self.plugins_dir / name).resolve())
 
-        # detect new/modified
-        for path in current:
-            try:
-                mtime = path.stat().st_mtime
-            except FileNotFoundError:
-                continue
+    def _check(self, path: Path) -> None:
+        """Bring one plugin file in line with the disk: load, reload or unload it."""
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            if path in self._loaded:
+                self.unload(path)
+            self._drop_deferred(path)
+            return
 
-            loaded = self._loaded.get(path)
-            if loaded is None:
-                self.load(path)
-            else:
-                # mtime changed => reload
-                if mtime != loaded.mtime:
-                    logger.info("[PluginManager] Detected change, reloading: %s", path.name)
-                    self.reload(path)
+        loaded = self._loaded.get(path) or self._deferred.get(path)
+        if loaded is None:
+            for eager in self._defer_lazy([path]):
+                self.load(eager, how="reload")
+        elif mtime != loaded.mtime:
+            # mtime changed => reload
+            logger.info("[PluginManager] Detected change, reloading: %s", path.name)
+            self.reload(path)
@@ -0,0 +1,547 @@
+"""Out-of-process plugin sandbox.
+
+A plugin marked ``"sandbox": True`` in its ``PLUGIN_INFO`` (or named in
+``plugin_sandbox`` in ``config.json``) is not imported into the server.
+:class:`SandboxHost` starts ``python -m utils.pluginhost <file> <fd>``
+instead, and the plugin's ``setup(ctx)`` runs in that child process with
+a local :class:`~utils.eventbus.EventBus`. The two sides talk over a Unix
+socket pair, one JSON object per line:
+
+- events: every ``ctx.on(event, ...)`` in the child subscribes the host to
+  that event on the server bus. Emitted events are converted to plain data
+  (:func:`portable`) and queued. The queue is sent as one ``events`` batch
+  every ``batch_interval`` seconds, or as soon as ``batch_max`` events are
+  waiting. The child acknowledges each batch.
+- commands: console commands the plugin registers on ``commands.init`` are
+  registered in the server's registry as forwarders. Running one sends a
+  ``command`` request, and the child answers with the lines its handler
+  printed.
+- ``ctx.emit`` in the child and its log records are sent back and
+  re-emitted / re-logged in the server.
+
+Payload objects (connection, handler, packet, ...) reach the child as
+:class:`Portable` namespaces of their public, plain-valued attributes (two
+levels deep, collections capped at 64 items). Sandboxed plugins can read
+what happened, but they cannot call back into live server objects.
+
+Isolation:
+
+- CPU budget: the child reports its CPU time with every ack and once a
+  second. When its share of one core over the last ``window`` seconds
+  exceeds ``cpu_budget``, events are dropped (``dropped``) until it is
+  back under budget. A slow plugin loses events instead of lagging behind
+  without bound. At most ``max_inflight`` unacknowledged batches are
+  outstanding; beyond that, events are dropped as well. Events are
+  dropped before their payload is converted, so an over-budget plugin
+  costs the server loop almost nothing. The child also runs at a lower
+  priority (``nice``).
+- crashes: the child exiting, or sending nothing for ``stall_timeout``
+  seconds (it is killed then), only affects that plugin. It is restarted
+  after a back-off that doubles up to 60 seconds and resets once the child
+  has run for a minute.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import enum
+import functools
+import itertools
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from utils.commands import Command, CommandContext
+from utils.eventbus import EventBus
+
+logger = logging.getLogger(__name__)
+
+_PLAIN = (type(None), bool, int, float, str)
+_MAX_ITEMS = 64
+_MAX_LINE = 1 << 24
+
+
+def supported() -> bool:
+    return os.name == "posix"
+
+
+def portable(value: Any, depth: int = 2) -> Any:
+    """JSON-able copy of an event payload value (see the module docstring)."""
+    if isinstance(value, _PLAIN):
+        return value
+    if isinstance(value, enum.Enum):
+        return value.value if isinstance(value.value, _PLAIN) else value.name
+    if depth <= 0 or isinstance(value, (bytes, bytearray, memoryview)) or callable(value):
+        return None
+    if isinstance(value, dict):
+        return {str(k): portable(v, depth - 1) for k, v in itertools.islice(value.items(), _MAX_ITEMS)}
+    if isinstance(value, (list, tuple, set, frozenset, deque)):
+        return [portable(v, depth - 1) for v in itertools.islice(value, _MAX_ITEMS)]
+    fields: Dict[str, Any] = {"__type__": type(value).__name__}
+    names = list(getattr(value, "__dict__", ()))
+    for cls in type(value).__mro__:
+        names.extend(getattr(cls, "__slots__", ()))
+    for name in names:
+        if name.startswith("_") or name in fields:
+            continue
+        try:
+            attr = getattr(value, name)
+        except Exception:
+            continue
+        if not callable(attr):
+            fields[name] = portable(attr, depth - 1)
+    return fields
+
+
+class Portable(SimpleNamespace):
+    """A payload object as the sandboxed plugin sees it (attribute access like the original)."""
+
+
+def _decode(line: bytes) -> Dict[str, Any]:
+    return json.loads(line, object_hook=lambda d: Portable(**d) if "__type__" in d else d)
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=lambda _: None).encode() + b"\n"
+
+
+# ---- server side --------------------------------------------------------------------
+
+
+class SandboxHost:
+    def __init__(
+        self,
+        bus: EventBus,
+        path: Path,
+        module_name: str,
+        *,
+        cpu_budget: float = 0.5,
+        window: float = 5.0,
+        batch_interval: float = 0.02,
+        batch_max: int = 256,
+        max_inflight: int = 32,
+        stall_timeout: float = 10.0,
+        nice: int = 10,
+    ) -> None:
+        self.bus = bus
+        self.path = path
+        self.name = path.stem
+        self.module_name = module_name
+        self.cpu_budget = cpu_budget    # 占一个核心的比例，0 表示不限
+        self.window = window
+        self.batch_interval = batch_interval
+        self.batch_max = batch_max
+        self.max_inflight = max_inflight
+        self.stall_timeout = stall_timeout
+        self.nice = nice
+
+        self.pid: Optional[int] = None
+        self.running = False
+        self.throttled = False
+        self.cpu_share = 0.0
+        self.import_ms: Optional[float] = None
+        self.setup_ms: Optional[float] = None
+        self.forwarded = 0
+        self.dropped = 0
+        self.restarts = 0
+
+        self._events: Set[str] = set()
+        self._batch: List[Tuple[str, Dict[str, Any]]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._inflight = 0
+        self._cpu: Deque[Tuple[float, float]] = deque()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._task: Optional[asyncio.Task] = None
+        self._registry = None
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._call_ids = itertools.count(1)
+        bus.on("commands.init", self._on_commands_init, owner=module_name)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._supervise())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._disconnect()
+        if self._proc is not None and self._proc.returncode is None:
+            self._proc.kill()
+            asyncio.ensure_future(self._proc.wait())
+        if self._registry is not None:
+            self._registry.off_owner(self.module_name)
+        self.bus.off_owner(self.module_name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pid": self.pid, "running": self.running, "throttled": self.throttled,
+                "cpu_share": round(self.cpu_share, 3), "cpu_budget": self.cpu_budget,
+                "forwarded": self.forwarded, "dropped": self.dropped, "restarts": self.restarts}
+
+    # -- child lifecycle --
+
+    async def _supervise(self) -> None:
+        backoff = 1.0
+        while True:
+            started = time.monotonic()
+            try:
+                code = await self._run_child()
+            except OSError as e:
+                logger.error("[Sandbox] Failed to start plugin %s: %s", self.name, e)
+                code = None
+            self.restarts += 1
+            if time.monotonic() - started > 60:
+                backoff = 1.0
+            logger.warning("[Sandbox] Plugin %s exited (code %s), restarting in %.0fs", self.name, code, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+    async def _run_child(self) -> Optional[int]:
+        parent, child = socket.socketpair()
+        try:
+            self._proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "utils.pluginhost", str(self.path), str(child.fileno()), str(self.nice),
+                pass_fds=(child.fileno(),), stdin=asyncio.subprocess.DEVNULL, env=self._child_env())
+        finally:
+            child.close()
+        self.pid = self._proc.pid
+        reader, self._writer = await asyncio.open_unix_connection(sock=parent, limit=_MAX_LINE)
+        self._cpu.clear()
+        self.running = True
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.stall_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning("[Sandbox] Plugin %s sent nothing for %.0fs, killing it", self.name,
+                                   self.stall_timeout)
+                    self._proc.kill()
+                    break
+                if not line:
+                    break
+                try:
+                    self._on_message(_decode(line))
+                except Exception:
+                    logger.exception("[Sandbox] Bad message from plugin %s", self.name)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._disconnect()
+        if self._proc.returncode is None:
+            self._proc.kill()
+        return await self._proc.wait()
+
+    @staticmethod
+    def _child_env() -> Dict[str, str]:
+        # 子进程沿用服务器的工作目录；项目根目录加入 PYTHONPATH 以便找到 utils
+        root = str(Path(__file__).resolve().parent.parent)
+        path = os.environ.get("PYTHONPATH")
+        return dict(os.environ, PYTHONPATH=root + os.pathsep + path if path else root)
+
+    def _disconnect(self) -> None:
+        self.running = False
+        self.throttled = False
+        self._inflight = 0
+        self._batch.clear()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for future in self._calls.values():
+            if not future.done():
+                future.set_result({"error": "插件进程已退出"})
+        self._calls.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _send(self, message: Dict[str, Any]) -> bool:
+        if self._writer is None or self._writer.is_closing():
+            return False
+        self._writer.write(_encode(message))
+        return True
+
+    # -- messages from the child --
+
+    def _on_message(self, msg: Dict[str, Any]) -> None:
+        kind = msg.get("t")
+        if kind == "ack":
+            self._inflight = max(0, self._inflight - 1)
+            self._account(msg["cpu"])
+        elif kind == "beat":
+            self._account(msg["cpu"])
+        elif kind == "on":
+            event = msg["event"]
+            if event not in self._events and event != "commands.init":
+                self._events.add(event)
+                self.bus.on(event, functools.partial(self._forward, event), owner=self.module_name)
+        elif kind == "emit":
+            self.bus.emit(msg["event"], **(msg.get("payload") or {}))
+        elif kind == "log":
+            logging.getLogger(msg.get("name") or f"plugin.{self.name}").log(msg.get("level", logging.INFO),
+                                                                            "%s", msg.get("msg"))
+        elif kind == "command_add":
+            self._add_command(msg)
+        elif kind == "result":
+            future = self._calls.pop(msg.get("id"), None)
+            if future is not None and not future.done():
+                future.set_result(msg)
+        elif kind == "ready":
+            self.import_ms, self.setup_ms = msg.get("import_ms"), msg.get("setup_ms")
+            logger.info("[Sandbox] Plugin %s running in pid %s (import %.1f ms, setup %.1f ms)", self.name,
+                        self.pid, self.import_ms or 0, self.setup_ms or 0)
+
+    def _account(self, cpu: float) -> None:
+        now = time.monotonic()
+        samples = self._cpu
+        samples.append((now, cpu))
+        while len(samples) > 2 and now - samples[1][0] >= self.window:
+            samples.popleft()
+        start_t, start_cpu = samples[0]
+        if now - start_t < 0.5:
+            return
+        self.cpu_share = (cpu - start_cpu) / (now - start_t)
+        over = self.cpu_budget > 0 and self.cpu_share > self.cpu_budget
+        if over != self.throttled:
+            self.throttled = over
+            if over:
+                logger.warning("[Sandbox] Plugin %s uses %.0f%% CPU (budget %.0f%%), dropping its events",
+                               self.name, self.cpu_share * 100, self.cpu_budget * 100)
+            else:
+                logger.info("[Sandbox] Plugin %s back under its CPU budget (%.0f%%)", self.name,
+                            self.cpu_share * 100)
+
+    # -- events to the child --
+
+    def _forward(self, event: str, **payload: Any) -> None:
+        # 超出 CPU 预算或积压时在转换负载之前就丢弃，不让游戏循环为之付出序列化开销
+        if not self.running or self.throttled or self._inflight >= self.max_inflight:
+            self.dropped += 1
+            return
+        self._batch.append((event, {k: portable(v) for k, v in payload.items()}))
+        if len(self._batch) >= self.batch_max:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_interval, self._flush)
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        if self.throttled or self._inflight >= self.max_inflight or not self._send({"t": "events", "items": batch}):
+            self.dropped += len(batch)
+            return
+        self._inflight += 1
+        self.forwarded += len(batch)
+
+    # -- console commands --
+
+    def _on_commands_init(self, registry=None, **_) -> None:
+        self._registry = registry
+
+    def _add_command(self, msg: Dict[str, Any]) -> None:
+        if self._registry is None:
+            return
+        name = msg["name"]
+        self._registry.register(Command(
+            name=name,
+            usage=msg.get("usage") or f"/{name}",
+            help=msg.get("help") or "",
+            aliases=tuple(msg.get("aliases") or ()),
+            hidden=bool(msg.get("hidden")),
+            handler=functools.partial(self._call_command, name),
+            owner=self.module_name,
+        ))
+
+    async def _call_command(self, name: str, c: CommandContext, args: List[str]) -> None:
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        if not self._send({"t": "command", "id": call_id, "name": name, "args": list(args)}):
+            self._calls.pop(call_id, None)
+            c.println(f"插件 {self.name} 当前不可用（进程重启中）")
+            return
+        try:
+            result = await asyncio.wait_for(future, self.stall_timeout)
+        except asyncio.TimeoutError:
+            self._calls.pop(call_id, None)
+            c.println(f"插件 {self.name} 未在 {self.stall_timeout:.0f} 秒内响应 /{name}")
+            return
+        for line in result.get("lines") or ():
+            c.println(line)
+        if result.get("error"):
+            c.println(f"指令执行失败: /{name} - {result['error']}")
+
+
+# ---- plugin process ---------------------------------------------------------------
+
+
+class _Channel:
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+
+    def send(self, message: Dict[str, Any]) -> None:
+        data = _encode(message)
+        if threading.get_ident() == self.thread:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+
+class _ForwardLogs(logging.Handler):
+    def __init__(self, channel: _Channel) -> None:
+        super().__init__()
+        self.channel = channel
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            msg = record.getMessage()
+            if record.exc_info:
+                msg += "\n" + logging.Formatter().formatException(record.exc_info)
+            self.channel.send({"t": "log", "level": record.levelno, "name": record.name, "msg": msg})
+        except Exception:
+            self.handleError(record)
+
+
+class _SandboxContext:
+    """``ctx`` of a sandboxed plugin: same surface as PluginContext, events come from the server."""
+
+    def __init__(self, bus: EventBus, plugin_name: str, owner: str, channel: _Channel) -> None:
+        self.bus = bus
+        self.plugin_name = plugin_name
+        self.logger = logging.getLogger(f"plugin.{plugin_name}")
+        self._owner = owner
+        self._channel = channel
+
+    def on(self, event: str, callback, *, owner: Any = None):
+        self._channel.send({"t": "on", "event": event})
+        return self.bus.on(event, callback, owner=self._owner if owner is None else owner)
+
+    def once(self, event: str, callback, *, owner: Any = None):
+        self._channel.send({"t": "on", "event": event})
+        return self.bus.once(event, callback, owner=self._owner if owner is None else owner)
+
+    def emit(self, event: str, **payload):
+        self._channel.send({"t": "emit", "event": event, "payload": {k: portable(v) for k, v in payload.items()}})
+
+
+class _RemoteRegistry:
+    """What ``commands.init`` hands a sandboxed plugin: commands are announced to the server."""
+
+    def __init__(self, channel: _Channel) -> None:
+        self.channel = channel
+        self.commands: Dict[str, Command] = {}
+
+    def register(self, cmd: Command) -> None:
+        for name in cmd.all_names():
+            self.commands[name.lower()] = cmd
+        self.channel.send({"t": "command_add", "name": cmd.name, "usage": cmd.usage, "help": cmd.help,
+                           "aliases": list(cmd.aliases), "hidden": cmd.hidden})
+
+    def off_owner(self, owner: Any) -> None:
+        for name in [n for n, cmd in self.commands.items() if cmd.owner == owner]:
+            del self.commands[name]
+
+
+class _CaptureContext(CommandContext):
+    def __init__(self, bus: EventBus, log: logging.Logger) -> None:
+        super().__init__(bus=bus, plugin_manager=None, server_state=None, shutdown_event=None, logger=log)
+        self.lines: List[str] = []
+
+    def println(self, msg: str) -> None:
+        self.lines.append(str(msg))
+
+
+async def _run_plugin(path: Path, fd: int) -> None:
+    from utils.plugin_manager import PluginManager
+
+    reader, writer = await asyncio.open_unix_connection(sock=socket.socket(fileno=fd), limit=_MAX_LINE)
+    channel = _Channel(writer)
+    root = logging.getLogger()
+    root.handlers[:] = [_ForwardLogs(channel)]
+    root.setLevel(logging.DEBUG)
+
+    bus = EventBus()
+    module_name = f"pyphira_plugin_{path.stem}"
+    log = logging.getLogger(f"plugin.{path.stem}")
+    started = time.perf_counter()
+    module = PluginManager._import_from_path(module_name, path)
+    import_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    teardown = None
+    if hasattr(module, "setup"):
+        result = module.setup(_SandboxContext(bus, path.stem, module_name, channel))
+        if callable(result):
+            teardown = result
+    setup_ms = (time.perf_counter() - started) * 1000
+    registry = _RemoteRegistry(channel)
+    bus.emit("commands.init", registry=registry, ctx=_CaptureContext(bus, log))
+    channel.send({"t": "ready", "import_ms": import_ms, "setup_ms": setup_ms})
+
+    async def beat() -> None:
+        while True:
+            await asyncio.sleep(1.0)
+            channel.send({"t": "beat", "cpu": time.process_time()})
+
+    beat_task = asyncio.create_task(beat())
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = _decode(line)
+            if msg["t"] == "events":
+                for event, payload in msg["items"]:
+                    bus.emit(event, **payload)
+                await asyncio.sleep(0)
+                channel.send({"t": "ack", "cpu": time.process_time()})
+            elif msg["t"] == "command":
+                channel.send(await _run_command(registry, msg, bus, log))
+    finally:
+        beat_task.cancel()
+        if teardown is not None:
+            teardown()
+
+
+async def _run_command(registry: _RemoteRegistry, msg: Dict[str, Any], bus: EventBus,
+                       log: logging.Logger) -> Dict[str, Any]:
+    cmd = registry.commands.get(str(msg["name"]).lower())
+    capture = _CaptureContext(bus, log)
+    error = None
+    if cmd is None:
+        error = "指令已被插件移除"
+    else:
+        try:
+            result = cmd.handler(capture, msg.get("args") or [])
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                await result
+        except Exception as e:
+            log.exception("Command failed: /%s", msg["name"])
+            error = str(e)
+    return {"t": "result", "id": msg["id"], "lines": capture.lines, "error": error}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    path, fd, nice = (argv if argv is not None else sys.argv[1:])[:3]
+    if int(nice) > 0:
+        os.nice(int(nice))
+    try:
+        asyncio.run(_run_plugin(Path(path), int(fd)))
+    except (ConnectionError, KeyboardInterrupt):
+        pass
+
+
+if __name__ == "__main__":
+    main()
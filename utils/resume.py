@@ -0,0 +1,167 @@
+"""Session resume: hold a player's room slot while they reconnect.
+
+The Phira client cannot be handed a server-issued token, but it presents the
+same Phira token again when it reconnects. A :class:`ResumeTicket` is keyed
+by that token and remembers the player's profile and room for a short grace
+window; claiming it lets ``handleAuthenticate`` skip the upstream API call
+and put the player straight back into their room.
+
+While a slot is held the player's :class:`~utils.room.RoomUser` stays in the
+room with a :class:`DetachedConnection` in place of the socket, so ready /
+finished state and host status are untouched. If nobody claims the ticket in
+time ``on_expire`` runs and the player leaves normally.
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from utils import clock
+
+logger = logging.getLogger(__name__)
+
+
+class DetachedConnection:
+    """Stands in for the socket of a player whose slot is being held.
+
+    Packets sent to it are dropped (the client gets a fresh room state on
+    resume); it reports itself closed so nothing waits on it.
+    """
+
+    __slots__ = ("user_id", "receiver", "closeHandler", "writer", "dropped")
+
+    def __init__(self, user_id) -> None:
+        self.user_id = user_id
+        self.receiver = None
+        self.closeHandler = None
+        self.writer = None
+        self.dropped = 0
+
+    def send(self, packet) -> None:
+        self.dropped += 1
+
+    def set_receiver(self, receiver) -> None:
+        self.receiver = receiver
+
+    def on_close(self, close_handler) -> None:
+        self.closeHandler = close_handler
+
+    def is_closed(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+    async def close_and_wait(self, writer_timeout: float = 2) -> None:
+        pass
+
+    def __repr__(self) -> str:
+        return f"<DetachedConnection user={self.user_id} dropped={self.dropped}>"
+
+
+class ResumeTicket:
+    __slots__ = ("token", "profile", "room_id", "expires", "on_expire", "timer")
+
+    def __init__(self, token: str, profile, room_id, expires: float, on_expire: Optional[Callable[[], None]]) -> None:
+        self.token = token
+        self.profile = profile
+        self.room_id = room_id
+        self.expires = expires
+        self.on_expire = on_expire
+        self.timer = None
+
+    @property
+    def user_id(self):
+        return self.profile.id
+
+
+class ResumeRegistry:
+    """Resume tickets by Phira token.
+
+    With a ``wheel`` (:class:`utils.timerwheel.TimerWheel`) expired tickets
+    are dropped and ``on_expire`` runs on time; without one they are only
+    discarded lazily when looked up.
+    """
+
+    def __init__(self, grace: float = 60.0, *, wheel=None) -> None:
+        self.grace = float(grace)
+        self.wheel = wheel
+        self._tickets: Dict[str, ResumeTicket] = {}
+        self._by_user: Dict[Any, str] = {}
+        self.stats: Dict[str, int] = {"held": 0, "resumed": 0, "expired": 0}
+
+    def hold(self, token: str, profile, room_id, *, on_expire: Optional[Callable[[], None]] = None,
+             grace: Optional[float] = None) -> ResumeTicket:
+        """Hold ``profile``'s slot in ``room_id`` for ``grace`` seconds (default: the registry's)."""
+        self.drop_user(profile.id)
+        grace = self.grace if grace is None else max(0.0, grace)
+        ticket = ResumeTicket(token, profile, room_id, clock.monotonic() + grace, on_expire)
+        self._tickets[token] = ticket
+        self._by_user[profile.id] = token
+        if self.wheel is not None:
+            ticket.timer = self.wheel.call_later(grace, self._expire, ticket)
+        self.stats["held"] += 1
+        logger.info("Holding slot of user %s in room %s for %.0fs", profile.id, room_id, grace)
+        return ticket
+
+    def peek(self, token: str) -> Optional[ResumeTicket]:
+        ticket = self._tickets.get(token)
+        if ticket is not None and ticket.expires <= clock.monotonic():
+            self._expire(ticket)
+            return None
+        return ticket
+
+    def claim(self, token: str) -> Optional[ResumeTicket]:
+        """Take the ticket for ``token`` (if still valid); its expiry callback will not run."""
+        ticket = self.peek(token)
+        if ticket is None:
+            return None
+        self._forget(ticket)
+        self.stats["resumed"] += 1
+        return ticket
+
+    def claim_user(self, user_id) -> Optional[ResumeTicket]:
+        """Same as :meth:`claim`, for a player who came back with a new Phira token."""
+        token = self._by_user.get(user_id)
+        return self.claim(token) if token is not None else None
+
+    def drop_user(self, user_id) -> Optional[ResumeTicket]:
+        """Discard a held ticket without running its expiry callback."""
+        token = self._by_user.get(user_id)
+        if token is None:
+            return None
+        ticket = self._tickets[token]
+        self._forget(ticket)
+        return ticket
+
+    def ticket_of(self, user_id) -> Optional[ResumeTicket]:
+        token = self._by_user.get(user_id)
+        return self._tickets.get(token) if token is not None else None
+
+    def _forget(self, ticket: ResumeTicket) -> None:
+        if self._tickets.get(ticket.token) is ticket:
+            del self._tickets[ticket.token]
+        if self._by_user.get(ticket.user_id) == ticket.token:
+            del self._by_user[ticket.user_id]
+        if ticket.timer is not None:
+            ticket.timer.cancel()
+            ticket.timer = None
+
+    def _expire(self, ticket: ResumeTicket) -> None:
+        if self._tickets.get(ticket.token) is not ticket:
+            return
+        self._forget(ticket)
+        self.stats["expired"] += 1
+        logger.info("Resume window of user %s expired", ticket.user_id)
+        if ticket.on_expire is not None:
+            try:
+                ticket.on_expire()
+            except Exception:
+                logger.exception("Resume expiry callback failed for user %s", ticket.user_id)
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def __iter__(self) -> Iterator[ResumeTicket]:
+        return iter(list(self._tickets.values()))
@@ -1,19 +1,231 @@
 from rymc.phira.protocol.data.state import *
+import heapq
 import logging
+import random
+
+from utils.metrics import Traffic
 
 logger = logging.getLogger(__name__)
 
+_STATE_NAMES = {"selectchart": SelectChart, "waitforready": WaitForReady, "playing": Playing}
+INDEXED = ("state", "chart", "locked", "live", "occupancy")
+_UNINDEXED = (None,) * len(INDEXED)
+
+
+def state_type(name):
+    """"select_chart" / "SelectChart" / "playing" ... -> 状态类（未知名称返回 None）"""
+    return _STATE_NAMES.get(str(name).replace("_", "").lower())
+
+
+def occupancy_bucket(count):
+    """人数分桶：0, 1, 2-3, 4-7, 8-15 ... 以桶的下界表示"""
+    return 1 << (count.bit_length() - 1) if count else 0
+
+
+class RoomTable(dict):
+    """房间表：在增删改房间时顺带维护二级索引和单调递增的版本号 ``version``。
+
+    房间列表中可见的任何变化（增删房间、成员进出、房主、锁定、循环、直播、状态/谱面）
+    都要经过 :meth:`touch`：``version`` 加一，重新登记该房间在索引（``INDEXED``：
+    状态类、谱面号、是否锁定、是否直播、人数分桶）中的位置，并以房间号通知
+    ``watchers`` 中的回调（http_api 的房间快照）。本模块的函数会自动处理，直接改
+    Room 字段的代码需要再调用 :meth:`touch`。这样统计（/metrics）、查询
+    （:meth:`query`）、缓存（/room）、推送以及加入房间时的成员检查（``members``）
+    都不需要每次遍历所有房间。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.index = {field: {} for field in INDEXED}
+        self._keys = {}
+        # 成员索引：玩家 id -> 所在房间号（加入/离开房间时 O(1) 判断“是否已在房间内”）
+        self.members = {}
+        self._users = {}
+        self.version = 0
+        self.watchers = []
+
+    @property
+    def by_state(self):
+        """{状态类: 房间数}"""
+        states = self.index["state"]
+        return {kind: len(states.get(kind, ())) for kind in (SelectChart, WaitForReady, Playing)}
+
+    def touch(self, roomId):
+        """房间 ``roomId`` 在房间列表中可见的内容变了（或房间被增删）"""
+        self.version += 1
+        self._reindex(roomId)
+        self._sync_members(roomId)
+        for watcher in self.watchers:
+            watcher(roomId)
+
+    def _reindex(self, roomId):
+        room = self.get(roomId)
+        keys = None if room is None else (
+            type(room.state), room.chart, bool(room.locked), bool(room.live), occupancy_bucket(len(room.users)))
+        old = self._keys.get(roomId)
+        if keys == old:
+            return
+        for field, before, after in zip(INDEXED, old or _UNINDEXED, keys or _UNINDEXED):
+            if old is not None and keys is not None and before == after:
+                continue
+            index = self.index[field]
+            if old is not None:
+                members = index[before]
+                members.discard(roomId)
+                if not members:
+                    del index[before]
+            if keys is not None:
+                index.setdefault(after, set()).add(roomId)
+        if keys is None:
+            del self._keys[roomId]
+        else:
+            self._keys[roomId] = keys
+
+    def _sync_members(self, roomId):
+        room = self.get(roomId)
+        users = frozenset(room.users) if room is not None else frozenset()
+        old = self._users.get(roomId, frozenset())
+        if users == old:
+            return
+        for uid in old - users:
+            if self.members.get(uid) == roomId:
+                del self.members[uid]
+        for uid in users - old:
+            self.members[uid] = roomId
+        if users:
+            self._users[roomId] = users
+        else:
+            self._users.pop(roomId, None)
+
+    def __setitem__(self, roomId, room):
+        super().__setitem__(roomId, room)
+        self.touch(roomId)
+
+    def __delitem__(self, roomId):
+        super().__delitem__(roomId)
+        self.touch(roomId)
+
+    def pop(self, roomId, *default):
+        if roomId not in self:
+            return super().pop(roomId, *default)
+        room = super().pop(roomId)
+        self.touch(roomId)
+        return room
+
+    def popitem(self):
+        roomId, room = super().popitem()
+        self.touch(roomId)
+        return roomId, room
+
+    def setdefault(self, roomId, room=None):
+        if roomId not in self:
+            self[roomId] = room
+        return self[roomId]
+
+    def update(self, *args, **kwargs):
+        for roomId, room in dict(*args, **kwargs).items():
+            self[roomId] = room
+
+    def clear(self):
+        removed = list(self)
+        super().clear()
+        for roomId in removed:
+            self.touch(roomId)
+
+    def query(self, *, state=None, chart=None, locked=None, live=None, min_players=None, max_players=None,
+              where=None, after=None, limit=50):
+        """按索引筛选房间，按房间号（字符串）排序分页。
+
+        ``state`` 为状态类，``where(roomId, room)`` 为附加的逐个判断（例如人数上限）；
+        ``after`` 是上一页返回的游标。返回 ``(本页的 [(roomId, room)], 下一页游标或 None,
+        符合条件的总数)``。
+        """
+        candidates = []
+        for field, value in (("state", state), ("chart", chart), ("locked", locked), ("live", live)):
+            if value is not None:
+                candidates.append(self.index[field].get(value, ()))
+        if min_players is not None or max_players is not None:
+            low = min_players or 0
+            high = max_players
+            buckets = set()
+            for bucket, members in self.index["occupancy"].items():
+                # 桶覆盖 [bucket, 2 * bucket - 1]（0 与 1 各自成桶）
+                top = max(bucket, 2 * bucket - 1)
+                if top >= low and (high is None or bucket <= high):
+                    buckets.update(members)
+            candidates.append(buckets)
+        if candidates:
+            candidates.sort(key=len)
+            first, rest = candidates[0], candidates[1:]
+            ids = [rid for rid in first if all(rid in other for other in rest)]
+        else:
+            ids = list(self)
+
+        matches = []
+        for rid in ids:
+            room = self[rid]
+            count = len(room.users)
+            if min_players is not None and count < min_players:
+                continue
+            if max_players is not None and count > max_players:
+                continue
+            if where is not None and not where(rid, room):
+                continue
+            matches.append(str(rid))
+        total = len(matches)
+        if after is not None:
+            after = str(after)
+            matches = [key for key in matches if key > after]
+        page = heapq.nsmallest(limit + 1, matches)
+        more = len(page) > limit
+        page = page[:limit]
+        by_key = {str(rid): rid for rid in ids} if page else {}
+        return [(by_key[key], self[by_key[key]]) for key in page], (page[-1] if more else None), total
+
+
 # 全局房间"列表"（实际是 dict）
-rooms = {}
+rooms = RoomTable()
+
+# 房主转移用的随机数生成器；模拟/测试时可 rng.seed(...) 得到可复现的结果
+rng = random.Random()
+
+
+
+class Limits:
+    """人数上限（None 表示不限）。
+
+    ``room_default``: 没有单独设置 ``Room.max_users`` 的房间使用的上限；
+    ``online``: 整个服务器同时在线的玩家数，满员时新的登录在鉴权阶段就被拒绝。
+    """
+    __slots__ = ("room_default", "online")
+
+    def __init__(self, room_default=None, online=None):
+        self.room_default = room_default
+        self.online = online
+
+
+limits = Limits()
+
+# 多进程/多节点共享的房间目录（提供 claim(roomId) -> bool 与 release(roomId)）；
+# 单进程运行时为 None，房间号只在本进程内判重
+room_directory = None
 
 # RoomUser 类：用于存储用户的详细信息和其网络连接
 class RoomUser:
     """一个简单的容器，用于存储用户信息和其连接。"""
+    __slots__ = ("info", "connection")
+
     def __init__(self, user_info, connection):
         self.info = user_info      # 存储 UserProfile/UserInfo 对象
         self.connection = connection # 存储 Connection 对象
 
 class Room:
+    # 使用 __slots__ 省去每个房间的 __dict__；需要新增字段时在这里声明
+    __slots__ = (
+        "id", "host", "state", "live", "locked", "cycle", "users", "monitors",
+        "chart", "ready", "finished", "contest_mode", "whitelist", "traffic", "max_users",
+    )
+
     def __init__(self, roomId):
         self.id = roomId
         self.host = None
@@ -26,6 +238,10 @@ class Room:
         self.chart = None
         self.ready = {} # 用于存储用户是否准备好的状态
         self.finished = {} # 用于存储用户是否完成游戏的状态
+        self.contest_mode = False # 比赛模式（由 http_api 插件设置）
+        self.whitelist = [] # 比赛模式白名单
+        self.traffic = Traffic() # 房间内所有连接的收发计数
+        self.max_users = None # 人数上限；None 时使用 limits.room_default
 
 # 初始化监控列表
 monitors = [] # 先初始化为空列表
@@ -37,18 +253,27 @@ except FileNotFoundError:
     logger.warning("monitors.txt not found. No monitors loaded.")
 
 
+def room_capacity(room):
+    """房间的人数上限（None 表示不限）"""
+    return room.max_users if room.max_users is not None else limits.room_default
+
+def has_space(room):
+    capacity = room_capacity(room)
+    return capacity is None or len(room.users) < capacity
+
 def create_room(roomId, user_info):
     """Create a room with the given ID.
     房间创建返回定义:
     0: 成功
     1: 房间已存在
     2: 玩家已在房间内"""
-    for existing_room_id, room in rooms.items():
-        if user_info.id in room.users:
-            return {"status": "2"}
+    if user_info.id in rooms.members:
+        return {"status": "2"}
 
     if roomId in rooms:                 # 已存在
         return {"status": "1"}
+    if room_directory is not None and not room_directory.claim(roomId):
+        return {"status": "1"}          # 已存在于其他进程/节点
     rooms[roomId] = Room(roomId)       # 初始化并放入字典
     # 设置房主
     rooms[roomId].host = user_info.id
@@ -62,8 +287,19 @@ def destroy_room(roomId):
     if roomId not in rooms:            # 房间不存在
         return {"status": "1"}
     del rooms[roomId]
+    if room_directory is not None:
+        try:
+            room_directory.release(roomId)
+        except Exception:
+            logger.exception(f"Failed to release room {roomId} in directory")
     return {"status": "0"}
 
+def bind_traffic(connection, room):
+    """让连接的收发计数同时记到 room 上（None 表示不再属于任何房间）"""
+    # DetachedConnection / LoopbackConnection 等替身没有计数字段
+    if hasattr(connection, "room_traffic"):
+        connection.room_traffic = room.traffic if room is not None else None
+
 def add_user(roomId, user_info, connection):
     """Add a user to the room.
     返回定义:
@@ -71,24 +307,48 @@ def add_user(roomId, user_info, connection):
     1: 房间不存在
     2: 用户已存在
     3: 房间已锁定
-    4: 玩家已在房间内"""
+    4: 玩家已在房间内
+    5: 房间已满"""
     logger.info(f"{user_info.id} 正在加入房间 {roomId}")
-    
-    for existing_room_id, room in rooms.items():
-        if user_info.id in room.users:
-            return {"status": "3"}
-            
-    if roomId not in rooms:            # 房间不存在
+
+    room = rooms.get(roomId)
+    if room is None:                   # 房间不存在
         logger.warning(f"{user_info.id} 试图加入不存在的房间 {roomId}")
         return {"status": "1"}
-    if user_info.id in rooms[roomId].users: # 用户已存在
+    current = rooms.members.get(user_info.id)
+    if current == roomId:              # 用户已存在
         logger.warning(f"{user_info.id} 试图重复加入房间 {roomId}")
         return {"status": "2"}
-    if rooms[roomId].locked:
+    if current is not None:            # 已在其他房间内
+        return {"status": "4"}
+    if room.locked:
         logger.warning(f"{user_info.id} 试图加入已锁定的房间 {roomId}")
         return {"status": "3"}
+    if not has_space(room):
+        logger.info(f"{user_info.id} 试图加入已满的房间 {roomId} ({len(room.users)}/{room_capacity(room)})")
+        return {"status": "5"}
     # 【修改】现在存储 RoomUser 实例，而不是直接存储 user_info
-    rooms[roomId].users[user_info.id] = RoomUser(user_info, connection)
+    room.users[user_info.id] = RoomUser(user_info, connection)
+    rooms.touch(roomId)
+    bind_traffic(connection, room)
+    return {"status": "0"}
+
+def set_default_max_users(max_users):
+    """Set ``limits.room_default``; rooms without their own limit are touched (their listing changes)."""
+    limits.room_default = max_users
+    for roomId, room in rooms.items():
+        if room.max_users is None:
+            rooms.touch(roomId)
+
+def set_max_users(roomId, max_users):
+    """Set the player limit of the room (None: use ``limits.room_default``).
+    返回定义:
+    0: 成功
+    1: 房间不存在"""
+    if roomId not in rooms:            # 房间不存在
+        return {"status": "1"}
+    rooms[roomId].max_users = max_users
+    rooms.touch(roomId)
     return {"status": "0"}
 
 def add_monitor(roomId, monitor_id):
@@ -108,6 +368,7 @@ def add_monitor(roomId, monitor_id):
     # 设置live为True
     if not rooms[roomId].live:
         rooms[roomId].live = True
+        rooms.touch(roomId)
     return {"status": "0"}
 
 def get_host(roomId):
@@ -125,10 +386,9 @@ def get_roomId(user_id):
     返回定义:
     0: 成功
     1: 用户不存在"""
-    # [优化] 虽然这里没有覆盖参数，但为了统一代码风格，将循环变量改为 r_id
-    for r_id, room in rooms.items():
-        if user_id in room.users:
-            return {"roomId": r_id}
+    r_id = rooms.members.get(user_id)
+    if r_id is not None:
+        return {"roomId": r_id}
     return {"status": "1"}
 
 def change_host(roomId, host_id):
@@ -142,8 +402,22 @@ def change_host(roomId, host_id):
     if host_id not in rooms[roomId].users: # 新房主不存在
         return {"status": "2"}
     rooms[roomId].host = host_id
+    rooms.touch(roomId)
     return {"status": "0"}
 
+def choose_new_host(roomId, exclude=None):
+    """Randomly pick a new host among the room members (using ``rng``).
+    返回定义:
+    0: 成功
+    1: 房间不存在
+    2: 没有可选的成员"""
+    if roomId not in rooms:            # 房间不存在
+        return {"status": "1"}
+    candidates = [uid for uid in rooms[roomId].users if uid != exclude]
+    if not candidates:
+        return {"status": "2"}
+    return {"status": "0", "host": rng.choice(candidates)}
+
 def room_lock_state_change(roomId):
     """Lock the room.
     返回定义:
@@ -156,6 +430,7 @@ def room_lock_state_change(roomId):
         rooms[roomId].locked = False
     else:
         rooms[roomId].locked = True
+    rooms.touch(roomId)
     return {"status": "0"}
 
 def set_state(roomId, state):
@@ -166,6 +441,7 @@ def set_state(roomId, state):
     if roomId not in rooms:            # 房间不存在
         return {"status": "1"}
     rooms[roomId].state = state
+    rooms.touch(roomId)
     return {"status": "0"}
 
 def set_cycle_mode(roomId, cycle):
@@ -176,6 +452,7 @@ def set_cycle_mode(roomId, cycle):
     if roomId not in rooms:            # 房间不存在
         return {"status": "1"}
     rooms[roomId].cycle = cycle
+    rooms.touch(roomId)
     return {"status": "0"}
 
 def set_chart(roomId, chart):
@@ -203,7 +480,8 @@ def player_leave(roomId, user_id):
         return {"status": "2"}
 
     # 从 users 中删除
-    del rooms[roomId].users[user_id]
+    bind_traffic(rooms[roomId].users.pop(user_id).connection, None)
+    rooms.touch(roomId)
     # 顺便清理 ready 和 finished 状态，防止脏数据影响逻辑
     if user_id in rooms[roomId].ready:
         del rooms[roomId].ready[user_id]
@@ -0,0 +1,227 @@
+"""房间状态机 (room state machine).
+
+A room is always in one of three phases, mirrored by the protocol state
+object stored in ``room.state``::
+
+    SELECT_CHART --request_start--> WAIT_FOR_READY --start_playing--> PLAYING
+         ^  |select_chart               |cancel_start                  |end_round
+         |  v                           v                              |
+         +------------------------------+------------------------------+
+
+Every action a handler can take on a room — phase changes as well as the
+per-player actions that are only legal in one phase (ready, played, ...) —
+is declared once in :data:`TRANSITIONS` together with its guards. Handlers
+call :func:`apply` (or :func:`check` for a dry run of the guards) and get
+the usual status dict back, so illegal transitions are rejected in one
+place. Joining goes through ``apply(..., "join", user_info=, connection=)``
+too, which adds the player with :func:`utils.room.add_user`.
+
+Readiness and completion are the sizes of ``room.ready`` / ``room.finished``;
+both only ever hold current members (``player_leave`` removes leavers), so
+:func:`all_ready` / :func:`all_finished` are O(1) length comparisons.
+
+Hooks: ``add_hook(before=..., after=...)``. Both only run in :func:`apply`:
+a before-hook returning a string vetoes the transition with that message;
+after-hooks are notified once the transition has been applied. ``main`` bridges them onto the event bus as
+``room.transition.before`` / ``room.transition.after`` for plugins.
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Dict, FrozenSet, List, Optional
+
+from rymc.phira.protocol.data.state import Playing, SelectChart, WaitForReady
+from utils.room import add_user, has_space, rooms, set_finished, set_ready, set_state
+
+logger = logging.getLogger(__name__)
+
+
+class Phase(Enum):
+    SELECT_CHART = "select_chart"
+    WAIT_FOR_READY = "wait_for_ready"
+    PLAYING = "playing"
+
+
+_PHASE_OF_STATE = {
+    SelectChart: Phase.SELECT_CHART,
+    WaitForReady: Phase.WAIT_FOR_READY,
+    Playing: Phase.PLAYING,
+}
+
+
+def phase_of(room) -> Phase:
+    return _PHASE_OF_STATE[type(room.state)]
+
+
+@dataclass(frozen=True)
+class Transition:
+    name: str
+    source: FrozenSet[Phase]
+    target: Optional[Phase] = None      # None: 不改变房间阶段（玩家级动作）
+    host_only: bool = False
+    member_only: bool = True            # False: 由服务器自身触发，不要求 user_id
+    rejected: str = "not_select_chart"  # 阶段不符时的 i10n key
+    rejected_by_phase: Dict[Phase, str] = field(default_factory=dict)
+
+    def reason_for(self, phase: Phase) -> str:
+        return self.rejected_by_phase.get(phase, self.rejected)
+
+
+_S, _W, _P = Phase.SELECT_CHART, Phase.WAIT_FOR_READY, Phase.PLAYING
+
+TRANSITIONS: Dict[str, Transition] = {t.name: t for t in (
+    Transition("join", frozenset({_S}), member_only=False,
+               rejected_by_phase={_W: "room_in_ready_state", _P: "room_in_playing_state"}),
+    Transition("select_chart", frozenset({_S}), _S, host_only=True),
+    Transition("request_start", frozenset({_S}), _W, host_only=True),
+    Transition("ready", frozenset({_W}), rejected="not_ready_state"),
+    Transition("cancel_ready", frozenset({_W}), rejected="not_ready_state"),
+    Transition("cancel_start", frozenset({_W}), _S, host_only=True, rejected="not_ready_state"),
+    Transition("start_playing", frozenset({_W}), _P, member_only=False, rejected="not_ready_state"),
+    Transition("played", frozenset({_P}), rejected="not_playing_state"),
+    Transition("abort", frozenset({_P}), rejected="not_playing_state"),
+    Transition("end_round", frozenset({_P}), _S, member_only=False, rejected="not_playing_state"),
+)}
+
+
+BeforeHook = Callable[[Any, Transition, Optional[int]], Optional[str]]
+AfterHook = Callable[[Any, Transition, Optional[int], Phase], None]
+
+_before_hooks: List[BeforeHook] = []
+_after_hooks: List[AfterHook] = []
+
+
+def add_hook(*, before: Optional[BeforeHook] = None, after: Optional[AfterHook] = None) -> None:
+    if before is not None:
+        _before_hooks.append(before)
+    if after is not None:
+        _after_hooks.append(after)
+
+
+def remove_hook(hook) -> None:
+    for hooks in (_before_hooks, _after_hooks):
+        if hook in hooks:
+            hooks.remove(hook)
+
+
+# add_user 的失败状态 -> i10n key
+_JOIN_REJECTED = {
+    "1": "room_not_exist",
+    "2": "user_already_exist",
+    "3": "room_already_locked",
+    "4": "room_duplicate_join",
+    "5": "room_full",
+}
+
+
+def check(roomId, action, user_id=None):
+    """Validate ``action`` against the room's phase, membership and host guards.
+    Changes nothing and runs no hooks.
+    返回定义:
+    0: 允许
+    1: 房间不存在
+    2: 当前阶段不允许该操作 (reason 为 i10n key)
+    3: 不是房主 (reason 为 i10n key)
+    4: 用户不在房间内 (reason 为 i10n key)
+    6: 无法加入（已在房间内、房间已锁定或已满，reason 为 i10n key）"""
+    transition = TRANSITIONS[action]
+    room = rooms.get(roomId)
+    if room is None:
+        return {"status": "1", "reason": "room_not_exist"}
+    phase = phase_of(room)
+    if phase not in transition.source:
+        return {"status": "2", "reason": transition.reason_for(phase)}
+    if transition.member_only and user_id not in room.users:
+        return {"status": "4", "reason": "user_not_exist"}
+    if transition.host_only and room.host != user_id:
+        return {"status": "3", "reason": "not_host"}
+    if action == "join":
+        # 与 add_user 的判定一致，加入失败时不触发任何钩子
+        current = rooms.members.get(user_id)
+        if current is not None:
+            return {"status": "6", "reason": "user_already_exist" if current == roomId else "room_duplicate_join"}
+        if room.locked:
+            return {"status": "6", "reason": "room_already_locked"}
+        if not has_space(room):
+            return {"status": "6", "reason": "room_full"}
+    return {"status": "0", "phase": phase}
+
+
+def apply(roomId, action, user_id=None, *, chart=None, user_info=None, connection=None):
+    """Check, run the before-hooks and perform ``action``.
+    返回定义: 同 :func:`check`，另有
+    5: 被钩子拒绝 (message 为拒绝原因)"""
+    result = check(roomId, action, user_id)
+    if result["status"] != "0":
+        return result
+    room = rooms[roomId]
+    transition = TRANSITIONS[action]
+    source = result["phase"]
+    for hook in list(_before_hooks):
+        try:
+            message = hook(room, transition, user_id)
+        except Exception:
+            logger.exception("Room transition hook failed: %s", action)
+            continue
+        if message:
+            return {"status": "5", "message": str(message)}
+
+    if action == "join":
+        joined = add_user(roomId, user_info, connection)
+        if joined["status"] != "0":
+            return {"status": "6", "reason": _JOIN_REJECTED[joined["status"]]}
+    elif action == "select_chart":
+        room.chart = chart
+        set_state(roomId, SelectChart(chartId=chart))
+    elif action == "request_start":
+        room.ready.clear()
+        set_state(roomId, WaitForReady())
+        # 发起者（房主）视为已准备
+        set_ready(roomId, user_id)
+    elif action == "ready":
+        set_ready(roomId, user_id)
+    elif action == "cancel_ready":
+        room.ready.pop(user_id, None)
+    elif action == "cancel_start":
+        room.ready.clear()
+        set_state(roomId, SelectChart(chartId=room.chart))
+    elif action == "start_playing":
+        room.ready.clear()
+        room.finished.clear()
+        set_state(roomId, Playing())
+    elif action in ("played", "abort"):
+        set_finished(roomId, user_id)
+    elif action == "end_round":
+        room.finished.clear()
+        room.chart = None
+        set_state(roomId, SelectChart(chartId=None))
+
+    for hook in list(_after_hooks):
+        try:
+            hook(room, transition, user_id, source)
+        except Exception:
+            logger.exception("Room transition hook failed: %s", action)
+    return {"status": "0", "from": source, "to": transition.target or source}
+
+
+def all_ready(roomId) -> bool:
+    """True when the room waits for ready and every member is ready. O(1)."""
+    room = rooms.get(roomId)
+    return (
+        room is not None
+        and type(room.state) is WaitForReady
+        and 0 < len(room.users) == len(room.ready)
+    )
+
+
+def all_finished(roomId) -> bool:
+    """True when the room is playing and every member has played/aborted. O(1)."""
+    room = rooms.get(roomId)
+    return (
+        room is not None
+        and type(room.state) is Playing
+        and 0 < len(room.users) == len(room.finished)
+    )
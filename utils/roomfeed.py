@@ -0,0 +1,197 @@
+"""Room list snapshots and the push-based room change feed.
+
+:class:`RoomSnapshots` runs on the game loop and watches
+``utils.room.rooms`` (``RoomTable.watchers``). Each mutation only adds the
+room id to a dirty set. Once per ``tick`` the dirty rooms are rendered with
+``view(room)`` into a new immutable :class:`Snapshot`. The snapshot's view
+dict is a copy; its entries are shared with the previous snapshot. Readers
+on any thread (``http_api``'s ``/room``, and its whole service when it runs
+in its own thread) use ``snapshots.current`` and never touch live rooms.
+
+:class:`RoomFeed` lives on the consumer's loop. It gets every snapshot in
+order, compares the changed rooms with the previous snapshot and turns
+them into deltas::
+
+    {"op": "created",   "roomid": ..., "room": {...}}
+    {"op": "destroyed", "roomid": ...}
+    {"op": "joined",    "roomid": ..., "user": {"id": ..., "name": ...}}
+    {"op": "left",      "roomid": ..., "user": id}
+    {"op": "state",     "roomid": ..., "state": ..., "chart": {...}}
+    {"op": "host",      "roomid": ..., "host": {...}}
+    {"op": "lock" / "cycle", "roomid": ..., "value": bool}
+    {"op": "max_users", "roomid": ..., "value": int or null}
+
+A tick's deltas are encoded once and the same bytes are queued for every
+subscriber, so N viewers cost one serialization plus N queue appends. A
+subscriber whose queue is full (it reads slower than the feed produces) is
+dropped; it can reconnect and start over from a fresh snapshot.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set
+
+from utils.room import rooms
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(event: str, payload: Dict[str, Any]) -> bytes:
+    """One server-sent event."""
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {event}\ndata: {data}\n\n".encode("utf-8")
+
+
+class Snapshot:
+    __slots__ = ("seq", "views", "changed")
+
+    def __init__(self, seq: int, views: Dict[Any, Dict[str, Any]], changed: FrozenSet[Any]) -> None:
+        self.seq = seq
+        self.views = views          # room id -> view；发布后不再修改
+        self.changed = changed      # 相比 seq - 1 变化（含增删）的房间号
+
+
+class RoomSnapshots:
+    def __init__(self, view: Callable[[Any], Dict[str, Any]], *, tick: float = 0.1) -> None:
+        self.view = view
+        self.tick = tick
+        self.current = Snapshot(0, {}, frozenset())
+        # 每个新快照都会（在游戏循环上）依次交给这些回调
+        self.listeners: List[Callable[[Snapshot], None]] = []
+        self._dirty: Set[Any] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> None:
+        """Build the first snapshot from all rooms and start watching (on the game loop)."""
+        self.current = Snapshot(self.current.seq + 1, {rid: self.view(room) for rid, room in rooms.items()},
+                                frozenset(rooms))
+        rooms.watchers.append(self._mark)
+
+    def close(self) -> None:
+        if self._mark in rooms.watchers:
+            rooms.watchers.remove(self._mark)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _mark(self, roomId) -> None:
+        self._dirty.add(roomId)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.tick, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, set()
+        views = dict(self.current.views)
+        for rid in dirty:
+            room = rooms.get(rid)
+            if room is None:
+                views.pop(rid, None)
+            else:
+                views[rid] = self.view(room)
+        self.current = snapshot = Snapshot(self.current.seq + 1, views, frozenset(dirty))
+        for listener in list(self.listeners):
+            try:
+                listener(snapshot)
+            except Exception:
+                logger.exception("Room snapshot listener failed")
+
+
+class Subscriber:
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self, backlog: int) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=backlog)
+        self.dropped = False
+
+
+class RoomFeed:
+    """Deltas between consecutive snapshots; ``on_snapshot`` must be called on the subscribers' loop."""
+
+    def __init__(self, start: Snapshot, *, backlog: int = 64) -> None:
+        self.backlog = backlog
+        self.current = start
+        self.subscribers: Set[Subscriber] = set()
+        self.dropped = 0
+        self._encoded: Optional[bytes] = None
+
+    def subscribe(self) -> Subscriber:
+        sub = Subscriber(self.backlog)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        self.subscribers.discard(sub)
+
+    def snapshot(self) -> bytes:
+        """The current rooms as a ``snapshot`` event (shared until the next snapshot)."""
+        if self._encoded is None:
+            current = self.current
+            self._encoded = _encode("snapshot", {"seq": current.seq, "rooms": list(current.views.values())})
+        return self._encoded
+
+    def on_snapshot(self, snapshot: Snapshot) -> None:
+        previous = self.current
+        if snapshot.seq <= previous.seq:
+            return
+        self.current = snapshot
+        self._encoded = None
+        if not self.subscribers:
+            return
+        if snapshot.seq == previous.seq + 1:
+            changed = snapshot.changed
+        else:
+            # 中间漏了快照（例如 feed 是后来才接上的）：比较全部房间
+            changed = previous.views.keys() | snapshot.views.keys()
+        changes: List[Dict[str, Any]] = []
+        for rid in changed:
+            old = previous.views.get(rid)
+            new = snapshot.views.get(rid)
+            if new is None:
+                if old is not None:
+                    changes.append({"op": "destroyed", "roomid": old["roomid"]})
+            elif old is None:
+                changes.append({"op": "created", "roomid": new["roomid"], "room": new})
+            elif old is not new:
+                changes.extend(self._diff(old, new))
+        if not changes:
+            return
+        chunk = _encode("delta", {"seq": snapshot.seq, "changes": changes})
+        for sub in list(self.subscribers):
+            try:
+                sub.queue.put_nowait(chunk)
+            except asyncio.QueueFull:
+                self._drop(sub)
+
+    @staticmethod
+    def _diff(old: Dict[str, Any], new: Dict[str, Any]) -> List[Dict[str, Any]]:
+        rid = new["roomid"]
+        out: List[Dict[str, Any]] = []
+        before = {p["id"] for p in old["players"]}
+        after = {p["id"] for p in new["players"]}
+        for player in new["players"]:
+            if player["id"] not in before:
+                out.append({"op": "joined", "roomid": rid, "user": player})
+        for uid in before - after:
+            out.append({"op": "left", "roomid": rid, "user": uid})
+        if old["state"] != new["state"] or old["chart"] != new["chart"]:
+            out.append({"op": "state", "roomid": rid, "state": new["state"], "chart": new["chart"]})
+        if old["host"] != new["host"]:
+            out.append({"op": "host", "roomid": rid, "host": new["host"]})
+        for key in ("lock", "cycle", "max_users"):
+            if old[key] != new[key]:
+                out.append({"op": key, "roomid": rid, "value": new[key]})
+        return out
+
+    def _drop(self, sub: Subscriber) -> None:
+        # 积压已满：清空队列，只留一个结束标记，由订阅者自己退出
+        sub.dropped = True
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+        self.dropped += 1
+        self.subscribers.discard(sub)
+        logger.info("Dropped a slow room feed subscriber (%d subscribers left)", len(self.subscribers))
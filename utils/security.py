@@ -38,6 +38,9 @@ class SecurityStore:
         self.bans: List[BanRecord] = []
         self.blacklist_ips: Dict[str, Optional[float]] = {}  # ip -> expire_at
         self.ops: set[str] = set()
+        # 查询计数（/metrics）：键为 "id" / "ip" / "blacklist_ip"
+        self.lookups: Dict[str, int] = {}
+        self.matches: Dict[str, int] = {}
         self.load()
 
     def load(self) -> None:
@@ -115,11 +118,18 @@ class SecurityStore:
         self.cleanup()
         return list(self.bans)
 
+    def _counted(self, kind: str, matched: bool) -> None:
+        self.lookups[kind] = self.lookups.get(kind, 0) + 1
+        if matched:
+            self.matches[kind] = self.matches.get(kind, 0) + 1
+
     def is_banned(self, ban_type: BanType, target: str) -> Optional[BanRecord]:
         self.cleanup()
         for b in self.bans:
             if b.type == ban_type and b.target == target:
+                self._counted(ban_type, True)
                 return b
+        self._counted(ban_type, False)
         return None
 
     # ---- blacklist ip ----
@@ -144,7 +154,9 @@ class SecurityStore:
 
     def is_blacklisted_ip(self, ip: str) -> bool:
         self.cleanup()
-        return ip in self.blacklist_ips
+        listed = ip in self.blacklist_ips
+        self._counted("blacklist_ip", listed)
+        return listed
 
     # ---- ops ----
     def op(self, pid: str) -> None:
@@ -5,6 +5,7 @@ import logging
 from typing import Any, Callable, Optional
 
 from utils.connection import Connection
+from utils.metrics import totals
 from utils.asyncioutil import *
 
 
@@ -15,11 +16,13 @@ SUPPORTED_VERSIONS = [1]
 
 class Server:
 
-    def __init__(self, host, port, handler, *, security_store: Any = None):
+    def __init__(self, host, port, handler, *, security_store: Any = None, sock=None):
         self.host = host
         self.port = port
         self.handler = handler
         self.security_store = security_store
+        # 热重启时由上一个进程交接过来的监听 socket（见 utils/hotrestart.py）
+        self.sock = sock
 
         self._server: Optional[asyncio.base_events.Server] = None
         self._serve_task: Optional[asyncio.Task] = None
@@ -62,19 +65,55 @@ class Server:
             return
 
         connection = Connection(writer)
+        connection.reader = reader
 
+        totals.connections += 1
         try:
             self.handler(connection)
+            await self._read_loop(reader, connection, addr)
+        finally:
+            totals.connections -= 1
+            connection.close()
+
+    async def _read_loop(self, reader: asyncio.StreamReader, connection: Connection, addr) -> None:
+        try:
             while True:
                 connection.on_receive(await receive_message(reader))
         except (asyncio.IncompleteReadError, ConnectionResetError):
             logger.info(f"Client disconnected from {addr}")
+
+    async def adopt(self, sock, pending: bytes, setup: Callable[[Connection], None]) -> None:
+        """接管由其他 worker 交接过来的连接（版本握手已在对方完成）。
+
+        ``pending`` 是对方已读入但未处理的字节，必须先于 socket 中的新数据送入解析；
+        ``setup(connection)`` 负责创建处理器并重放触发交接的请求。
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        if pending:
+            reader.feed_data(pending)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock=sock)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        addr = writer.get_extra_info('peername')
+        logger.info(f"Adopted client {addr} from another worker")
+
+        connection = Connection(writer)
+        connection.reader = reader
+        totals.connections += 1
+        try:
+            setup(connection)
+            await self._read_loop(reader, connection, addr)
         finally:
+            totals.connections -= 1
             connection.close()
 
     async def start(self):
         # start_server returns immediately, but serve_forever blocks, so we run it in a task.
-        self._server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        if self.sock is not None:
+            self._server = await asyncio.start_server(self.handle_client, sock=self.sock)
+        else:
+            self._server = await asyncio.start_server(self.handle_client, self.host, self.port)
         addrs = ', '.join(str(sock.getsockname()) for sock in (self._server.sockets or []))
         logger.info(f"Server listening on {addrs}")
 
@@ -85,12 +124,19 @@ class Server:
 
         self._serve_task = asyncio.create_task(_serve())
 
+    def listening_socket(self):
+        """The (first) listening socket, e.g. to hand it over on hot restart."""
+        if self._server is None or not self._server.sockets:
+            return None
+        return self._server.sockets[0]
+
     async def stop(self) -> None:
         if self._serve_task:
             self._serve_task.cancel()
             try:
                 await self._serve_task
-            except Exception:
+            except (asyncio.CancelledError, Exception):
+                # CancelledError 不是 Exception 的子类，不捕获会直接中断关闭流程
                 pass
             self._serve_task = None
 
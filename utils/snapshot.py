@@ -0,0 +1,135 @@
+"""Binary snapshot of the room registry, carried across a hot restart.
+
+Only plain values are written (ints / strings / lists / tuples), encoded
+with :mod:`marshal` behind a small header::
+
+    b"PPRS" | version: u16 LE | marshal payload
+
+The payload holds every room (phase, chart, flags, members, ready /
+finished sets, contest whitelist, player limit) and one resume session per player —
+``(token, user id, name, language, room id, seconds left)`` — so the new
+process can rebuild the rooms and let players reclaim their slots (see
+:mod:`utils.resume`). Connections are not part of the snapshot; members are
+restored with a :class:`~utils.resume.DetachedConnection`.
+
+The file is only ever read back by the same server, so marshal's lack of
+a stable cross-version format is not a concern beyond the version check.
+"""
+
+from __future__ import annotations
+
+import logging
+import marshal
+import os
+import struct
+from typing import Dict, Iterable, List, Tuple
+
+from rymc.phira.protocol.data.state import Playing, SelectChart, WaitForReady
+from utils.phiraapi import OnlineProfile
+from utils.resume import DetachedConnection
+from utils.room import Room, RoomUser
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PPRS"
+VERSION = 1
+_HEADER = struct.Struct("<4sH")
+
+# (token, user id, name, language, room id or None, seconds left)
+Session = Tuple[str, int, str, str, object, float]
+
+_PHASE = {SelectChart: 0, WaitForReady: 1, Playing: 2}
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _dump_room(room: Room) -> tuple:
+    return (
+        room.id, room.host, _PHASE[type(room.state)], room.chart,
+        room.live, room.locked, room.cycle,
+        list(room.users), list(room.monitors),
+        list(room.ready), list(room.finished),
+        room.contest_mode, list(room.whitelist), room.max_users,
+    )
+
+
+def _load_room(data: tuple, profiles: Dict[int, OnlineProfile]) -> Room:
+    (rid, host, phase, chart, live, locked, cycle,
+     users, monitors, ready, finished, contest_mode, whitelist) = data[:13]
+    # 人数上限是后来加的字段，旧进程写的快照里没有
+    max_users = data[13] if len(data) > 13 else None
+    room = Room(rid)
+    room.host = host
+    room.chart = chart
+    room.state = (SelectChart(chartId=chart), WaitForReady(), Playing())[phase]
+    room.live, room.locked, room.cycle = live, locked, cycle
+    for uid in users:
+        profile = profiles.get(uid)
+        if profile is None:
+            logger.warning("Snapshot: no session for user %s of room %s, dropped", uid, rid)
+            continue
+        room.users[uid] = RoomUser(profile, DetachedConnection(uid))
+    room.monitors = list(monitors)
+    room.ready = {uid: True for uid in ready if uid in room.users}
+    room.finished = {uid: True for uid in finished if uid in room.users}
+    room.contest_mode = contest_mode
+    room.whitelist = list(whitelist)
+    room.max_users = max_users
+    return room
+
+
+def dumps(rooms: Dict[str, Room], sessions: Iterable[Session]) -> bytes:
+    payload = {
+        "rooms": [_dump_room(room) for room in rooms.values()],
+        "sessions": [tuple(s) for s in sessions],
+    }
+    return _HEADER.pack(MAGIC, VERSION) + marshal.dumps(payload)
+
+
+def loads(data: bytes) -> Tuple[Dict[str, Room], List[Session]]:
+    """Rebuild ``(rooms, sessions)``; rooms without remaining members are dropped."""
+    if len(data) < _HEADER.size:
+        raise SnapshotError("snapshot too short")
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError(f"unsupported snapshot {magic!r} v{version}")
+    try:
+        payload = marshal.loads(data[_HEADER.size:])
+    except (EOFError, ValueError, TypeError) as e:
+        raise SnapshotError(f"corrupt snapshot: {e}") from e
+
+    sessions: List[Session] = [tuple(s) for s in payload["sessions"]]
+    profiles = {uid: OnlineProfile(uid, name, lang, token=token) for token, uid, name, lang, _, _ in sessions}
+    rooms: Dict[str, Room] = {}
+    for data_room in payload["rooms"]:
+        room = _load_room(data_room, profiles)
+        if not room.users:
+            continue
+        if room.host not in room.users:
+            room.host = next(iter(room.users))
+        rooms[room.id] = room
+    return rooms, sessions
+
+
+def save(path: str, rooms: Dict[str, Room], sessions: Iterable[Session]) -> int:
+    """Write the snapshot (owner-only, it contains login tokens); returns its size."""
+    data = dumps(rooms, sessions)
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+
+def load(path: str, *, remove: bool = True) -> Tuple[Dict[str, Room], List[Session]]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if remove:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return loads(data)
@@ -0,0 +1,260 @@
+"""Connection and room deadlines on top of :class:`utils.timerwheel.TimerWheel`.
+
+Policies (seconds, ``0`` disables one):
+
+- ``auth_timeout``: a connection must authenticate within this time.
+- ``idle_timeout``: a connection that sends nothing (clients ping every few
+  seconds) for this long is closed.
+- ``ready_timeout``: a room left in WaitForReady this long is sent back to
+  SelectChart, as if the host had cancelled.
+- ``playing_stall_timeout``: a player in a Playing room whose connection
+  sends nothing at all (not even pings) for this long is aborted, so one
+  frozen client cannot hold the round forever. A player who disconnects
+  mid-round while their slot is held for resume keeps the deadline (from
+  the last packet the old connection sent); resuming re-arms it for the
+  new connection.
+- ``playing_max_duration``: players still unfinished this long after the
+  round started are aborted.
+
+Packets only refresh a ``last_seen`` timestamp; timers are not re-armed per
+packet. When a deadline fires it checks the timestamp and either acts or
+re-schedules itself for the remaining time. Room timers remember the state
+object they were armed for and do nothing once the room has moved on.
+
+The manager only decides *when*; the actions (closing a connection,
+aborting a player, cancelling the ready phase) are callbacks supplied by
+``main`` so they reuse the normal handler paths.
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, fields
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from rymc.phira.protocol.data.state import Playing
+from utils.room import rooms
+from utils.timerwheel import Timer, TimerWheel
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TimeoutPolicy:
+    auth_timeout: float = 30.0
+    idle_timeout: float = 60.0
+    ready_timeout: float = 0.0
+    playing_stall_timeout: float = 30.0
+    playing_max_duration: float = 0.0
+
+    @classmethod
+    def from_config(cls, get_value: Callable[[str, Any], Any]) -> "TimeoutPolicy":
+        policy = cls()
+        for f in fields(cls):
+            value = get_value(f.name, None)
+            if value is not None:
+                setattr(policy, f.name, max(0.0, float(value)))
+        return policy
+
+
+class _Session:
+    __slots__ = ("handler", "last_seen", "user_id", "auth_timer", "idle_timer", "stall_timer", "stall_room")
+
+    def __init__(self, handler, now: float) -> None:
+        self.handler = handler
+        self.last_seen = now
+        self.user_id = None
+        self.auth_timer: Optional[Timer] = None
+        self.idle_timer: Optional[Timer] = None
+        self.stall_timer: Optional[Timer] = None
+        self.stall_room: Optional[Tuple[Any, Any, Any]] = None     # (room id, room, state) of the stall timer
+
+    def cancel_all(self) -> None:
+        for timer in (self.auth_timer, self.idle_timer, self.stall_timer):
+            if timer is not None:
+                timer.cancel()
+
+
+class TimeoutManager:
+    def __init__(
+        self,
+        wheel: TimerWheel,
+        policy: TimeoutPolicy,
+        *,
+        on_auth_timeout: Callable[[Any], None],
+        on_idle: Callable[[Any], None],
+        on_ready_timeout: Callable[[Any], None],
+        on_stalled: Callable[[Any, Any, Any], None],
+    ) -> None:
+        self.wheel = wheel
+        self.policy = policy
+        self.on_auth_timeout = on_auth_timeout
+        self.on_idle = on_idle
+        self.on_ready_timeout = on_ready_timeout
+        self.on_stalled = on_stalled
+        self._sessions: Dict[Any, _Session] = {}     # connection -> session
+        self._by_user: Dict[Any, _Session] = {}      # user id -> session
+        self._held: Dict[Any, Timer] = {}            # user id -> stall timer of a disconnected (held) player
+        self._room_timers: Dict[Any, Timer] = {}     # room object -> ready / max duration timer
+        self.fired: Dict[str, int] = {"auth": 0, "idle": 0, "ready": 0, "stalled": 0, "max_duration": 0}
+
+    # ---- connections ------------------------------------------------------
+
+    def connection_opened(self, connection, handler) -> None:
+        session = _Session(handler, self.wheel.clock())
+        self._sessions[connection] = session
+        if self.policy.auth_timeout:
+            session.auth_timer = self.wheel.call_later(self.policy.auth_timeout, self._auth_deadline, connection)
+        if self.policy.idle_timeout:
+            session.idle_timer = self.wheel.call_later(self.policy.idle_timeout, self._idle_deadline, connection)
+
+    def packet_received(self, connection) -> None:
+        session = self._sessions.get(connection)
+        if session is not None:
+            session.last_seen = self.wheel.clock()
+
+    def authenticated(self, connection, user_id) -> None:
+        session = self._sessions.get(connection)
+        if session is None:
+            return
+        if session.auth_timer is not None:
+            session.auth_timer.cancel()
+            session.auth_timer = None
+        session.user_id = user_id
+        self._by_user[user_id] = session
+
+    def connection_closed(self, connection) -> None:
+        session = self._sessions.pop(connection, None)
+        if session is None:
+            return
+        session.cancel_all()
+        if session.user_id is not None and self._by_user.get(session.user_id) is session:
+            del self._by_user[session.user_id]
+            if session.stall_timer is not None:
+                # 游玩中断线（位置可能被保留等待续连）：卡死期限照常从旧连接最后一个包算起
+                remaining = session.last_seen + self.policy.playing_stall_timeout - self.wheel.clock()
+                self._held[session.user_id] = self.wheel.call_later(
+                    max(0.0, remaining), self._held_deadline, session.user_id, *session.stall_room)
+
+    def resumed(self, user_id, room) -> None:
+        """``user_id`` came back to ``room`` on a new connection: its stall deadline moves to the new session."""
+        timer = self._held.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        if self.policy.playing_stall_timeout and type(room.state) is Playing and user_id not in room.finished:
+            self._arm_stall(user_id, room, self.policy.playing_stall_timeout)
+
+    def _auth_deadline(self, connection) -> None:
+        session = self._sessions.get(connection)
+        if session is None or session.user_id is not None:
+            return
+        self.fired["auth"] += 1
+        logger.info("Connection did not authenticate within %ss, closing", self.policy.auth_timeout)
+        self.on_auth_timeout(connection)
+
+    def _idle_deadline(self, connection) -> None:
+        session = self._sessions.get(connection)
+        if session is None:
+            return
+        remaining = session.last_seen + self.policy.idle_timeout - self.wheel.clock()
+        if remaining > 0:
+            session.idle_timer = self.wheel.call_later(remaining, self._idle_deadline, connection)
+            return
+        session.idle_timer = None
+        self.fired["idle"] += 1
+        logger.info("Connection of user %s idle for %ss, closing", session.user_id, self.policy.idle_timeout)
+        self.on_idle(connection)
+
+    # ---- rooms (room_engine after-hook) -----------------------------------
+
+    def room_transition(self, room, transition, user_id, source) -> None:
+        name = transition.name
+        if name == "request_start":
+            self._arm_room(room, self.policy.ready_timeout, self._ready_deadline)
+        elif name == "start_playing":
+            self._arm_room(room, self.policy.playing_max_duration, self._max_duration_deadline)
+            if self.policy.playing_stall_timeout:
+                for uid in room.users:
+                    self._arm_stall(uid, room, self.policy.playing_stall_timeout)
+        elif name in ("cancel_start", "end_round"):
+            self._disarm_room(room)
+        elif name in ("played", "abort"):
+            session = self._by_user.get(user_id)
+            if session is not None and session.stall_timer is not None:
+                session.stall_timer.cancel()
+                session.stall_timer = None
+
+    def _arm_room(self, room, delay: float, callback) -> None:
+        self._disarm_room(room)
+        if delay:
+            self._room_timers[room] = self.wheel.call_later(delay, callback, room.id, room, room.state)
+
+    def _disarm_room(self, room) -> None:
+        timer = self._room_timers.pop(room, None)
+        if timer is not None:
+            timer.cancel()
+
+    @staticmethod
+    def _still(room_id, room, state) -> bool:
+        # 房间已被销毁/重建或阶段已改变时，定时器作废
+        return rooms.get(room_id) is room and room.state is state
+
+    def _ready_deadline(self, room_id, room, state) -> None:
+        self._room_timers.pop(room, None)
+        if not self._still(room_id, room, state):
+            return
+        self.fired["ready"] += 1
+        logger.info("Room %s waited for ready over %ss, back to SelectChart", room_id, self.policy.ready_timeout)
+        self.on_ready_timeout(room_id)
+
+    def _max_duration_deadline(self, room_id, room, state) -> None:
+        self._room_timers.pop(room, None)
+        if not self._still(room_id, room, state):
+            return
+        for uid in list(room.users):
+            # 断线保留位置的玩家没有会话，handler 为 None
+            session = self._by_user.get(uid)
+            if uid not in room.finished and self._still(room_id, room, state):
+                self.fired["max_duration"] += 1
+                self.on_stalled(session.handler if session is not None else None, room_id, uid)
+
+    def _arm_stall(self, uid, room, delay: float) -> None:
+        session = self._by_user.get(uid)
+        if session is None:
+            return
+        if session.stall_timer is not None:
+            session.stall_timer.cancel()
+        session.stall_room = (room.id, room, room.state)
+        session.stall_timer = self.wheel.call_later(delay, self._stall_deadline, uid, room.id, room, room.state)
+
+    def _stall_deadline(self, uid, room_id, room, state) -> None:
+        session = self._by_user.get(uid)
+        if session is None:
+            return
+        session.stall_timer = None
+        if not self._still(room_id, room, state) or uid not in room.users or uid in room.finished:
+            return
+        remaining = session.last_seen + self.policy.playing_stall_timeout - self.wheel.clock()
+        if remaining > 0:
+            session.stall_timer = self.wheel.call_later(remaining, self._stall_deadline, uid, room_id, room, state)
+            return
+        self.fired["stalled"] += 1
+        logger.info("User %s stalled in room %s for %ss, aborting", uid, room_id, self.policy.playing_stall_timeout)
+        self.on_stalled(session.handler, room_id, uid)
+
+    def _held_deadline(self, uid, room_id, room, state) -> None:
+        if self._held.pop(uid, None) is None or uid in self._by_user:
+            return
+        if not self._still(room_id, room, state) or uid not in room.users or uid in room.finished:
+            return
+        self.fired["stalled"] += 1
+        logger.info("Disconnected user %s stalled in room %s for %ss, aborting", uid, room_id,
+                    self.policy.playing_stall_timeout)
+        self.on_stalled(None, room_id, uid)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "timers": len(self.wheel),
+            "connections": len(self._sessions),
+            **{f"fired.{k}": v for k, v in self.fired.items()},
+        }
@@ -0,0 +1,186 @@
+"""Hierarchical timer wheel.
+
+One wheel driven by a single asyncio task replaces per-deadline
+``loop.call_later`` handles: scheduling and cancelling are O(1) dict
+operations, and thousands of deadlines cost one small :class:`Timer` each.
+
+Time is quantised to ``resolution`` seconds ("ticks"). Level 0 holds the
+next ``slots[0]`` ticks one slot per tick; each further level covers
+``slots[n]`` times the span of the level below, and its slots are cascaded
+down whenever the lower level wraps around. Deadlines beyond the last level
+are parked in its farthest slot and re-placed on every cascade.
+
+Time comes from :func:`utils.clock.monotonic` by default, so a
+:class:`utils.clock.VirtualClock` can drive the wheel through :meth:`advance`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from utils import clock as clock_mod
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """A scheduled callback; ``cancel()`` is O(1) and idempotent."""
+
+    __slots__ = ("expires", "callback", "args", "cancelled", "_slot", "_wheel")
+
+    def __init__(self, wheel: "TimerWheel", expires: int, callback: Callable[..., Any], args: tuple) -> None:
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._slot: Optional[Dict["Timer", None]] = None
+        self._wheel = wheel
+
+    def cancel(self) -> None:
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self._slot is not None:
+            del self._slot[self]
+            self._slot = None
+            self._wheel._count -= 1
+
+    def __repr__(self) -> str:
+        return f"<Timer tick={self.expires} {getattr(self.callback, '__name__', self.callback)}{' cancelled' if self.cancelled else ''}>"
+
+
+class TimerWheel:
+    def __init__(
+        self,
+        resolution: float = 0.1,
+        slots: Sequence[int] = (256, 64, 64, 64),
+        *,
+        clock: Callable[[], float] = clock_mod.monotonic,
+    ) -> None:
+        for n in slots:
+            if n < 2 or n & (n - 1):
+                raise ValueError("slot counts must be powers of two >= 2")
+        self.resolution = float(resolution)
+        self.clock = clock
+        self._origin = clock()
+        self._current = 0                       # next tick to process
+        self._bits = [n.bit_length() - 1 for n in slots]
+        self._masks = [n - 1 for n in slots]
+        self._spans: List[int] = []             # ticks covered by levels 0..n
+        span = 1
+        for n in slots:
+            span *= n
+            self._spans.append(span)
+        self._levels: List[List[Dict[Timer, None]]] = [[{} for _ in range(n)] for n in slots]
+        self._count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    # ---- scheduling -------------------------------------------------------
+
+    def call_later(self, delay: float, callback: Callable[..., Any], *args: Any) -> Timer:
+        return self.call_at(self.clock() + max(0.0, delay), callback, *args)
+
+    def call_at(self, when: float, callback: Callable[..., Any], *args: Any) -> Timer:
+        expires = math.ceil((when - self._origin) / self.resolution - 1e-9)
+        timer = Timer(self, expires, callback, args)
+        self._place(timer)
+        self._count += 1
+        return timer
+
+    def _place(self, timer: Timer) -> None:
+        expires = max(timer.expires, self._current)
+        delta = expires - self._current
+        shift = 0
+        for level, span in enumerate(self._spans):
+            if delta < span or level == len(self._spans) - 1:
+                if delta >= span:
+                    # 超出最高层范围: 先放在最远的槽里，级联时会按真实到期时间重新放置
+                    expires = self._current + span - 1
+                slot = self._levels[level][(expires >> shift) & self._masks[level]]
+                break
+            shift += self._bits[level]
+        slot[timer] = None
+        timer._slot = slot
+
+    def __len__(self) -> int:
+        return self._count
+
+    # ---- expiry -----------------------------------------------------------
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """Run every timer due at ``now`` (default: the clock); returns how many fired."""
+        if now is None:
+            now = self.clock()
+        target = math.floor((now - self._origin) / self.resolution + 1e-9)
+        fired = 0
+        while self._current <= target:
+            if self._count == 0:
+                # 空轮直接跳到目标 tick（槽位只依赖 tick 编号，跳过是安全的）
+                self._current = target + 1
+                break
+            fired += self._tick(self._current)
+        return fired
+
+    def _tick(self, tick: int) -> int:
+        # 低层转完一圈时，把上一层对应的槽级联下来
+        shift = 0
+        for level in range(1, len(self._levels)):
+            shift += self._bits[level - 1]
+            if tick & ((1 << shift) - 1):
+                break
+            self._cascade(level, (tick >> shift) & self._masks[level])
+
+        slot = self._levels[0][tick & self._masks[0]]
+        # 先推进 tick: 回调里新建的已到期定时器落到下一个 tick，而不是刚清空的槽（否则要等一整圈）
+        self._current = tick + 1
+        if not slot:
+            return 0
+        due = list(slot)
+        slot.clear()
+        self._count -= len(due)
+        for timer in due:
+            timer._slot = None
+        fired = 0
+        for timer in due:
+            if timer.cancelled:
+                # 同一批次中被先执行的回调取消
+                continue
+            timer.cancelled = True  # 已触发，之后 cancel() 无副作用
+            fired += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback failed: %r", timer)
+        return fired
+
+    def _cascade(self, level: int, index: int) -> None:
+        slot = self._levels[level][index]
+        if not slot:
+            return
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._place(timer)
+
+    # ---- driving ----------------------------------------------------------
+
+    def start(self) -> None:
+        """Drive the wheel from the running event loop (one task for all timers)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.resolution)
+                self.advance()
+        except asyncio.CancelledError:
+            pass
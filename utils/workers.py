@@ -0,0 +1,252 @@
+"""Multi-process worker mode.
+
+With ``"workers": N`` in ``config.json`` (POSIX only) the main process forks
+N workers. Each worker runs the normal server on its own event loop, and
+they all bind the game port with ``SO_REUSEPORT``, so the kernel spreads
+new connections across them. The parent process becomes the
+**coordinator**. It holds the only shared state:
+
+- the room directory: room id -> worker that owns the room;
+- presence: user id -> worker the player is online on (or has a held
+  resume slot on).
+
+Workers talk to the coordinator over a Unix socket with the directory
+protocol of :mod:`utils.directory` (the coordinator is its broker, worker
+ids are the node ids).
+
+A connection may land on a worker that does not own the player's room,
+either by joining a room created elsewhere or by reconnecting to a player
+who is still present on another worker. That connection is **handed off**.
+The socket fd (plus any bytes already read from it) goes to the owning
+worker over a per-worker ``SOCK_DGRAM`` Unix socket with ``SCM_RIGHTS``.
+The owning worker adopts it and replays the request that triggered the
+handoff. The client keeps the same TCP connection and notices nothing.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from typing import Any, Callable, Dict, Optional
+
+from utils.directory import DirectoryClient, DirectoryServer
+
+logger = logging.getLogger(__name__)
+
+# worker 以该退出码结束表示请求重启（/restart），协调进程会重新拉起全部 worker
+RESTART_EXIT_CODE = 75
+_MAX_HANDOFF = 1 << 20
+
+
+def supported() -> bool:
+    return os.name == "posix" and hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "send_fds")
+
+
+# ---- coordinator (parent process) ----------------------------------------
+
+
+class Coordinator(DirectoryServer):
+    """Room directory and presence shared by all workers (node id = worker id)."""
+
+    async def serve(self, sock: socket.socket, pids: Dict[int, int]) -> int:
+        """Serve workers until one of them exits; returns that worker's exit code."""
+        await self.start(sock=sock)
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        exit_code = 0
+        try:
+            while not stop.is_set():
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid and pid in pids:
+                    exit_code = os.waitstatus_to_exitcode(status)
+                    logger.warning("Worker %s (pid %s) exited with %s", pids[pid], pid, exit_code)
+                    del pids[pid]
+                    break
+                try:
+                    await asyncio.wait_for(stop.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.close()
+        return exit_code
+
+
+# ---- worker side ------------------------------------------------------------
+
+
+class WorkerCluster(DirectoryClient):
+    """A worker's view of the cluster: directory client + connection handoff."""
+
+    def __init__(self, worker_id: int, count: int, run_dir: str, host: str, port: int) -> None:
+        super().__init__(worker_id, broker="unix:" + os.path.join(run_dir, "coordinator.sock"))
+        self.worker_id = worker_id
+        self.count = count
+        self.run_dir = run_dir
+        self.host = host
+        self.port = port
+        self._inbox: Optional[socket.socket] = None
+        self.stats: Dict[str, int] = {"handoff_out": 0, "handoff_in": 0, "handoff_failed": 0}
+
+    def listen_socket(self) -> socket.socket:
+        """The game port, bound with SO_REUSEPORT so every worker can accept on it."""
+        family = socket.AF_INET6 if ":" in str(self.host) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(256)
+        sock.setblocking(False)
+        return sock
+
+    def inbox_path(self, worker_id: int) -> str:
+        return os.path.join(self.run_dir, f"worker-{worker_id}.sock")
+
+    # -- handoff --
+
+    def start_inbox(self, adopt: Callable[[socket.socket, Dict[str, Any]], None]) -> None:
+        """Receive handed-off connections; ``adopt(sock, payload)`` runs on the event loop."""
+        path = self.inbox_path(self.worker_id)
+        inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        inbox.bind(path)
+        inbox.setblocking(False)
+        self._inbox = inbox
+
+        def _on_readable() -> None:
+            while True:
+                try:
+                    data, fds, _, _ = socket.recv_fds(inbox, _MAX_HANDOFF, 1)
+                except (BlockingIOError, InterruptedError):
+                    return
+                if not fds:
+                    continue
+                sock = socket.socket(fileno=fds[0])
+                try:
+                    payload = json.loads(data)
+                except ValueError:
+                    logger.error("Dropping malformed handoff message")
+                    sock.close()
+                    continue
+                self.stats["handoff_in"] += 1
+                adopt(sock, payload)
+
+        asyncio.get_running_loop().add_reader(inbox.fileno(), _on_readable)
+
+    def hand_off(self, connection, worker_id: int, payload: Dict[str, Any]) -> None:
+        """Move ``connection`` (a :class:`utils.connection.Connection`) to ``worker_id``.
+
+        Must be called from the packet handler: reading stops and the bytes
+        already buffered are taken out before the read loop can parse them.
+        The fd is sent once everything queued for the client has been
+        written, so nothing is reordered.
+        """
+        connection.writer.transport.pause_reading()
+        reader = getattr(connection, "reader", None)
+        pending = b""
+        if reader is not None:
+            # StreamReader 已读入但尚未解析的字节（没有公开接口，只能取内部缓冲区）
+            pending = bytes(reader._buffer)
+            reader._buffer.clear()
+        payload = dict(payload, pending=base64.b64encode(pending).decode())
+        asyncio.get_running_loop().create_task(self._send_connection(connection, worker_id, payload))
+
+    async def _send_connection(self, connection, worker_id: int, payload: Dict[str, Any]) -> None:
+        writer = connection.writer
+        try:
+            await connection.write_queue.join()
+            await writer.drain()
+            data = json.dumps(payload).encode()
+            fd = os.dup(writer.get_extra_info("socket").fileno())
+            try:
+                out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                out.settimeout(2)
+                try:
+                    # send_fds 在 3.11 及以前会忽略 address 参数，需先 connect
+                    out.connect(self.inbox_path(worker_id))
+                    socket.send_fds(out, [data], [fd])
+                finally:
+                    out.close()
+            finally:
+                os.close(fd)
+            self.stats["handoff_out"] += 1
+        except Exception:
+            self.stats["handoff_failed"] += 1
+            logger.exception("Failed to hand connection over to worker %s, closing it", worker_id)
+        # 对方持有同一个 socket 的副本，这里关闭只释放本进程的引用，不会断开客户端
+        writer.transport.abort()
+
+    def close(self) -> None:
+        if self._inbox is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._inbox.fileno())
+            except RuntimeError:
+                pass
+            self._inbox.close()
+            self._inbox = None
+        super().close()
+
+
+def decode_pending(payload: Dict[str, Any]) -> bytes:
+    return base64.b64decode(payload.get("pending") or b"")
+
+
+# ---- process management ------------------------------------------------------
+
+
+def run(count: int, host: str, port: int, run_worker: Callable[[WorkerCluster], None]) -> int:
+    """Fork ``count`` workers and coordinate them; returns the exit code of the first worker to exit."""
+    run_dir = tempfile.mkdtemp(prefix="pyphira-")
+    coord_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    coord_sock.bind(os.path.join(run_dir, "coordinator.sock"))
+    coord_sock.listen(count * 2)
+
+    pids: Dict[int, int] = {}
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            coord_sock.close()
+            # Ctrl+C 发给整个进程组；由协调进程统一用 SIGTERM 结束各 worker
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                cluster = WorkerCluster(worker_id, count, run_dir, host, port)
+                cluster.connect()
+                run_worker(cluster)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                logger.exception("Worker %s crashed", worker_id)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        pids[pid] = worker_id
+    logger.info("Started %s workers on port %s: %s", count, port, sorted(pids))
+
+    try:
+        code = asyncio.run(Coordinator().serve(coord_sock, pids))
+    finally:
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(pids):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        coord_sock.close()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return code